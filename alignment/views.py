@@ -56,16 +56,7 @@ class TargetSelectionGprotein(AbsTargetSelection):
             'color': 'success',
         },
     }
-    try:
-        ppf = ProteinFamily.objects.get(slug="100_000")
-        pfs = ProteinFamily.objects.filter(parent=ppf.id)
-        ps = Protein.objects.filter(family=ppf)
-        tree_indent_level = []
-        action = 'expand'
-        # remove the parent family (for all other families than the root of the tree, the parent should be shown)
-        del ppf
-    except Exception as e:
-        pass
+    default_slug = '100_000'
 
 class SegmentSelection(AbsSegmentSelection):
     step = 2
@@ -1,5 +1,7 @@
 from rest_framework import renderers
 
+import json
+
 class PDBRenderer(renderers.BaseRenderer):
     media_type = 'chemical/x-pdb'
     format = 'pdb'
@@ -7,4 +9,34 @@ class PDBRenderer(renderers.BaseRenderer):
     filename = 'output.pdb'
 
     def render(self, data, media_type=None, renderer_context=None):
-        return data
\ No newline at end of file
+        return data
+
+class FastaRenderer(renderers.BaseRenderer):
+    media_type = 'text/x-fasta'
+    format = 'fasta'
+    charset = 'utf-8'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            return ''.join(stream_fasta((k, v) for k, v in data.items() if isinstance(v, str)))
+        return data
+
+
+def alignment_rows(alignment):
+    """Generate the (entry name, aligned sequence) pairs of an alignment, one row at a time"""
+    for row in alignment.proteins:
+        yield row.protein.entry_name, ''.join([r[2] for s in row.alignment.values() for r in s])
+
+
+def stream_json(items):
+    """Write (key, value) pairs as a JSON object, one pair at a time"""
+    yield '{'
+    for i, (key, value) in enumerate(items):
+        yield '{}{}:{}'.format(',' if i else '', json.dumps(key), json.dumps(value))
+    yield '}'
+
+
+def stream_fasta(items):
+    """Write (name, sequence) pairs as FASTA records, one record at a time"""
+    for name, sequence in items:
+        yield '>{}\n{}\n'.format(name, sequence)
@@ -1,27 +1,32 @@
 from django.conf.urls import include, url
 from api import views
+from common.release_cache import release_cache_page
+
+
+# read-only endpoints are cached until the next data release (see common.release_cache)
+cached = release_cache_page()
 
 
 urlpatterns = [
     url(r'^', include(views.router.urls, namespace='services')),
     url(r'^reference/', views.schema_view),
-    url(r'^protein/accession/(?P<accession>[^/].+)/$', views.ProteinByAccessionDetail.as_view(),
+    url(r'^protein/accession/(?P<accession>[^/].+)/$', cached(views.ProteinByAccessionDetail.as_view()),
         name='proteinbyaccession'),
-    url(r'^protein/(?P<entry_name>[^/].+)/$', views.ProteinDetail.as_view(), name='protein-detail'),
+    url(r'^protein/(?P<entry_name>[^/].+)/$', cached(views.ProteinDetail.as_view()), name='protein-detail'),
     
-    url(r'^proteinfamily/$', views.ProteinFamilyList.as_view(), name='proteinfamily-list'),
-    url(r'^proteinfamily/(?P<slug>[^/]+)/$', views.ProteinFamilyDetail.as_view(), name='proteinfamily-detail'),
-    url(r'^proteinfamily/children/(?P<slug>[^/]+)/$', views.ProteinFamilyChildrenList.as_view(),
+    url(r'^proteinfamily/$', cached(views.ProteinFamilyList.as_view()), name='proteinfamily-list'),
+    url(r'^proteinfamily/(?P<slug>[^/]+)/$', cached(views.ProteinFamilyDetail.as_view()), name='proteinfamily-detail'),
+    url(r'^proteinfamily/children/(?P<slug>[^/]+)/$', cached(views.ProteinFamilyChildrenList.as_view()),
         name='proteinfamily-children'),
-    url(r'^proteinfamily/descendants/(?P<slug>[^/]+)/$', views.ProteinFamilyDescendantList.as_view(),
+    url(r'^proteinfamily/descendants/(?P<slug>[^/]+)/$', cached(views.ProteinFamilyDescendantList.as_view()),
         name='proteinfamily-descendants'),
-    url(r'^proteinfamily/proteins/(?P<slug>[^/]+)/$', views.ProteinsInFamilyList.as_view(),
+    url(r'^proteinfamily/proteins/(?P<slug>[^/]+)/$', cached(views.ProteinsInFamilyList.as_view()),
         name='proteinfamily-proteins'),
-    url(r'^proteinfamily/proteins/(?P<slug>[^/]+)/(?P<latin_name>[^/]+)/$', views.ProteinsInFamilySpeciesList.as_view(),
+    url(r'^proteinfamily/proteins/(?P<slug>[^/]+)/(?P<latin_name>[^/]+)/$', cached(views.ProteinsInFamilySpeciesList.as_view()),
         name='proteinfamily-proteins'),
 
-    url(r'^residues/(?P<entry_name>[^/]+)/$', views.ResiduesList.as_view(), name='residues'),
-    url(r'^residues/extended/(?P<entry_name>[^/]+)/$', views.ResiduesExtendedList.as_view(), name='residues-extended'),
+    url(r'^residues/(?P<entry_name>[^/]+)/$', cached(views.ResiduesList.as_view()), name='residues'),
+    url(r'^residues/extended/(?P<entry_name>[^/]+)/$', cached(views.ResiduesExtendedList.as_view()), name='residues-extended'),
     
     url(r'^alignment/family/(?P<slug>[^/]+)/$', views.FamilyAlignment.as_view(), name='familyalignment'),
     url(r'^alignment/family/(?P<slug>[^/]+)/statistics/$', views.FamilyAlignment.as_view(), {'statistics': True}, name='familyalignment-statistics'),
@@ -44,25 +49,25 @@ urlpatterns = [
     url(r'^alignment/similarity/(?P<proteins>[^/]+)/(?P<segments>[^/]+)/$', views.ProteinSimilaritySearchAlignment.as_view(),
         name='proteinsimilarityalignment'),
 
-    url(r'^structure/$', views.StructureList.as_view(), name='structure-list'),
-    url(r'^structure/representative/$', views.RepresentativeStructureList.as_view(), {'representative': True},
+    url(r'^structure/$', cached(views.StructureList.as_view()), name='structure-list'),
+    url(r'^structure/representative/$', cached(views.RepresentativeStructureList.as_view()), {'representative': True},
         name='structure-representative-list'),
-    url(r'^structure/protein/(?P<entry_name>[^/]+)/$', views.StructureListProtein.as_view(),
+    url(r'^structure/protein/(?P<entry_name>[^/]+)/$', cached(views.StructureListProtein.as_view()),
         name='structure-list-protein'),
     url(r'^structure/protein/(?P<entry_name>[^/]+)/representative/$',
-        views.RepresentativeStructureListProtein.as_view(), {'representative': True},
+        cached(views.RepresentativeStructureListProtein.as_view()), {'representative': True},
         name='representative-structure-list-protein'),
-    url(r'^structure/(?P<pdb_code>[^/]+)/$', views.StructureDetail.as_view(), name='structure-detail'),
-    url(r'^structure/(?P<pdb_code>[^/]+)/interaction/$', views.StructureLigandInteractions.as_view(), name='interaction'),
-    url(r'^structure/template/(?P<entry_name>[^/]+)/$', views.StructureTemplate.as_view(),
+    url(r'^structure/(?P<pdb_code>[^/]+)/$', cached(views.StructureDetail.as_view()), name='structure-detail'),
+    url(r'^structure/(?P<pdb_code>[^/]+)/interaction/$', cached(views.StructureLigandInteractions.as_view()), name='interaction'),
+    url(r'^structure/template/(?P<entry_name>[^/]+)/$', cached(views.StructureTemplate.as_view()),
         name='structuretemplate'),
-    url(r'^structure/template/(?P<entry_name>[^/]+)/(?P<segments>[^/]+)/$', views.StructureTemplatePartial.as_view(),
+    url(r'^structure/template/(?P<entry_name>[^/]+)/(?P<segments>[^/]+)/$', cached(views.StructureTemplatePartial.as_view()),
         name='structuretemplate-partial'),
     url(r'structure/assign_generic_numbers$', views.StructureAssignGenericNumbers.as_view(),
         name='assign_generic_numbers'),
     url(r'structure/parse_pdb$', views.StructureSequenceParser.as_view(), name='sequence_parser'),
-    url(r'^species/$', views.SpeciesList.as_view(), name='species-list'),
-    url(r'^species/(?P<latin_name>[^/]+)/$', views.SpeciesDetail.as_view(), name='species-detail'),
-    url(r'^mutants/(?P<entry_name>[^/].+)/$', views.MutantList.as_view(), name='mutants'),
-    url(r'^drugs/(?P<entry_name>[^/].+)/$', views.DrugList.as_view(), name='drugs')
+    url(r'^species/$', cached(views.SpeciesList.as_view()), name='species-list'),
+    url(r'^species/(?P<latin_name>[^/]+)/$', cached(views.SpeciesDetail.as_view()), name='species-detail'),
+    url(r'^mutants/(?P<entry_name>[^/].+)/$', cached(views.MutantList.as_view()), name='mutants'),
+    url(r'^drugs/(?P<entry_name>[^/].+)/$', cached(views.DrugList.as_view()), name='drugs')
 ]
\ No newline at end of file
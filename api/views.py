@@ -2,12 +2,14 @@ from django.shortcuts import render
 from rest_framework import views, generics, viewsets
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser
-from rest_framework.renderers import JSONRenderer
+from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from django.template.loader import render_to_string
+from django.http import StreamingHttpResponse
 from django.db.models import Q
 from django.conf import settings
+from django.core.cache import cache
 
-from interaction.models import ResidueFragmentInteraction
+from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from mutation.models import MutationRaw
 from protein.models import Protein, ProteinConformation, ProteinFamily, Species, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
@@ -17,8 +19,9 @@ from api.serializers import (ProteinSerializer, ProteinFamilySerializer, Species
                              ResidueExtendedSerializer, StructureSerializer,
                              StructureLigandInteractionSerializer,
                              MutationSerializer)
-from api.renderers import PDBRenderer
+from api.renderers import PDBRenderer, FastaRenderer, alignment_rows, stream_json, stream_fasta
 from common.alignment import Alignment
+from common.tools import release_stamp
 from common.definitions import *
 from drugs.models import Drugs
 
@@ -26,6 +29,8 @@ import json, os
 from io import StringIO
 from Bio.PDB import PDBIO
 from collections import OrderedDict
+from itertools import chain
+from string import Template
 
 # FIXME add
 # getMutations
@@ -231,57 +236,68 @@ class StructureList(views.APIView):
         else:
             structures = Structure.objects.all()
 
-        structures = structures.prefetch_related('protein_conformation__protein__parent__species', 'pdb_code',
-            'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
-            'publication__web_link', 'structureligandinteraction_set__ligand__properities', 'structure_type',
-            'structureligandinteraction_set__ligand__properities__ligand_type',
-            'structureligandinteraction_set__ligand_role')
+        # the serialized list only changes with a data release
+        cache_key = 'api_structure_list_{}_{}_{}_{}'.format(release_stamp(), pdb_code, entry_name, representative)
+        s = cache.get(cache_key)
+        if s is None:
+            s = self.serialize_structures(structures)
+            cache.set(cache_key, s, 60*60*24*7) #7 days
 
-        # structures = self.get_structures(pdb_code, entry_name, representative)
+        # if a structure is selected, return a single dict rather then a list of dicts
+        if len(s) == 1:
+            s = s[0]
+
+        return Response(s)
+
+    def serialize_structures(self, structures):
+        """Convert structures to a list of dictionaries with two queries (structures and annotated ligands). Normal
+            serializers can not be used because of abstraction of tables (e.g. protein_conformation)"""
+        parent = 'protein_conformation__protein__parent__'
+        rows = structures.values('id', 'pdb_code__index', parent + 'entry_name', parent + 'family__slug',
+            parent + 'species__latin_name', 'preferred_chain', 'resolution', 'publication_date', 'structure_type__name',
+            'publication_id', 'publication__web_link__index', 'publication__web_link__web_resource__url')
+
+        # ligands of all structures, grouped by structure
+        ligands = {}
+        interactions = StructureLigandInteraction.objects.filter(structure__in=structures, annotated=True).values(
+            'structure_id', 'ligand__name', 'ligand__properities__ligand_type__name', 'ligand_role__name').order_by('id')
+        for interaction in interactions:
+            ligand = {}
+            if interaction['ligand__name']:
+                ligand['name'] = interaction['ligand__name']
+            if interaction['ligand__properities__ligand_type__name']:
+                ligand['type'] = interaction['ligand__properities__ligand_type__name']
+            if interaction['ligand_role__name']:
+                ligand['function'] = interaction['ligand_role__name']
+            if ligand:
+                ligands.setdefault(interaction['structure_id'], []).append(ligand)
 
-        # convert objects to a list of dictionaries
-        # normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)
         s = []
-        for structure in structures:
+        for row in rows:
             # essential fields
             structure_data = {
-                'pdb_code': structure.pdb_code.index,
-                'protein': structure.protein_conformation.protein.parent.entry_name,
-                'family': structure.protein_conformation.protein.parent.family.slug,
-                'species': structure.protein_conformation.protein.parent.species.latin_name,
-                'preferred_chain': structure.preferred_chain,
-                'resolution': structure.resolution,
-                'publication_date': structure.publication_date,
-                'type': structure.structure_type.name,
+                'pdb_code': row['pdb_code__index'],
+                'protein': row[parent + 'entry_name'],
+                'family': row[parent + 'family__slug'],
+                'species': row[parent + 'species__latin_name'],
+                'preferred_chain': row['preferred_chain'],
+                'resolution': row['resolution'],
+                'publication_date': row['publication_date'],
+                'type': row['structure_type__name'],
             }
 
-            # publication
-            if structure.publication:
-                structure_data['publication'] = structure.publication.web_link.__str__()
+            # publication (formatted in the same way as WebLink.__str__)
+            if row['publication_id'] and row['publication__web_link__web_resource__url'] is not None:
+                structure_data['publication'] = Template(row['publication__web_link__web_resource__url']).substitute(
+                    index=row['publication__web_link__index'])
             else:
                 structure_data['publication'] = None
 
             # ligand
-            ligands = []
-            for interaction in structure.structureligandinteraction_set.filter(annotated=True):
-                ligand = {}
-                if interaction.ligand.name:
-                    ligand['name'] = interaction.ligand.name
-                if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
-                    ligand['type'] = interaction.ligand.properities.ligand_type.name
-                if interaction.ligand_role and interaction.ligand_role.name:
-                    ligand['function'] = interaction.ligand_role.name
-                if ligand:
-                    ligands.append(ligand)
-            structure_data['ligands'] = ligands
+            structure_data['ligands'] = ligands.get(row['id'], [])
 
             s.append(structure_data)
-
-        # if a structure is selected, return a single dict rather then a list of dicts
-        if len(s) == 1:
-            s = s[0]
-
-        return Response(s)
+        return s
 
     def get_structures(self, pdb_code=None, representative=None):
         return Structure.objects.all()
@@ -318,7 +334,45 @@ class StructureDetail(StructureList):
         return Structure.objects.filter(pdb_code__index=pdb_code)
 
 
-class FamilyAlignment(views.APIView):
+class AlignmentResponseMixin:
+    """Streams an alignment row by row, as JSON (an object of entry names and sequences) or as FASTA (?format=fasta).
+        The browsable API gets a regular response"""
+
+    renderer_classes = (JSONRenderer, BrowsableAPIRenderer, FastaRenderer)
+
+    def alignment_response(self, a, extra=None):
+        rows = alignment_rows(a)
+        if extra is None:
+            extra = []
+        renderer_format = self.request.accepted_renderer.format
+        if renderer_format == 'fasta':
+            items = chain(rows, [(k, v) for k, v in extra if isinstance(v, str)])
+            return StreamingHttpResponse(stream_fasta(items), content_type='text/x-fasta')
+        elif renderer_format == 'json':
+            return StreamingHttpResponse(stream_json(chain(rows, extra)), content_type='application/json')
+        return Response(OrderedDict(chain(rows, extra)))
+
+    def alignment_statistics(self, a):
+        feat = {}
+        for i, feature in enumerate(AMINO_ACID_GROUPS):
+            feature_stats = a.feature_stats[i]
+            feature_stats_clean = []
+            for d in feature_stats:
+                sub_list = [x[0] for x in d]
+                feature_stats_clean.append(sub_list) # remove feature frequencies
+            feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
+
+        for i, AA in enumerate(AMINO_ACIDS):
+            feature_stats = a.amino_acid_stats[i]
+            feature_stats_clean = []
+            for d in feature_stats:
+                sub_list = [x[0] for x in d]
+                feature_stats_clean.append(sub_list) # remove feature frequencies
+            feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
+        return feat
+
+
+class FamilyAlignment(AlignmentResponseMixin, views.APIView):
     """
     Get a full sequence alignment of a protein family including a consensus sequence
     \n/alignment/family/{slug}/
@@ -326,7 +380,6 @@ class FamilyAlignment(views.APIView):
     """
 
     def get(self, request, slug=None, segments=None, latin_name=None, statistics=False):
-        print(statistics)
         if slug is not None:
             # Check for specific species
             if latin_name is not None:
@@ -379,44 +432,13 @@ class FamilyAlignment(views.APIView):
             residue_list = []
             for aa in a.full_consensus:
                 residue_list.append(aa.amino_acid)
-
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = OrderedDict({})
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                else:
-                    ali_dict[k] = row
-                    k = False
-            ali_dict['CONSENSUS'] = ''.join(residue_list)
+            extra = [('CONSENSUS', ''.join(residue_list))]
 
             # render statistics for output
             if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+                extra.append(('statistics', self.alignment_statistics(a)))
+
+            return self.alignment_response(a, extra)
 
 class FamilyAlignmentPartial(FamilyAlignment):
     """
@@ -521,7 +543,7 @@ class ProteinSimilaritySearchAlignment(views.APIView):
             ali_dict_ordered = OrderedDict(sorted(ali_dict.items(), key=lambda x: x[1]['similarity'], reverse=True))
             return Response(ali_dict_ordered)
 
-class ProteinAlignment(views.APIView):
+class ProteinAlignment(AlignmentResponseMixin, views.APIView):
     """
     Get a full sequence alignment of two or more proteins
     \n/alignment/protein/{proteins}/
@@ -577,43 +599,12 @@ class ProteinAlignment(views.APIView):
             if statistics == True:
                 a.calculate_statistics()
             
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    ali_dict[k] = row
-                    k = False
-            
             # render statistics for output
+            extra = []
             if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+                extra.append(('statistics', self.alignment_statistics(a)))
+
+            return self.alignment_response(a, extra)
 
 class ProteinAlignmentStatistics(ProteinAlignment):
     """
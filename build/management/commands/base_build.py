@@ -5,6 +5,10 @@ from django.db import connection
 
 import datetime
 import logging
+import os
+import queue
+import time
+import traceback
 from multiprocessing import Queue, Process
 
 
@@ -26,30 +30,173 @@ class Command(BaseCommand):
             default=False,
             help='Include only a subset of data for testing')
 
+    # number of items per work unit. If None, units shrink as the remaining work shrinks (large units first, to keep
+    # queue overhead low, and single items at the end, so that no worker is left with a long tail). Setup that does not
+    # depend on the items belongs in setup_worker, which is run once per worker, not in main_func
+    batch_size = None
+
+    # number of times a failed work unit is retried. Only commands whose main_func can safely be run again on the same
+    # items (e.g. it writes files or uses update_or_create) should set this, as a unit that fails part way may already
+    # have written some of its rows
+    retries = 0
+
+    # interval (in seconds) between progress reports
+    progress_interval = 60
+
+    # time limit (in seconds) of prepare_input, after which unfinished work units are reported as failed
+    timeout = getattr(settings, 'BUILD_TIMEOUT', None)
+
     def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
+        """Process items in parallel by calling main_func((first, last), iteration) in proc worker processes. Items are
+            split into small work units, which are handed to idle workers one at a time. Raises CommandError with the
+            work units that failed (after retries), or were not finished within timeout"""
         num_items = len(items)
 
         if not num_items:
             return False
 
-        # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
+        # make sure not to use more workers than items
         if proc > num_items:
             proc = num_items
 
-        chunk_size = int(num_items / proc)
+        results = Queue()
+        units = self.work_units(num_items, proc)
+        pending = [(unit, 1) for unit in units]
+
         connection.close()
-        for i in range(0, proc):
-            first = chunk_size * i
-            if i == proc - 1:
-                last = False
+        workers = {} # worker pid -> (process, task queue)
+        for i in range(proc):
+            self.start_worker(workers, results, iteration)
+
+        # hand out work units until all are done (or have failed too often), and replace workers that die. The unit of
+        # each worker is recorded when it is handed out, so a unit is never lost with its worker
+        assigned = {} # worker pid -> (unit, attempt)
+        failed = []
+        timings = []
+        done = 0
+        start_time = last_report = time.time()
+        while done < len(units):
+            for pid, worker in workers.items():
+                if pid not in assigned and pending:
+                    assigned[pid] = pending.pop(0)
+                    worker[1].put(assigned[pid])
+
+            if self.timeout and time.time() - start_time > self.timeout:
+                for unit, attempt in list(assigned.values()) + pending:
+                    failed.append((unit, 'Not finished within {} seconds'.format(self.timeout)))
+                for process, task_queue in workers.values():
+                    process.terminate()
+                    process.join()
+                workers = {}
+                break
+
+            for pid, worker in list(workers.items()):
+                if not worker[0].is_alive():
+                    del workers[pid]
+                    if pid in assigned:
+                        unit, attempt = assigned.pop(pid)
+                        msg = 'Worker exited with code {}'.format(worker[0].exitcode)
+                        done += self.unit_failed(pending, failed, unit, attempt, msg)
+                    if done < len(units):
+                        self.start_worker(workers, results, iteration)
+
+            try:
+                status, pid, unit, attempt, value = results.get(timeout=5)
+            except queue.Empty:
+                continue
+
+            # a result of a worker that has been found dead in the meantime was already counted as failed
+            if assigned.get(pid) != (unit, attempt):
+                continue
+            del assigned[pid]
+            if status == 'done':
+                timings.append((value, unit))
+                done += 1
+            else:
+                done += self.unit_failed(pending, failed, unit, attempt, value)
+
+            if time.time() - last_report > self.progress_interval:
+                last_report = time.time()
+                self.report_progress(timings, num_items, start_time)
+
+        for process, task_queue in workers.values():
+            task_queue.put(None)
+        for process, task_queue in workers.values():
+            process.join()
+
+        self.report_progress(timings, num_items, start_time, final=True)
+        if failed:
+            for unit, msg in failed:
+                self.logger.error('Failed to process items {} to {}: {}'.format(unit[0], unit[1], msg))
+            raise CommandError('Failed to process items {}'.format(', '.join(['{} to {}'.format(unit[0], unit[1])
+                for unit, msg in sorted(failed)])))
+        return True
+
+    def work_units(self, num_items, proc):
+        """Split the item range into (first, last) work units"""
+        units = []
+        first = 0
+        while first < num_items:
+            if self.batch_size:
+                size = self.batch_size
             else:
-                last = chunk_size * (i + 1)
-    
-            p = Process(target=self.main_func, args=([(first, last), iteration]))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
\ No newline at end of file
+                size = max(1, int((num_items - first) / (proc * 4)))
+            last = min(first + size, num_items)
+            units.append((first, last))
+            first = last
+        return units
+
+    def start_worker(self, workers, results, iteration):
+        task_queue = Queue()
+        p = Process(target=self.run_worker, args=([task_queue, results, iteration]))
+        p.start()
+        workers[p.pid] = (p, task_queue)
+
+    def setup_worker(self, iteration):
+        """Prepare a worker process before it processes its first work unit, e.g. load data that main_func uses for
+            all items. Attributes set here are available to main_func"""
+        pass
+
+    def run_worker(self, tasks, results, iteration):
+        pid = os.getpid()
+        try:
+            self.setup_worker(iteration)
+            setup_error = None
+        except Exception:
+            setup_error = traceback.format_exc()
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            unit, attempt = task
+            if setup_error:
+                results.put(('failed', pid, unit, attempt, setup_error))
+                continue
+            unit_start = time.time()
+            try:
+                self.main_func(unit, iteration)
+            except Exception:
+                results.put(('failed', pid, unit, attempt, traceback.format_exc()))
+            else:
+                results.put(('done', pid, unit, attempt, time.time() - unit_start))
+
+    def unit_failed(self, pending, failed, unit, attempt, msg):
+        """Requeue a failed work unit, or record it as failed if it has been retried too often. Returns the number of
+            finished units (0 or 1)"""
+        if attempt <= self.retries:
+            self.logger.warning('Retrying items {} to {} (attempt {}): {}'.format(unit[0], unit[1], attempt, msg))
+            pending.append((unit, attempt + 1))
+            return 0
+        failed.append((unit, msg))
+        return 1
+
+    def report_progress(self, timings, num_items, start_time, final=False):
+        processed = sum([unit[1] - unit[0] for duration, unit in timings])
+        elapsed = time.time() - start_time
+        self.logger.info('Processed {} of {} items in {:.0f}s ({:.2f} items/s)'.format(processed, num_items, elapsed,
+            processed / elapsed if elapsed else 0))
+        if final and timings:
+            slowest = sorted(timings, reverse=True)[:5]
+            self.logger.info('Slowest work units: {}'.format(', '.join(['items {} to {} ({:.1f}s, {:.1f}s/item)'.format(
+                unit[0], unit[1], duration, duration / (unit[1] - unit[0])) for duration, unit in slowest])))
@@ -0,0 +1,95 @@
+from django.conf import settings
+
+from build.management.commands.base_build import Command as BaseBuild
+from protein.models import Protein, ProteinFamily, ProteinSegment
+from common.alignment_store import AlignmentStore
+
+import shutil
+import os
+
+# alignments are stored as built by the views, with site specific generic number formatting
+Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
+
+
+class Command(BaseBuild):
+    help = 'Precomputes alignments of all protein families for the current data release, and stores them in the ' \
+        + 'alignment store'
+
+    # stored alignments are replaced atomically, so failed families can be run again
+    retries = 1
+
+    # protein sets of each family (the family alignment views, API and default target selection)
+    protein_sets = [
+        {'sequence_type__slug': 'wt'},
+        {'sequence_type__slug': 'wt', 'source__name': 'SWISSPROT'},
+    ]
+
+    # standard segment sets
+    segment_sets = [
+        ProteinSegment.objects.filter(partial=False),
+        ProteinSegment.objects.filter(category='helix'),
+    ]
+
+    # G protein families use a different set of segments
+    families = ProteinFamily.objects.exclude(slug='000').exclude(slug__startswith='100')
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Delete alignments stored for previous data releases')
+
+    def handle(self, *args, **options):
+        self.store = AlignmentStore()
+        try:
+            if options['purge']:
+                self.purge_old_releases()
+            self.logger.info('BUILDING ALIGNMENT STORE IN {}'.format(self.store.release_dir()))
+            self.prepare_input(options['proc'], self.families)
+            self.logger.info('COMPLETED BUILDING ALIGNMENT STORE')
+        except Exception as msg:
+            self.logger.error(msg)
+            raise
+
+    def purge_old_releases(self):
+        release_dir = self.store.release_dir()
+        if not os.path.isdir(self.store.location):
+            return
+        for d in os.listdir(self.store.location):
+            path = os.sep.join([self.store.location, d])
+            if path != release_dir and os.path.isdir(path):
+                shutil.rmtree(path)
+                self.logger.info('Deleted alignment store {}'.format(path))
+
+    def main_func(self, positions, iteration):
+        # families
+        if not positions[1]:
+            families = self.families[positions[0]:]
+        else:
+            families = self.families[positions[0]:positions[1]]
+
+        for family in families:
+            for protein_set in self.protein_sets:
+                proteins = Protein.objects.filter(family__slug__startswith=family.slug, **protein_set)
+                if not proteins.exists():
+                    continue
+                for segments in self.segment_sets:
+                    self.store_alignment(family, proteins, segments)
+
+    def store_alignment(self, family, proteins, segments):
+        a = Alignment()
+        a.use_alignment_store = False
+        a.load_proteins(proteins)
+        a.load_segments(segments)
+        key = self.store.key(a)
+        if not key:
+            return
+
+        if a.build_alignment() == 'Too large':
+            self.logger.info('Alignment of {} ({} residues) is too large to store'.format(family,
+                a.number_of_residues_total))
+            return
+        self.store.save(a, key)
+        self.logger.info('Stored alignment of {} with {} proteins'.format(family, len(a.proteins)))
@@ -1,12 +1,23 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
+from django.conf import settings
+from django.db import connection
 
 import datetime
+import logging
+import os
+import shutil
+import sys
+import time
+import traceback
+from multiprocessing import Process
 
 
 class Command(BaseCommand):
     help = 'Runs all build functions'
 
+    logger = logging.getLogger(__name__)
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
                             type=int,
@@ -19,43 +30,128 @@ class Command(BaseCommand):
                             dest='test',
                             default=False,
                             help='Include only a subset of data for testing')
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            action='store',
+                            dest='jobs',
+                            default=1,
+                            help='Number of independent build stages to run at the same time')
+        parser.add_argument('--resume',
+                            action='store_true',
+                            dest='resume',
+                            default=False,
+                            help='Skip stages that were completed by a previous (failed) run')
 
     def handle(self, *args, **options):
         if options['test']:
             print('Running in test mode')
 
-        commands = [
-            ['build_common'],
-            ['build_human_proteins'],
-            ['build_blast_database'],
-            ['build_other_proteins', {'constructs_only': options['test'] ,'proc': options['proc']}], # build only constructs in test mode
-            ['build_annotation', {'proc': options['proc']}],
+        # stage name, command, command options, and the stages that must be completed before the stage can start
+        stages = [
+            ['common', 'build_common', {}, []],
+            ['human_proteins', 'build_human_proteins', {}, ['common']],
+            ['blast_database_human', 'build_blast_database', {}, ['human_proteins']],
+            ['sequence_index_human', 'build_sequence_index', {}, ['blast_database_human']],
+            ['other_proteins', 'build_other_proteins', {'constructs_only': options['test'] ,'proc': options['proc']},
+                ['sequence_index_human']], # build only constructs in test mode
+            ['annotation', 'build_annotation', {'proc': options['proc']}, ['other_proteins']],
             # OLD['build_human_residues', {'proc': options['proc']}],
             # OLD['build_other_residues', {'proc': options['proc']}],
-            ['build_blast_database'],
-            ['build_links'],
-            ['build_construct_proteins'], #, {'proc': options['proc']}
-            ['build_structures', {'proc': options['proc']}],
-            ['build_construct_data'], #, {'proc': options['proc']}
-            ['build_mutant_data', {'proc': options['proc']}],
+            ['blast_database', 'build_blast_database', {}, ['other_proteins']],
+            ['sequence_index', 'build_sequence_index', {}, ['blast_database']],
+            ['links', 'build_links', {}, ['other_proteins']],
+            ['construct_proteins', 'build_construct_proteins', {}, ['annotation', 'sequence_index']], #, {'proc': options['proc']}
+            ['structures', 'build_structures', {'proc': options['proc']}, ['construct_proteins']],
+            ['construct_data', 'build_construct_data', {}, ['structures']], #, {'proc': options['proc']}
+            ['mutant_data', 'build_mutant_data', {'proc': options['proc']}, ['structures']],
             # OLD ['find_protein_templates', {'proc': options['proc']}],
             # OLD['update_alignments', {'proc': options['proc']}],
-            ['build_protein_sets'],
-            ['build_consensus_sequences', {'proc': options['proc']}],
-            ['build_g_proteins'],
-            ['build_drugs'],
-            ['build_residue_sets'],
-            ['build_text'],
-            ['build_release_notes'],
+            ['protein_sets', 'build_protein_sets', {}, ['structures']],
+            ['consensus_sequences', 'build_consensus_sequences', {'proc': options['proc']}, ['annotation']],
+            ['g_proteins', 'build_g_proteins', {}, ['consensus_sequences']],
+            ['drugs', 'build_drugs', {}, ['human_proteins']],
+            ['residue_sets', 'build_residue_sets', {}, ['structures']],
+            ['text', 'build_text', {}, []],
+            ['release_notes', 'build_release_notes', {}, ['construct_data', 'mutant_data', 'protein_sets',
+                'g_proteins', 'drugs', 'residue_sets', 'text', 'links']],
+            ['alignment_store', 'build_alignment_store', {'proc': options['proc'], 'purge': True}, ['release_notes']],
+            ['template_index', 'build_template_index', {'proc': options['proc'], 'purge': True}, ['release_notes']],
         ]
 
-        for c in commands:
-            print('{} Running {}'.format(
-                datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), c[0]))
-            if len(c) > 1:
-                call_command(c[0], **c[1])
-            else:
-                call_command(c[0])
+        state_dir = getattr(settings, 'BUILD_STATE_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'build_all']))
+        if not options['resume'] and os.path.isdir(state_dir):
+            shutil.rmtree(state_dir)
+        os.makedirs(state_dir, exist_ok=True)
+
+        completed = set([s[0] for s in stages if os.path.isfile(self.marker_path(state_dir, s[0]))])
+        for stage in stages:
+            if stage[0] in completed:
+                print('{} Skipping {} (completed by a previous run)'.format(self.now(), stage[0]))
+
+        self.run_stages(stages, completed, state_dir, max(1, options['jobs']))
+
+        print('{} Build completed'.format(self.now()))
+
+    def run_stages(self, stages, completed, state_dir, jobs):
+        """Run stages as soon as their dependencies are completed, with at most jobs stages at the same time. Stages
+            are started in the order they are listed, so with one job the build order is the listed order"""
+        pending = [s for s in stages if s[0] not in completed]
+        running = {}
+        failed = []
+        while pending or running:
+            # start ready stages (unless a stage has failed, in which case running stages are allowed to finish)
+            while not failed and len(running) < jobs:
+                ready = [s for s in pending if all(d in completed for d in s[3])]
+                if not ready:
+                    break
+                stage = ready[0]
+                pending.remove(stage)
+                print('{} Running {}'.format(self.now(), stage[1]))
+                connection.close()
+                p = Process(target=self.run_stage, args=([stage, state_dir]))
+                p.start()
+                running[stage[0]] = p
+
+            if not running:
+                if not failed:
+                    raise CommandError('Unresolvable stage dependencies: {}'.format(', '.join(
+                        [s[0] for s in pending])))
+                break
+
+            time.sleep(1)
+            for name, p in list(running.items()):
+                if p.is_alive():
+                    continue
+                p.join()
+                del running[name]
+                if p.exitcode == 0 and os.path.isfile(self.marker_path(state_dir, name)):
+                    completed.add(name)
+                    print('{} Completed {}'.format(self.now(), name))
+                else:
+                    failed.append(name)
+                    print('{} Failed {}'.format(self.now(), name))
+
+        if failed:
+            raise CommandError('Build stage(s) failed: {}. Run build_all with --resume to continue from the last '
+                'completed stages'.format(', '.join(failed)))
+
+    def run_stage(self, stage, state_dir):
+        """Run the command of a stage, and mark the stage as completed if it returns. Build commands signal failure by
+            raising an exception (prepare_input raises CommandError for unprocessed items), never only by logging it"""
+        name, command, command_options = stage[:3]
+        try:
+            call_command(command, **command_options)
+        except Exception:
+            traceback.print_exc()
+            self.logger.error('Build stage {} failed\n{}'.format(name, traceback.format_exc()))
+            sys.exit(1)
+        with open(self.marker_path(state_dir, name), 'w') as f:
+            f.write(self.now())
+
+    @staticmethod
+    def marker_path(state_dir, name):
+        return os.sep.join([state_dir, name + '.done'])
 
-        print('{} Build completed'.format(datetime.datetime.strftime(
-            datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
+    @staticmethod
+    def now():
+        return datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')
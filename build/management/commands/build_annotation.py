@@ -8,9 +8,11 @@ from django.db import transaction
 from build.management.commands.base_build import Command as BaseBuild
 from residue.models import Residue
 from residue.functions import *
+from residue.bulk_writer import ResidueWriter
 from protein.models import Protein, ProteinConformation, ProteinSegment, ProteinFamily
 
-from Bio import pairwise2
+from Bio import pairwise2, AlignIO
+from Bio.Align.Applications import ClustalOmegaCommandline
 from Bio.SubsMat import MatrixInfo as matlist
 
 import logging
@@ -89,8 +91,8 @@ class Command(BaseBuild):
 
             self.logger.info('COMPLETED CREATING RESIDUES')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
     def analyse_rf_annotations(self):
         ## THIS ONLY WORKS IF NOT RUNNING IN PARALLIZED
@@ -264,6 +266,8 @@ class Command(BaseBuild):
         # print(data)
         counter = 0
         lacking = []
+        # residues of this work unit are written together, in bulk
+        writer = ResidueWriter(logger=self.logger)
         # print('total',len(pconfs))
         for p in pconfs:
             entry_name = p.protein.entry_name
@@ -442,22 +446,18 @@ class Command(BaseBuild):
 
                 al.append(res)
 
-            bulked = Residue.objects.bulk_create(bulk)
-            rs = Residue.objects.filter(protein_conformation=pconf).order_by('sequence_number')
-
-            ThroughModel = Residue.alternative_generic_numbers.through
-            bulk = []
-            for i,res in enumerate(rs):
-                for alt in bulk_alt[i]:
-                    bulk.append(ThroughModel(residue_id=res.pk, residuegenericnumber_id=alt.pk))
-            ThroughModel.objects.bulk_create(bulk)
+            for res, alts in zip(bulk, bulk_alt):
+                writer.add(res, alts)
+            writer.checkpoint()
             end = time.time()
             diff = round(end - current,1)
-            self.logger.info('{} {} residues ({}) {}s alignemt {}'.format(p.protein.entry_name,len(rs),human_ortholog,diff,aligned_gn_mismatch_gap))
+            self.logger.info('{} {} residues ({}) {}s alignemt {}'.format(p.protein.entry_name,len(bulk),human_ortholog,diff,aligned_gn_mismatch_gap))
             if aligned_gn_mismatch_gap>20:
-                #print(p.protein.entry_name,len(rs),"residues","(",human_ortholog,")",diff,"s", " Unaligned generic numbers: ",aligned_gn_mismatch_gap)
-                self.logger.error('{} {} residues ({}) {}s MANY ERRORS IN ALIGNMENT {}'.format(p.protein.entry_name,len(rs),human_ortholog,diff,aligned_gn_mismatch_gap))
+                #print(p.protein.entry_name,len(bulk),"residues","(",human_ortholog,")",diff,"s", " Unaligned generic numbers: ",aligned_gn_mismatch_gap)
+                self.logger.error('{} {} residues ({}) {}s MANY ERRORS IN ALIGNMENT {}'.format(p.protein.entry_name,len(bulk),human_ortholog,diff,aligned_gn_mismatch_gap))
 
+        writer.flush()
+        writer.report()
         self.logger.info('COMPLETED ANNOTATIONS PROCESS {}'.format(positions))
 
     def compare_human_to_orthologue(self, human, ortholog, annotation,counter):
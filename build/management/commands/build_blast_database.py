@@ -42,6 +42,7 @@ class Command(BaseCommand):
             self.logger.info('Saving sequences into {}'.format(self.tmp_file_path))
         except Exception as e:
             self.logger.error('Saving the sequences failed')
+            raise CommandError('Saving the sequences failed: {}'.format(e))
         
         self.logger.info('Running makeblastdb')
         try:
@@ -49,10 +50,12 @@ class Command(BaseCommand):
             makeblastdb = Popen("makeblastdb -in {} -dbtype prot -title protwis_blastdb -out {} -parse_seqids".format(
                 self.tmp_file_path, self.db_file_path), universal_newlines=True, stdout=PIPE, shell=True, stderr=PIPE)
             out, err = makeblastdb.communicate()
-            if len(err) != 0:
-                self.logger.error(err)
         except Exception as e:
             self.logger.error('Makeblastdb failed')
+            raise CommandError('Makeblastdb failed: {}'.format(e))
+        if makeblastdb.returncode != 0 or len(err) != 0:
+            self.logger.error(err)
+            raise CommandError('Makeblastdb failed with exit code {}: {}'.format(makeblastdb.returncode, err))
 
         
         # remove tmp sequence file
@@ -80,6 +83,7 @@ class Command(BaseCommand):
             self.logger.info('Saving sequences into {}'.format(self.tmp_file_path))
         except Exception as e:
             self.logger.error('Saving the sequences failed')
+            raise CommandError('Saving the sequences failed: {}'.format(e))
         
         self.logger.info('Running makeblastdb')
         try:
@@ -87,10 +91,12 @@ class Command(BaseCommand):
             makeblastdb = Popen("makeblastdb -in {} -dbtype prot -title protwis_blastdb -out {} -parse_seqids".format(
                 self.tmp_file_path, self.human_db_file_path), universal_newlines=True, stdout=PIPE, shell=True, stderr=PIPE)
             out, err = makeblastdb.communicate()
-            if len(err) != 0:
-                self.logger.error(err)
         except Exception as e:
             self.logger.error('Makeblastdb failed')
+            raise CommandError('Makeblastdb failed: {}'.format(e))
+        if makeblastdb.returncode != 0 or len(err) != 0:
+            self.logger.error(err)
+            raise CommandError('Makeblastdb failed with exit code {}: {}'.format(makeblastdb.returncode, err))
 
         
         # remove tmp sequence file
@@ -35,8 +35,8 @@ class Command(BuildHumanProteins):
             self.prepare_input(options['proc'], self.families)
             self.logger.info('COMPLETED CREATING CONSENSUS SEQUENCES')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
     def purge_consensus_sequences(self):
         Protein.objects.filter(sequence_type__slug='consensus').delete()
@@ -59,8 +59,8 @@ class Command(BaseBuild):
             self.prepare_input(options['proc'], self.filenames)
             self.logger.info('COMPLETED CREATING CONSTRUCTS')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
     def purge_constructs(self):
         try:
@@ -5,7 +5,9 @@ from django.db import IntegrityError
 
 from build.management.commands.base_build import Command as BaseBuild
 from protein.models import Protein, ProteinConformation, ProteinSegment, ProteinFamily
+from residue.bulk_writer import ResidueWriter
 from residue.functions import *
+from residue.sequence_alignment import align_to_references
 
 import os
 import yaml
@@ -43,8 +45,8 @@ class Command(BaseBuild):
 
             self.logger.info('COMPLETED CREATING RESIDUES')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
     def main_func(self, positions, iteration):
         # pconfs
@@ -53,15 +55,20 @@ class Command(BaseBuild):
         else:
             pconfs = self.pconfs[positions[0]:positions[1]]
 
+        # residues of this work unit are written together, in bulk
+        writer = ResidueWriter(update=True, logger=self.logger)
+
+        # proteins without reference positions, which are aligned to a template together after the loop
+        unaligned = []
         for pconf in pconfs:
             # read reference positions for this protein
             ref_position_file_path = os.sep.join([self.ref_position_source_dir, pconf.protein.entry_name + '.yaml'])
             ref_positions = load_reference_positions(ref_position_file_path)
 
             # look for automatically generated ref positions if annotations are not found
+            auto_ref_position_file_path = os.sep.join([self.auto_ref_position_source_dir,
+                pconf.protein.entry_name + '.yaml'])
             if not ref_positions:
-                auto_ref_position_file_path = os.sep.join([self.auto_ref_position_source_dir,
-                    pconf.protein.entry_name + '.yaml'])
                 ref_positions = load_reference_positions(auto_ref_position_file_path)
 
             # if auto refs are not found, generate them
@@ -71,163 +78,178 @@ class Command(BaseBuild):
                 if iteration == 2:
                     self.logger.info("Reference positions for {} not annotated, looking for a template".format(
                         pconf.protein))
-
-                    # required information about this protein
-                    up = {}
-                    up['entry_name'] = pconf.protein.entry_name
-                    up['sequence'] = pconf.protein.sequence
-
-                    # find closest protein (by family) to get ref positions
-                    # - level 3 parent family
-                    # - - level2 parent family
-                    # - - - level1 parent family
-                    # - - - - current proteins family
-                    # - - - - - current protein
-                    template_found = False
-
-                    # try level1 families first, then level2, then level3
-                    parent_family_levels = [pconf.protein.family.parent, pconf.protein.family.parent.parent,
-                        pconf.protein.family.parent.parent.parent]
-                    for parent_family in parent_family_levels:
-                        if template_found:
-                            break
-
-                        # find sub families
-                        related_families = ProteinFamily.objects.filter(parent=parent_family)
-
-                        # loop through families and search for proteins to use as template
-                        for family in related_families:
-                            if template_found:
-                                break
-                            proteins = Protein.objects.filter(family=family)
-                            if not proteins:
-                                proteins = Protein.objects.filter(family__parent=family)
-                                if not proteins:
-                                    proteins = Protein.objects.filter(family__parent__parent=family)
-                            for p in proteins:
-                                tpl_ref_position_file_path = os.sep.join([self.ref_position_source_dir,
-                                    p.entry_name + '.yaml'])
-                                tpl_ref_positions = load_reference_positions(tpl_ref_position_file_path)
-                                if tpl_ref_positions:
-                                    self.logger.info("Found template {}".format(p))
-                                    ref_positions = align_protein_to_reference(up, tpl_ref_position_file_path, p)
-                                    # write reference positions to a file
-                                    with open(auto_ref_position_file_path, "w") as auto_ref_position_file:
-                                        yaml.dump(ref_positions, auto_ref_position_file, default_flow_style=False)
-                                    template_found = True
-                                    break
+                    template = self.find_template(pconf)
+                    if template:
+                        unaligned.append((pconf, auto_ref_position_file_path) + template)
                     else:
-                        if not template_found:
-                            self.logger.error('No template reference positions found for {}'.format(pconf.protein))
-                else:
-                    continue
+                        self.logger.error('No template reference positions found for {}'.format(pconf.protein))
+                continue
             elif iteration == 2:
                 # proteins with ref positions have already been processed in the first iteration
                 continue
 
-            # remote empty ref positions
-            ref_positions_copy = copy.deepcopy(ref_positions)
-            for position, position_value in ref_positions_copy.items():
-                if position_value == '-':
-                    del ref_positions[position]
-
-            # determine segment ranges, and create residues
-            nseg = self.segments.count()
-            sequence_number_counter = 0
-            for i, segment in enumerate(self.segments):
-                # should this segment be aligned? This value is updated below
-                unaligned_segment = True
-
-                # next segment (for checking start positions)
-                if (i+1) < nseg:
-                    next_segment = self.segments[i+1]
-                else:
-                    next_segment = False
-
-                # is this an alignable segment?
-                if segment.slug in settings.REFERENCE_POSITIONS:
-                    # is there a reference position available?
-                    if ref_positions and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions:
-                        # mark segment as aligned
-                        unaligned_segment = False
-
-                        segment_start = (ref_positions[settings.REFERENCE_POSITIONS[segment.slug]]
-                            - self.segment_length[segment.slug]['before'])
-                        aligned_segment_start = segment_start
-                        segment_end = (ref_positions[settings.REFERENCE_POSITIONS[segment.slug]]
-                            + self.segment_length[segment.slug]['after'])
-                        aligned_segment_end = segment_end
-
-                        # is this segment is not fully aligned, find the start and stop (not just the aligned start
-                        # and stop)
-                        if not segment.fully_aligned:
-                            segment_start = sequence_number_counter + 1
-                            if next_segment:
-                                next_segment_start = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
-                                - self.segment_length[next_segment.slug]['before'])
-                                segment_end = next_segment_start - 1
+            self.create_residues(pconf, ref_positions, writer)
+
+        if not unaligned:
+            writer.flush()
+            writer.report()
+            return
 
-                                if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
-                                    settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
-                                    next_segment_start = (
-                                        ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
-                                        - self.segment_length[next_segment.slug]['before'])
-                                    segment_end = next_segment_start - 1
-                                else:
-                                    self.logger.warning('A non-fully aligned segment {} is followed a unaligned' \
-                                        + 'segment {}. Skipping.'.format(segment.slug, next_segment.slug))
-                                    continue
+        # align the proteins to their templates (in memory, so that workers do not share any files)
+        aligned = align_to_references([(u[0].protein.entry_name, u[0].protein.sequence, u[2].sequence, u[3])
+            for u in unaligned])
+        for pconf, auto_ref_position_file_path, template, tpl_ref_positions in unaligned:
+            ref_positions = aligned[pconf.protein.entry_name]
+            if ref_positions is False:
+                continue
+            self.logger.info("{} aligned to {}".format(pconf.protein.entry_name, template.entry_name))
+
+            # write reference positions to a file
+            with open(auto_ref_position_file_path, "w") as auto_ref_position_file:
+                yaml.dump(ref_positions, auto_ref_position_file, default_flow_style=False)
+
+            self.create_residues(pconf, ref_positions, writer)
+
+        writer.flush()
+        writer.report()
+
+    def find_template(self, pconf):
+        """Find the closest protein (by family) with annotated reference positions. Returns the template and its
+            reference positions, or None"""
+        # - level 3 parent family
+        # - - level2 parent family
+        # - - - level1 parent family
+        # - - - - current proteins family
+        # - - - - - current protein
+
+        # try level1 families first, then level2, then level3
+        parent_family_levels = [pconf.protein.family.parent, pconf.protein.family.parent.parent,
+            pconf.protein.family.parent.parent.parent]
+        for parent_family in parent_family_levels:
+            # find sub families
+            related_families = ProteinFamily.objects.filter(parent=parent_family)
+
+            # loop through families and search for proteins to use as template
+            for family in related_families:
+                proteins = Protein.objects.filter(family=family)
+                if not proteins:
+                    proteins = Protein.objects.filter(family__parent=family)
+                    if not proteins:
+                        proteins = Protein.objects.filter(family__parent__parent=family)
+                for p in proteins:
+                    tpl_ref_position_file_path = os.sep.join([self.ref_position_source_dir, p.entry_name + '.yaml'])
+                    tpl_ref_positions = load_reference_positions(tpl_ref_position_file_path)
+                    if tpl_ref_positions:
+                        self.logger.info("Found template {}".format(p))
+                        return (p, tpl_ref_positions)
+        return None
+
+    def create_residues(self, pconf, ref_positions, writer):
+        # remote empty ref positions
+        ref_positions_copy = copy.deepcopy(ref_positions)
+        for position, position_value in ref_positions_copy.items():
+            if position_value == '-':
+                del ref_positions[position]
+
+        # determine segment ranges, and create residues
+        nseg = self.segments.count()
+        sequence_number_counter = 0
+        for i, segment in enumerate(self.segments):
+            # should this segment be aligned? This value is updated below
+            unaligned_segment = True
+
+            # next segment (for checking start positions)
+            if (i+1) < nseg:
+                next_segment = self.segments[i+1]
+            else:
+                next_segment = False
+
+            # is this an alignable segment?
+            if segment.slug in settings.REFERENCE_POSITIONS:
+                # is there a reference position available?
+                if ref_positions and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions:
+                    # mark segment as aligned
+                    unaligned_segment = False
+
+                    segment_start = (ref_positions[settings.REFERENCE_POSITIONS[segment.slug]]
+                        - self.segment_length[segment.slug]['before'])
+                    aligned_segment_start = segment_start
+                    segment_end = (ref_positions[settings.REFERENCE_POSITIONS[segment.slug]]
+                        + self.segment_length[segment.slug]['after'])
+                    aligned_segment_end = segment_end
+
+                    # is this segment is not fully aligned, find the start and stop (not just the aligned start
+                    # and stop)
+                    if not segment.fully_aligned:
+                        segment_start = sequence_number_counter + 1
+                        if next_segment:
+                            next_segment_start = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
+                            - self.segment_length[next_segment.slug]['before'])
+                            segment_end = next_segment_start - 1
+
+                            if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
+                                settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
+                                next_segment_start = (
+                                    ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
+                                    - self.segment_length[next_segment.slug]['before'])
+                                segment_end = next_segment_start - 1
                             else:
-                                segment_end = len(pconf.protein.sequence)
-
-                            if next_segment:
-                                if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
-                                    settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
-                                    segment_end = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
-                                    - self.segment_length[next_segment.slug]['before'] - 1)
-                                    next_ref_found = True
-                                else:
-                                    continue
+                                self.logger.warning('A non-fully aligned segment {} is followed a unaligned' \
+                                    + 'segment {}. Skipping.'.format(segment.slug, next_segment.slug))
+                                continue
+                        else:
+                            segment_end = len(pconf.protein.sequence)
+
+                        if next_segment:
+                            if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
+                                settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
+                                segment_end = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
+                                - self.segment_length[next_segment.slug]['before'] - 1)
+                                next_ref_found = True
                             else:
-                                # for the last segment, the end is the last residue of the sequence
-                                segment_end = len(pconf.protein.sequence)
+                                continue
+                        else:
+                            # for the last segment, the end is the last residue of the sequence
+                            segment_end = len(pconf.protein.sequence)
 
+                else:
+                    if segment.fully_aligned:
+                        # stop processing this segment
+                        self.logger.error('Reference position missing for fully aligned segment {} in {},' \
+                            + ' skipping'.format(segment, pconf))
+                        continue
                     else:
-                        if segment.fully_aligned:
-                            # stop processing this segment
-                            self.logger.error('Reference position missing for fully aligned segment {} in {},' \
-                                + ' skipping'.format(segment, pconf))
-                            continue
-                        else:
-                            # log the missing reference position
-                            self.logger.warning('Reference position missing for segment {} in {}'.format(segment,
-                                pconf))
-
-                if unaligned_segment:
-                    segment_start = sequence_number_counter + 1
-
-                    # if this is not the last segment, find next segments reference position
-                    if next_segment:
-                        if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
-                            settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
-                            segment_end = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
-                            - self.segment_length[next_segment.slug]['before'] - 1)
-                        else:
-                            continue
+                        # log the missing reference position
+                        self.logger.warning('Reference position missing for segment {} in {}'.format(segment,
+                            pconf))
+
+            if unaligned_segment:
+                segment_start = sequence_number_counter + 1
+
+                # if this is not the last segment, find next segments reference position
+                if next_segment:
+                    if (next_segment.slug in settings.REFERENCE_POSITIONS and ref_positions and
+                        settings.REFERENCE_POSITIONS[next_segment.slug] in ref_positions):
+                        segment_end = (ref_positions[settings.REFERENCE_POSITIONS[next_segment.slug]]
+                        - self.segment_length[next_segment.slug]['before'] - 1)
                     else:
-                        # for the last segment, the end is the last residue of the sequence
-                        segment_end = len(pconf.protein.sequence)
+                        continue
+                else:
+                    # for the last segment, the end is the last residue of the sequence
+                    segment_end = len(pconf.protein.sequence)
 
-                    aligned_segment_start = None
-                    aligned_segment_end = None
+                aligned_segment_start = None
+                aligned_segment_end = None
+
+            # skip if the segment ends before it starts (can happen if the next segment is long)
+            if segment_start > segment_end:
+                self.logger.warning('Start of segment {} is larger than its end'.format(segment))
+                continue
 
-                # skip if the segment ends before it starts (can happen if the next segment is long)
-                if segment_start > segment_end:
-                    self.logger.warning('Start of segment {} is larger than its end'.format(segment))
-                    continue
+            # create residues for this segment
+            create_or_update_residues_in_segment(pconf, segment, segment_start, aligned_segment_start,
+                segment_end, aligned_segment_end, self.schemes, ref_positions, [], True, writer)
 
-                # create residues for this segment
-                create_or_update_residues_in_segment(pconf, segment, segment_start, aligned_segment_start,
-                    segment_end, aligned_segment_end, self.schemes, ref_positions, [], True)
+            sequence_number_counter = segment_end
 
-                sequence_number_counter = segment_end
+        writer.checkpoint()
@@ -27,7 +27,6 @@ from urllib.request import urlopen, quote
 import math
 import xlrd
 import operator
-import traceback
 import time
 
 ## FOR VIGNIR ORDERED DICT YAML IMPORT/DUMP
@@ -93,9 +92,8 @@ class Command(BaseBuild):
             self.logger.info('COMPLETED CREATING MUTANTS')
 
         except Exception as msg:
-            print(msg)
-            traceback.print_exc()
             self.logger.error(msg)
+            raise
 
     def purge_mutants(self):
         Mutation.objects.all().delete()
@@ -64,48 +64,48 @@ class Command(BuildHumanProteins):
 
 
         # self.create_orthologs(constructs_only)
-        filenames = os.listdir(self.local_uniprot_dir)
-        self.prepare_input(options['proc'], filenames)
+        self.filenames = os.listdir(self.local_uniprot_dir)
+        self.prepare_input(options['proc'], self.filenames)
 
 
     def purge_orthologs(self):
         Protein.objects.filter(~Q(species__common_name="Human")).delete()
 
+    def setup_worker(self, iteration):
+        # go through constructs and finding their entry_names for lookup
+        self.construct_entry_names = []
+        self.logger.info('Getting construct accession codes')
+        filenames = os.listdir(self.construct_data_dir)
+        for source_file in filenames:
+            source_file_path = os.sep.join([self.construct_data_dir, source_file])
+            self.logger.info('Getting protein name from construct file {}'.format(source_file))
+            split_filename = source_file.split(".")
+            extension = split_filename[1]
+            if extension != 'yaml':
+                continue
+
+            # read the yaml file
+            with open(source_file_path, 'r') as f:
+                sd = yaml.load(f)
+
+            # check whether protein is specified
+            if 'protein' not in sd:
+                continue
+
+            # append entry_name to lookup list
+            self.construct_entry_names.append(sd['protein'])
+
     def main_func(self, positions, iteration):
         self.logger.info('CREATING OTHER PROTEINS')
         try:
-            # go through constructs and finding their entry_names for lookup
-            construct_entry_names = []
-            self.logger.info('Getting construct accession codes')
-            filenames = os.listdir(self.construct_data_dir)
-            for source_file in filenames:
-                source_file_path = os.sep.join([self.construct_data_dir, source_file])
-                self.logger.info('Getting protein name from construct file {}'.format(source_file))
-                split_filename = source_file.split(".")
-                extension = split_filename[1]
-                if extension != 'yaml':
-                    continue
-
-                # read the yaml file
-                with open(source_file_path, 'r') as f:
-                    sd = yaml.load(f)
-
-                # check whether protein is specified
-                if 'protein' not in sd:
-                    continue
-
-                # append entry_name to lookup list
-                construct_entry_names.append(sd['protein'])
+            construct_entry_names = self.construct_entry_names
 
             # parse files
-            filenames = os.listdir(self.local_uniprot_dir)
-            for i,source_file in enumerate(filenames):
-                if i<positions[0]: #continue if less than start
-                    continue
-                if positions[1]: #if end is non-false
-                    if i>=positions[1]:
-                        #continue if i less than process
-                        continue
+            if not positions[1]:
+                filenames = self.filenames[positions[0]:]
+            else:
+                filenames = self.filenames[positions[0]:positions[1]]
+            for source_file in filenames:
                 source_file_name = os.sep.join([self.local_uniprot_dir, source_file])
                 split_filename = source_file.split(".")
                 accession = split_filename[0]
@@ -227,6 +227,6 @@ class Command(BuildHumanProteins):
 
             self.logger.info('COMPLETED CREATING OTHER PROTEINS')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
             PrintException()
+            raise
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from build.management.commands.build_blast_database import Command as BuildBlastDatabase
+from protein.models import Protein
+from structure.functions import SequenceIndex
+
+import logging
+
+
+class Command(BaseCommand):
+    help = 'Generates minimizer indices of the sequences in the blast databases. The indices are used to identify ' \
+        + 'proteins of (nearly) identical sequences without running blast.'
+
+    logger = logging.getLogger(__name__)
+
+    databases = [
+        (BuildBlastDatabase.db_file_path, {'sequence_type__slug': 'wt'}),
+        (BuildBlastDatabase.human_db_file_path, {'sequence_type__slug': 'wt', 'species__common_name': 'Human'}),
+    ]
+
+    def handle(self, *args, **options):
+        for db_file_path, protein_filter in self.databases:
+            self.logger.info('BUILDING SEQUENCE INDEX FOR {}'.format(db_file_path))
+            try:
+                proteins = Protein.objects.filter(**protein_filter).only('id', 'sequence')
+                index = SequenceIndex.build(proteins)
+                index.save(SequenceIndex.path(db_file_path))
+                self.logger.info('Indexed {} sequences with {} minimizers'.format(len(index.protein_ids),
+                    len(index.minimizers)))
+            except Exception as msg:
+                self.logger.error(msg)
+                raise
+            self.logger.info('COMPLETED BUILDING SEQUENCE INDEX FOR {}'.format(db_file_path))
@@ -8,6 +8,7 @@ from build.management.commands.base_build import Command as BaseBuild
 from protein.models import (Protein, ProteinConformation, ProteinState, ProteinAnomaly, ProteinAnomalyType,
     ProteinSegment)
 from residue.models import ResidueGenericNumber, ResidueNumberingScheme, Residue
+from residue.bulk_writer import ResidueWriter
 from common.models import WebLink, WebResource, Publication
 from structure.models import (Structure, StructureType, StructureSegment, StructureStabilizingAgent,PdbData,
     Rotamer, StructureSegmentModeling, StructureCoordinates, StructureCoordinatesDescription, StructureEngineering,
@@ -115,8 +116,8 @@ class Command(BaseBuild):
 
             self.logger.info('COMPLETED CREATING STRUCTURES')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
     def purge_structures(self):
         Structure.objects.all().delete()
@@ -611,16 +612,14 @@ class Command(BaseBuild):
                                 #print('inserted',residue.sequence_number) #sanity check
                                 # residue.save()
                                 residues_bulk.append(residue)
-                                rotamer_data, created = PdbData.objects.get_or_create(pdb=temp)
-                                #rotamer_data_bulk.append(PdbData(pdb=temp))
                                 missing_atoms = False
-                                if rotamer_data.startswith('COMPND'):
-                                    lines = len(rotamer_data.split('\n'))-2
+                                if temp.startswith('COMPND'):
+                                    lines = len(temp.split('\n'))-2
                                 else:
-                                    lines = len(rotamer_data.split('\n'))
+                                    lines = len(temp.split('\n'))
                                 if lines<atom_num_dict[residue.amino_acid]:
                                     missing_atoms = True
-                                rotamer_data_bulk.append([rotamer_data, missing_atoms])
+                                rotamer_data_bulk.append([temp, missing_atoms])
                                 # rotamer, created = Rotamer.objects.get_or_create(residue=residue, structure=structure, pdbdata=rotamer_data)
                                 #rotamer_bulk.append(Rotamer(residue=residue, structure=structure, pdbdata=rotamer_data))
 
@@ -705,14 +704,18 @@ class Command(BaseBuild):
                         prev_display = None
                     prev_segment = res.protein_segment
 
-        bulked_res = Residue.objects.bulk_create(residues_bulk)
-        #bulked_rot = PdbData.objects.bulk_create(rotamer_data_bulk)
-        bulked_rot = rotamer_data_bulk
+        writer = ResidueWriter(logger=self.logger)
+        for res in residues_bulk:
+            writer.add(res)
+        writer.flush()
+        bulked_res = residues_bulk
+        # resolve all rotamer PDB files with one lookup and one insert
+        bulked_rot = PdbData.objects.get_or_create_many([r[0] for r in rotamer_data_bulk])
 
         rotamer_bulk = []
         for i,res in enumerate(bulked_res):
-            rotamer_bulk.append(Rotamer(residue=res, structure=structure, pdbdata=bulked_rot[i][0], 
-                                        missing_atoms=bulked_rot[i][1]))
+            rotamer_bulk.append(Rotamer(residue=res, structure=structure, pdbdata=bulked_rot[i], 
+                                        missing_atoms=rotamer_data_bulk[i][1]))
 
         Rotamer.objects.bulk_create(rotamer_bulk)
         #
@@ -817,7 +820,7 @@ class Command(BaseBuild):
                         with open(pdb_path, 'r') as pdb_file:
                             pdbdata_raw = pdb_file.read()
 
-                    pdbdata, created = PdbData.objects.get_or_create(pdb=pdbdata_raw)
+                    pdbdata, created = PdbData.objects.get_or_create_pdb(pdbdata_raw)
                     s.pdb_data = pdbdata
 
                     # UPDATE HETSYN with its PDB reference instead + GRAB PUB DATE, PMID, DOI AND RESOLUTION
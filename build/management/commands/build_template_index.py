@@ -0,0 +1,75 @@
+from build.management.commands.base_build import Command as BaseBuild
+from protein.models import Protein
+from common.alignment import AlignedReferenceTemplate
+from common.template_index import TemplateIndex
+
+import shutil
+import os
+
+
+class Command(BaseBuild):
+    help = 'Ranks the template structures of all receptors for homology modeling, for the current data release, and ' \
+        + 'stores them in the template index'
+
+    # index entries are replaced atomically, so failed receptors can be run again
+    retries = 1
+
+    # query states and segments of the template searches of the homology model build
+    query_state_sets = [
+        ['Inactive', 'Active'],
+    ]
+    segment_sets = [
+        ['TM1', 'ICL1', 'TM2', 'ECL1', 'TM3', 'ICL2', 'TM4', 'ECL2', 'TM5', 'TM6', 'TM7', 'H8'],
+    ]
+
+    receptors = Protein.objects.filter(parent__isnull=True, accession__isnull=False, species__common_name='Human',
+        family__slug__startswith='00').order_by('entry_name')
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Delete template indexes of previous data releases')
+
+    def handle(self, *args, **options):
+        self.index = TemplateIndex()
+        if options['purge']:
+            self.purge_old_releases()
+        self.logger.info('BUILDING TEMPLATE INDEX IN {}'.format(self.index.release_dir()))
+        self.prepare_input(options['proc'], self.receptors)
+        self.logger.info('COMPLETED BUILDING TEMPLATE INDEX')
+
+    def purge_old_releases(self):
+        release_dir = self.index.release_dir()
+        if not os.path.isdir(self.index.location):
+            return
+        for d in os.listdir(self.index.location):
+            path = os.sep.join([self.index.location, d])
+            if path != release_dir and os.path.isdir(path):
+                shutil.rmtree(path)
+                self.logger.info('Deleted template index {}'.format(path))
+
+    def main_func(self, positions, iteration):
+        # receptors
+        if not positions[1]:
+            receptors = self.receptors[positions[0]:]
+        else:
+            receptors = self.receptors[positions[0]:positions[1]]
+
+        for receptor in receptors:
+            entry = {}
+            for query_states in self.query_state_sets:
+                for segments in self.segment_sets:
+                    try:
+                        templates = AlignedReferenceTemplate().rank_templates(receptor.entry_name, segments,
+                            query_states)
+                    except Exception as msg:
+                        self.logger.warning('Failed ranking templates of {} ({}): {}'.format(receptor.entry_name,
+                            ', '.join(query_states), msg))
+                        continue
+                    entry[TemplateIndex.key(query_states, segments)] = templates
+            if entry:
+                self.index.save(receptor.entry_name, entry)
+                self.logger.info('Indexed templates of {}'.format(receptor.entry_name))
@@ -6,8 +6,10 @@ from build.management.commands.base_build import Command as BaseBuild
 from protein.models import ProteinConformation, ProteinSegment, ProteinAnomaly, ProteinConformationTemplateStructure
 from structure.models import StructureSegment
 from residue.models import Residue
+from residue.bulk_writer import ResidueWriter
 from residue.functions import *
 from common.alignment import Alignment
+from common.alignment_store import AlignmentStore
 
 import os
 from collections import OrderedDict
@@ -40,39 +42,53 @@ class Command(BaseBuild):
     def handle(self, *args, **options):
         try:
             self.logger.info('UPDATING PROTEIN ALIGNMENTS')
+
+            # residues are updated in place, which does not change the state of the residue table that the alignment
+            # store is versioned by
+            AlignmentStore().clear()
+
             self.prepare_input(options['proc'], self.pconfs)
             self.logger.info('COMPLETED UPDATING PROTEIN ALIGNMENTS')
         except Exception as msg:
-            print(msg)
             self.logger.error(msg)
+            raise
 
-    def main_func(self, positions, iteration):
-        # pconfs
-        if not positions[1]:
-            pconfs = self.pconfs[positions[0]:]
-        else:
-            pconfs = self.pconfs[positions[0]:positions[1]]
-
-        schemes = parse_scheme_tables(self.generic_numbers_source_dir)
+    def setup_worker(self, iteration):
+        self.schemes = parse_scheme_tables(self.generic_numbers_source_dir)
 
         # pre-fetch protein anomalies and associated rules
-        anomaly_rule_sets = {}
-        anomalies = {}
+        self.anomaly_rule_sets = {}
+        self.anomalies = {}
         pas = ProteinAnomaly.objects.all().prefetch_related(
             'rulesets__protein_anomaly__generic_number__protein_segment', 'rulesets__rules')
         for pa in pas:
             segment = pa.generic_number.protein_segment
-            if segment.slug not in anomaly_rule_sets:
-                anomaly_rule_sets[segment.slug] = {}
+            if segment.slug not in self.anomaly_rule_sets:
+                self.anomaly_rule_sets[segment.slug] = {}
             anomaly_label = pa.generic_number.label
-            anomalies[anomaly_label] = pa
-            if anomaly_label not in anomaly_rule_sets[segment.slug]:
-                anomaly_rule_sets[segment.slug][anomaly_label] = []
+            self.anomalies[anomaly_label] = pa
+            if anomaly_label not in self.anomaly_rule_sets[segment.slug]:
+                self.anomaly_rule_sets[segment.slug][anomaly_label] = []
             for pars in pa.rulesets.all():
-                anomaly_rule_sets[segment.slug][anomaly_label].append(pars)
+                self.anomaly_rule_sets[segment.slug][anomaly_label].append(pars)
 
-        # pre-fetch protein conformations
-        segments = ProteinSegment.objects.filter(partial=False)
+        # pre-fetch protein segments
+        self.segments = list(ProteinSegment.objects.filter(partial=False))
+
+    def main_func(self, positions, iteration):
+        # pconfs
+        if not positions[1]:
+            pconfs = self.pconfs[positions[0]:]
+        else:
+            pconfs = self.pconfs[positions[0]:positions[1]]
+
+        schemes = self.schemes
+        anomaly_rule_sets = self.anomaly_rule_sets
+        anomalies = self.anomalies
+        segments = self.segments
+
+        # residues of this work unit are written together, in bulk
+        writer = ResidueWriter(update=True, logger=self.logger)
 
         for pconf in pconfs:
             # skip protein conformations without a template (consensus sequences)
@@ -426,4 +442,8 @@ class Command(BaseBuild):
             for us in update_segments:
                 if 'start' in us and 'end' in us and us['end']:
                     create_or_update_residues_in_segment(pconf, us['segment'], us['start'], us['aligned_start'],
-                        us['end'], us['aligned_end'], schemes, ref_positions, us['protein_anomalies'], False)
+                        us['end'], us['aligned_end'], schemes, ref_positions, us['protein_anomalies'], False, writer)
+            writer.checkpoint()
+
+        writer.flush()
+        writer.report()
@@ -1,4 +1,5 @@
 from build.management.commands.base_build import Command as BaseBuild
+from django.conf import settings
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState
 from residue.models import Residue
@@ -6,6 +7,7 @@ from residue.functions import dgn, ggn
 from structure.models import *
 from structure.functions import HSExposureCB
 from common.alignment import AlignedReferenceTemplate
+from common.template_index import TemplateIndex
 import structure.structural_superposition as sp
 import structure.assign_generic_numbers_gpcr as as_gn
 import structure.homology_models_tests as tests
@@ -16,6 +18,9 @@ from modeller.automodel import *
 from collections import OrderedDict
 import os
 import logging
+import tempfile
+import time
+from multiprocessing import Pool, TimeoutError
 import pprint
 from io import StringIO
 import sys
@@ -38,6 +43,9 @@ logger.setLevel(logging.INFO)
 
 class Command(BaseBuild):  
     help = 'Build automated chimeric GPCR homology models'    
+
+    # each receptor is a long running job, so workers take one receptor at a time
+    batch_size = 1
     
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser=parser)
@@ -49,6 +57,13 @@ class Command(BaseBuild):
                             action='store_true')
         parser.add_argument('--hmver', help='Homology modeling version', default=1.0, type=float)
         parser.add_argument('-s', help='Set activation state for model', default='inactive')
+        parser.add_argument('--models', help='Number of models built by MODELLER for each receptor, the model with the '
+                            'best DOPE score is kept', default=1, type=int)
+        parser.add_argument('--modeller-proc', help='Number of MODELLER processes for each receptor (models are split '
+                            'between them)', default=1, type=int, dest='modeller_proc')
+        parser.add_argument('--modeller-timeout', help='Time limit (in seconds) of each MODELLER process',
+                            default=getattr(settings, 'HOMOLOGY_MODELING_TIMEOUT', 7200), type=int,
+                            dest='modeller_timeout')
         
     def handle(self, *args, **options):
         if not os.path.exists('./structure/homology_models/'):
@@ -67,6 +82,10 @@ class Command(BaseBuild):
             state = 'Inactive'
         elif options['s']=='active':
             state = 'Active'
+        self.state = state
+        self.number_of_models = options['models']
+        self.modeller_processes = options['modeller_proc']
+        self.modeller_timeout = options['modeller_timeout']
         if options['r']==False:
             structures = Structure.objects.all()
             struct_parent = [i.protein_conformation.protein.parent for i in structures]
@@ -74,25 +93,18 @@ class Command(BaseBuild):
                                             family__slug__istartswith='001')
             self.receptor_list = [i.entry_name for i in classA if i not in struct_parent]
             print(self.receptor_list)
-            try:
-                self.prepare_input(options['proc'], self.receptor_list)
-            except Exception as msg:
-                print(msg)
+            self.prepare_input(options['proc'], self.receptor_list)
         elif len(options['r'])>1:
             self.receptor_list = options['r']
-            try:
-                self.prepare_input(options['proc'], self.receptor_list)
-            except Exception as msg:
-                print(msg)
+            self.prepare_input(options['proc'], self.receptor_list)
         else:
             self.run_HomologyModeling(options['r'][0], state)
         
-        os.chdir('./structure/')
         if options['z']==True:
-            zipf = zipfile.ZipFile('../static/homology_models/homology_models_v{}.zip'.format(str(self.version)),'w',zipfile.ZIP_DEFLATED)
-            for root, dirs, files in os.walk('homology_models'):
+            zipf = zipfile.ZipFile('./static/homology_models/homology_models_v{}.zip'.format(str(self.version)),'w',zipfile.ZIP_DEFLATED)
+            for root, dirs, files in os.walk('./structure/homology_models'):
                 for f in files:
-                    zipf.write(os.path.join(root, f))
+                    zipf.write(os.path.join(root, f), os.path.relpath(os.path.join(root, f), './structure'))
             zipf.close()
 #        shutil.rmtree('homology_models')
 #        shutil.rmtree('PIR')
@@ -104,11 +116,14 @@ class Command(BaseBuild):
             receptor_list = self.receptor_list[positions[0]:positions[1]]
         
         for receptor in receptor_list:
-            self.run_HomologyModeling(receptor, state)
+            self.run_HomologyModeling(receptor, self.state)
     
     def run_HomologyModeling(self, receptor, state):
         try:
-            Homology_model = HomologyModeling(receptor, state, [state,"Active"], update=self.update, version=self.version)
+            Homology_model = HomologyModeling(receptor, state, [state,"Active"], update=self.update, version=self.version,
+                                              number_of_models=self.number_of_models,
+                                              modeller_processes=self.modeller_processes,
+                                              modeller_timeout=self.modeller_timeout)
             alignment = Homology_model.run_alignment()
             Homology_model.build_homology_model(alignment)
             if self.update==False:
@@ -139,15 +154,22 @@ class HomologyModeling(object):
         @param query_states: list, list of endogenous ligand states to be applied for template search, 
         @param update: boolean, upload the StructureModel table, default=False
         @param version: float, version number of homology modeling pipeline, default=1.0
+        @param number_of_models: int, number of models built by MODELLER, default=1
+        @param modeller_processes: int, number of MODELLER processes, default=1
+        @param modeller_timeout: int, time limit (in seconds) of each MODELLER process, default=None
     '''
     segment_coding = {1:'TM1',2:'TM2',3:'TM3',4:'TM4',5:'TM5',6:'TM6',7:'TM7',8:'H8', 12:'ICL1', 23:'ECL1', 34:'ICL2', 
                       45:'ECL2'}
-    def __init__(self, reference_entry_name, state, query_states, update=False, version=1.0):
+    def __init__(self, reference_entry_name, state, query_states, update=False, version=1.0, number_of_models=1,
+                 modeller_processes=1, modeller_timeout=None):
         self.reference_entry_name = reference_entry_name.lower()
         self.state = state
         self.query_states = query_states
         self.update = update
         self.version = version
+        self.number_of_models = number_of_models
+        self.modeller_processes = modeller_processes
+        self.modeller_timeout = modeller_timeout
         self.statistics = CreateStatistics(self.reference_entry_name)
         self.reference_protein = Protein.objects.get(entry_name=self.reference_entry_name)        
         self.reference_class = self.reference_protein.family.parent.parent.parent
@@ -343,6 +365,20 @@ class HomologyModeling(object):
                 except:
                     pass
         
+    def load_similarity_table(self, segments, query_states):
+        ''' Returns the similarity table of all templates of the reference from the template index (see
+            build_template_index), or aligns the reference to all templates if it is not in the index.
+        '''
+        similarity_table = None
+        if not self.revise_xtal:
+            similarity_table = TemplateIndex().similarity_table(self.reference_entry_name, query_states, segments)
+        if similarity_table==None:
+            logger.info('Templates of {} not found in template index'.format(self.reference_entry_name))
+            alignment = AlignedReferenceTemplate()
+            alignment.run_hommod_alignment(self.reference_protein, segments, query_states, 'similarity')
+            similarity_table = alignment.similarity_table
+        return similarity_table
+
     def run_alignment(self, core_alignment=True, query_states=self.query_states, 
                       segments=['TM1','ICL1','TM2','ECL1','TM3','ICL2','TM4','ECL2','TM5','TM6','TM7','H8'], 
                       order_by='similarity'):
@@ -365,8 +401,11 @@ class HomologyModeling(object):
             self.segments = segments
             self.main_structure = alignment.main_template_structure           
             self.similarity_table = alignment.similarity_table
-            self.similarity_table_all = self.run_alignment(core_alignment=False, 
-                                                           query_states=['Inactive','Active'])[0].similarity_table
+            # the templates of all states are those of the core alignment when it was searched with all states
+            if set(query_states)==set(['Inactive','Active']) and order_by=='similarity':
+                self.similarity_table_all = OrderedDict(self.similarity_table)
+            else:
+                self.similarity_table_all = self.load_similarity_table(segments, ['Inactive','Active'])
             self.main_template_preferred_chain = str(self.main_structure.preferred_chain)[0]
             self.statistics.add_info("main_template", self.main_structure)
             self.statistics.add_info("preferred_chain", self.main_template_preferred_chain)
@@ -1290,7 +1329,7 @@ class HomologyModeling(object):
         self.main_pdb_array = main_pdb_array
         
         self.run_MODELLER("./structure/PIR/"+self.uniprot_id+"_"+self.state+".pir", path+self.reference_entry_name+'_'+self.state+"_post.pdb", 
-                          self.uniprot_id, 1, "{}_{}_{}_{}.pdb".format(self.class_name, self.reference_entry_name,self.state,self.main_structure), 
+                          self.uniprot_id, self.number_of_models, "{}_{}_{}_{}.pdb".format(self.class_name, self.reference_entry_name,self.state,self.main_structure), 
                           atom_dict=trimmed_res_nums, helix_restraints=helix_restraints, icl3_mid=icl3_mid)
 
 #        os.remove(path+self.reference_entry_name+'_'+self.state+"_post.pdb")
@@ -1678,7 +1717,9 @@ sequence:{uniprot}::::::::
             
     def run_MODELLER(self, pir_file, template, reference, number_of_models, output_file_name, atom_dict=None, 
                      helix_restraints=[], icl3_mid=None):
-        ''' Build homology model with MODELLER.
+        ''' Build homology model with MODELLER. Models are built in a scratch directory by modeller_processes worker
+            processes (see build_models), so that MODELLER output of different models never mixes, and the model with
+            the best DOPE score is moved to the homology_models directory.
         
             @param pir_file: str, file name of PIR file with path \n
             @param template: str, file name of template with path \n
@@ -1691,54 +1732,92 @@ sequence:{uniprot}::::::::
             MODELLER, default=[]
             @param icl3_mid: int, position of the break in the middle of ICL3, default=None
         '''
-        log.none()
-        env = environ(rand_seed=1000) #!!random number generator
         if self.revise_xtal==True:
             ref_prot = self.reference_protein.parent
         else:
             ref_prot = self.reference_protein
-        if ref_prot==self.main_structure.protein_conformation.protein.parent:
-            env.io.hetatm = True
-            env.io.water = True
-        if atom_dict==None:
-            a = automodel(env, alnfile = pir_file, knowns = template, sequence = reference, 
-                          assess_methods=(assess.DOPE))
-        else:
-            a = HomologyMODELLER(env, alnfile = pir_file, knowns = template, sequence = reference, 
-                                 assess_methods=(assess.DOPE), atom_selection=atom_dict, 
-                                 helix_restraints=helix_restraints, icl3_mid=icl3_mid)
-        
-        a.starting_model = 1
-        a.ending_model = number_of_models
-        a.md_level = refine.slow
         path = "./structure/homology_models/"
         if not os.path.exists(path):
             os.mkdir(path)
-        a.make()
-        
-        # Get a list of all successfully built models from a.outputs
-        ok_models = [x for x in a.outputs if x['failure'] is None]
-        if len(ok_models)==0:
-            os.rename("./"+template, "./structure/homology_models/"+output_file_name)
-            return 0
 
-        # Rank the models by DOPE score
-        key = 'DOPE score'
-        if sys.version_info[:2] == (2,3):
-            # Python 2.3's sort doesn't have a 'key' argument
-            ok_models.sort(lambda a,b: cmp(a[key], b[key]))
-        else:
-            ok_models.sort(key=lambda a: a[key])
-        
-        # Get top model
-        m = ok_models[0]
-#        print("Top model: %s (DOPE score %.3f)" % (m['name'], m[key]))        
+        scratch_dir = tempfile.mkdtemp(prefix='{}_{}_'.format(self.reference_entry_name, self.state),
+                                       dir=getattr(settings, 'HOMOLOGY_MODELING_SCRATCH_DIR', None))
+        try:
+            # models are split into consecutive ranges, one for each process
+            processes = max(1, min(self.modeller_processes, number_of_models))
+            jobs, first = [], 1
+            for i in range(processes):
+                last = first - 1 + (number_of_models - first + 1) // (processes - i)
+                job_dir = os.path.join(scratch_dir, str(i))
+                os.mkdir(job_dir)
+                jobs.append({'directory':job_dir, 'atom_files_directory':os.getcwd(),
+                             'alnfile':os.path.abspath(pir_file), 'knowns':template, 'sequence':reference,
+                             'models':(first, last), 'hetatm':ref_prot==self.main_structure.protein_conformation.protein.parent,
+                             'atom_dict':atom_dict, 'helix_restraints':helix_restraints, 'icl3_mid':icl3_mid})
+                first = last + 1
+
+            ok_models = []
+            pool = Pool(len(jobs))
+            try:
+                results = [pool.apply_async(build_models, (job,)) for job in jobs]
+                start = time.time()
+                for job, result in zip(jobs, results):
+                    timeout = None
+                    if self.modeller_timeout:
+                        timeout = max(0, start + self.modeller_timeout - time.time())
+                    try:
+                        ok_models+=result.get(timeout)
+                    except TimeoutError:
+                        logger.error('MODELLER did not finish models {}-{} of {} within {} seconds'.format(
+                                     job['models'][0], job['models'][1], self.reference_entry_name,
+                                     self.modeller_timeout))
+                    except Exception as msg:
+                        logger.error('MODELLER failed for models {}-{} of {}: {}'.format(job['models'][0],
+                                     job['models'][1], self.reference_entry_name, msg))
+            finally:
+                pool.terminate()
+                pool.join()
 
-        for file in os.listdir("./"):
-            if file==m['name']:
-                os.rename("./"+file, "./structure/homology_models/"+output_file_name)
-            elif file.startswith(self.uniprot_id):
-                os.remove("./"+file)
+            if len(ok_models)==0:
+                os.rename("./"+template, path+output_file_name)
+                return 0
+
+            # Rank the models by DOPE score, the top model replaces the output file in one step
+            ok_models.sort(key=lambda m: m[1])
+            fd, tmp_path = tempfile.mkstemp(dir=path)
+            os.close(fd)
+            shutil.copyfile(ok_models[0][0], tmp_path)
+            os.replace(tmp_path, path+output_file_name)
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def build_models(job):
+    ''' Builds a range of models with MODELLER in a worker process, in the job directory (MODELLER writes its output
+        to the working directory). Returns a list of (file name, DOPE score) tuples of the successfully built models.
+
+        @param job: dict, MODELLER input of HomologyModeling.run_MODELLER
+    '''
+    os.chdir(job['directory'])
+    log.none()
+    # each range of models has its own seed, the first range uses the seed of a single MODELLER run
+    env = environ(rand_seed=1000+job['models'][0]-1) #!!random number generator
+    env.io.atom_files_directory = [job['atom_files_directory']]
+    if job['hetatm']:
+        env.io.hetatm = True
+        env.io.water = True
+    if job['atom_dict']==None:
+        a = automodel(env, alnfile = job['alnfile'], knowns = job['knowns'], sequence = job['sequence'], 
+                      assess_methods=(assess.DOPE))
+    else:
+        a = HomologyMODELLER(env, alnfile = job['alnfile'], knowns = job['knowns'], sequence = job['sequence'], 
+                             assess_methods=(assess.DOPE), atom_selection=job['atom_dict'], 
+                             helix_restraints=job['helix_restraints'], icl3_mid=job['icl3_mid'])
+    a.starting_model = job['models'][0]
+    a.ending_model = job['models'][1]
+    a.md_level = refine.slow
+    a.make()
+    return [(os.path.join(job['directory'], x['name']), x['DOPE score']) for x in a.outputs if x['failure'] is None]
 
 
 class SilentModeller(object):
@@ -3234,8 +3313,7 @@ class GPCRDBParsingPDB(object):
                         break
             else:
                 rotamer = rotamer[0]
-            io = StringIO(rotamer.pdbdata.pdb)
-            rota_struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
+            rota_struct = rotamer.pdbdata.get_structure()[0]
             for chain in rota_struct:
                 for residue in chain:
                     for atom in residue:
@@ -3272,12 +3350,11 @@ class GPCRDBParsingPDB(object):
             @param filename: str, filename of pdb to be parsed. When using filename, leave structure=None).
         '''
         if structure!=None and filename==None:
-            io = StringIO(structure.pdb_data.pdb)
+            pdb_struct = structure.pdb_data.get_structure()[0]
         else:
-            io = filename
+            pdb_struct = PDB.PDBParser(QUIET=True).get_structure('structure', filename)[0]
         gn_array = []
         residue_array = []
-        pdb_struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
         
         residues = Residue.objects.filter(protein_conformation=structure.protein_conformation)
         gn_list = []
@@ -0,0 +1,5 @@
+from build.management.commands.build_sequence_index import Command as BuildSequenceIndex
+
+
+class Command(BuildSequenceIndex):
+    pass
\ No newline at end of file
@@ -0,0 +1,5 @@
+from build.management.commands.build_template_index import Command as BuildTemplateIndex
+
+
+class Command(BuildTemplateIndex):
+    pass
\ No newline at end of file
@@ -2,6 +2,8 @@ from django.conf import settings
 
 from common.selection import Selection
 from common.definitions import *
+from common.alignment_matrix import AlignmentMatrix
+from common.alignment_store import AlignmentStore
 from protein.models import Protein, ProteinConformation, ProteinState, ProteinSegment, ProteinFusionProtein, ProteinFamily
 from residue.models import Residue
 from residue.models import ResidueGenericNumber, ResidueGenericNumberEquivalent
@@ -41,6 +43,13 @@ class Alignment:
         self.states = [settings.DEFAULT_PROTEIN_STATE] # inactive, active etc
         self.use_residue_groups = False
         self.ignore_alternative_residue_numbering_schemes = False # set to true if no numbering is to be displayed
+
+        # array-backed alignment used for statistics (see common.alignment_matrix), set to False to use the dict loops
+        self.use_matrix_engine = True
+        self.alignment_matrix = None
+
+        # serve precomputed alignments from the alignment store (see build_alignment_store) when the selection matches
+        self.use_alignment_store = True
         
         # refers to which ProteinConformation attribute to order by (identity, similarity or similarity score)
         self.order_by = 'similarity'
@@ -223,6 +232,9 @@ class Alignment:
 
     def build_alignment(self):
         """Fetch selected residues from DB and build an alignment"""
+        if self.use_alignment_store and AlignmentStore().load(self):
+            return
+
         # fetch segment residues
         if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
             rs = Residue.objects.filter(
@@ -566,8 +578,16 @@ class Alignment:
         """A placeholder for an instance specific function"""
         return generic_number
 
+    def build_alignment_matrix(self):
+        """Encode the rows of the alignment as an integer matrix (proteins x aligned positions)"""
+        self.alignment_matrix = AlignmentMatrix.from_proteins(self.proteins)
+        return self.alignment_matrix
+
     def calculate_statistics(self):
         """Calculate consesus sequence and amino acid and feature frequency"""
+        if self.use_matrix_engine:
+            return self.calculate_matrix_statistics()
+
         feature_count = OrderedDict()
         most_freq_aa = OrderedDict()
         amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
@@ -705,6 +725,82 @@ class Alignment:
                     k += 1
                 j += 1
 
+    def calculate_matrix_statistics(self):
+        """Calculate consesus sequence and amino acid and feature frequency from the alignment matrix. The results are
+            identical to the ones of the dict based calculation, but the counting is done with array operations"""
+        m = self.build_alignment_matrix()
+        self.amino_acids = AMINO_ACIDS.keys()
+        self.features = AMINO_ACID_GROUP_NAMES.values()
+        amino_acid_letters = list(AMINO_ACIDS)
+        num_proteins = len(self.proteins)
+
+        aa_counts = m.amino_acid_counts()
+        feature_counts = m.feature_counts(aa_counts)
+
+        # collect the non-empty positions of each segment, in the order they are first encountered
+        column_order = m.column_order()
+        segment_columns = OrderedDict([(segment, []) for segment in m.segments])
+        for c in column_order:
+            segment, generic_number = m.columns[c]
+            segment_columns[segment].append((generic_number, c))
+            if generic_number in self.generic_number_objs and generic_number not in self.aa_count_with_protein:
+                self.aa_count_with_protein[generic_number] = {amino_acid_letters[code]: entry_names
+                    for code, entry_names in m.entry_names_by_amino_acid(c).items()}
+
+        most_freq_aa = OrderedDict()
+        for segment, columns in segment_columns.items():
+            self.aa_count[segment] = OrderedDict()
+            most_freq_aa[segment] = OrderedDict()
+            for generic_number, c in columns:
+                self.aa_count[segment][generic_number] = OrderedDict(zip(amino_acid_letters, aa_counts[:, c].tolist()))
+                codes, count = m.most_frequent(c, aa_counts)
+                most_freq_aa[segment][generic_number] = [[amino_acid_letters[code] for code in codes], count]
+
+        # merge the amino acid counts into a consensus sequence
+        sequence_counter = 1
+        for i, s in most_freq_aa.items():
+            self.consensus[i] = OrderedDict()
+            self.forced_consensus[i] = OrderedDict()
+            for p in sorted(s):
+                r = s[p]
+                conservation = str(round(r[1]/num_proteins*100))
+                if len(conservation) == 1:
+                    cons_interval = '0'
+                else:
+                    # the intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors.
+                    cons_interval = conservation[:-1]
+
+                # forced consensus sequence uses the first residue to break ties
+                self.forced_consensus[i][p] = r[0][0]
+
+                # consensus sequence displays + in tie situations
+                if len(r[0]) == 1:
+                    self.consensus[i][p] = [r[0][0], cons_interval, r[0][0] + ' ' + conservation + '%']
+                else:
+                    self.consensus[i][p] = ['+', cons_interval, '/'.join(r[0]) + ' ' + conservation + '%']
+
+                # create a residue object full consensus
+                res = Residue()
+                res.sequence_number = sequence_counter
+                if p in self.generic_number_objs:
+                    res.display_generic_number = self.generic_number_objs[p]
+                res.family_generic_number = p
+                res.segment_slug = i
+                res.amino_acid = r[0][0]
+                res.frequency = self.consensus[i][p][2]
+                self.full_consensus.append(res)
+
+                # update sequence counter
+                sequence_counter += 1
+
+        # process amino acid and feature frequency, the intervals are defined in the same way as for the consensus
+        # sequence
+        sorted_columns = [[c for gn, c in sorted(columns)] for columns in segment_columns.values()]
+        for counts, stats in ((aa_counts, self.amino_acid_stats), (feature_counts, self.feature_stats)):
+            for frequency_row in m.frequencies(counts, num_proteins).tolist():
+                stats.append([[[str(frequency_row[c]), str(frequency_row[c] // 10)] for c in columns]
+                    for columns in sorted_columns])
+
     def calculate_aa_count_per_generic_number(self):
         ''' Small function to return a dictionary of display_generic_number and the frequency of each AA '''
         generic_lookup_aa_freq = {}
@@ -722,13 +818,19 @@ class Alignment:
 
     def calculate_similarity(self):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        if self.use_matrix_engine:
+            m = self.build_alignment_matrix()
+            values = m.compare_rows(0, list(range(1, len(self.proteins))))
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
                 continue
 
             # calculate identity, similarity and similarity score to the reference
-            calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
+            if self.use_matrix_engine:
+                calc_values = self.format_similarity(*[v[i-1] for v in values])
+            else:
+                calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
             
             # update the protein
             if calc_values:
@@ -746,13 +848,21 @@ class Alignment:
     def calculate_similarity_matrix(self):
         """Calculate a matrix of sequence identity/similarity for every selected protein"""
         self.similarity_matrix = OrderedDict()
+        if self.use_matrix_engine:
+            # all pairs are calculated in one pass over the alignment matrix
+            values = [v.tolist() for v in self.build_alignment_matrix().pairwise_similarity()]
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': []}
             for k, protein in enumerate(self.proteins):
                 # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                if k == i:
+                    calc_values = None
+                elif self.use_matrix_engine:
+                    calc_values = self.format_similarity(*[v[i][k] for v in values])
+                else:
+                    calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
                 if k == i:
                     value = '-'
                 elif k < i:
@@ -852,6 +962,15 @@ class Alignment:
         else:
             return False
 
+    def format_similarity(self, length, identities, similarities, similarity_score):
+        """Format the identity, similarity and similarity score counted in the alignment matrix in the same way as
+            pairwise_similarity"""
+        if not length:
+            return False
+        identity = "{:10.0f}".format(int(identities) / int(length) * 100)
+        similarity = "{:10.0f}".format(int(similarities) / int(length) * 100)
+        return identity, similarity, int(similarity_score)
+
     def score_match(self, pair, matrix):
         if pair not in matrix:
             return matrix[(tuple(reversed(pair)))]
@@ -889,16 +1008,7 @@ class AlignedReferenceTemplate(Alignment):
             self.revise_xtal = None
         self.provide_alignment = provide_alignment
         if provide_main_template_structure==None and provide_similarity_table==None:
-            self.query_states = query_states
-            self.order_by = order_by
-            self.load_reference_protein(self.reference_protein)
-            self.load_proteins_by_structure()
-            self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
-            self.build_alignment()
-            self.calculate_similarity()
-            self.reference_protein = self.proteins[0]
-            self.main_template_protein = None
-            self.ordered_proteins = []
+            self.align_templates(segments, query_states, order_by)
         if provide_main_template_structure==None:
             self.main_template_structure = None
             self.provide_main_template_structure = False
@@ -920,19 +1030,54 @@ class AlignedReferenceTemplate(Alignment):
         if self.main_template_structure==None:
             self.main_template_structure = self.get_main_template()
             
+    def align_templates(self, segments, query_states, order_by):
+        ''' Aligns the reference protein to the proteins of all template structures and calculates their similarity.
+        '''
+        self.query_states = query_states
+        self.order_by = order_by
+        self.load_reference_protein(self.reference_protein)
+        self.load_proteins_by_structure()
+        self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
+        self.build_alignment()
+        self.calculate_similarity()
+        self.reference_protein = self.proteins[0]
+        self.main_template_protein = None
+        self.ordered_proteins = []
+
+    def rank_templates(self, reference_protein, segments, query_states, order_by='similarity'):
+        ''' Ranks the template structures of a reference protein as run_hommod_alignment does, without selecting the
+            main template (see TemplateIndex). Returns a dict with the ids of the candidate template structures
+            ('structures') and the ranked templates ('ranked'), a list of (structure id, similarity, identity,
+            resolution) tuples.
+
+            @param reference_protein: str, entry name of reference protein.
+        '''
+        self.logger = logging.getLogger('homology_modeling')
+        self.segment_labels = segments
+        self.reference_protein = Protein.objects.get(entry_name=reference_protein)
+        self.revise_xtal = None
+        self.provide_alignment = None
+        self.align_templates(segments, query_states, order_by)
+        self.similarity_table = self.create_helix_similarity_table()
+        return {'structures': sorted([st.id for st in self.structures_data]),
+                'ranked': [(st.id, similarity, int(protein.identity), float(st.resolution)) for (st, similarity), protein
+                           in zip(self.similarity_table.items(), self.ordered_proteins[1:])]}
+
     def __repr__(self):
         return '<AlignedReferenceTemplate: Ref: {} ; Temp: {}>'.format(self.reference_protein.protein.entry_name, 
                                                                        self.main_template_structure)
 
-    def load_proteins_by_structure(self):
-        ''' Loads proteins into alignment based on available structures in the database.
+    @staticmethod
+    def template_structures(reference_protein, query_states):
+        ''' Returns the candidate template structures of a reference protein (Protein object), ordered by protein and
+            resolution.
         '''
-        if self.reference_protein.family.parent.parent.parent.slug=='003':
+        if reference_protein.family.parent.parent.parent.slug=='003':
             template_family = ProteinFamily.objects.get(slug='002')
         else:
-            template_family = self.reference_protein.family.parent.parent.parent
-        self.structures_data = Structure.objects.filter(
-            state__name__in=self.query_states, protein_conformation__protein__parent__family__parent__parent__parent=
+            template_family = reference_protein.family.parent.parent.parent
+        return Structure.objects.filter(
+            state__name__in=query_states, protein_conformation__protein__parent__family__parent__parent__parent=
             template_family).order_by('protein_conformation__protein__parent',
             'resolution').filter(pdb_code__index__in=["4IAQ","4IAR","4IB4","4NC3","2YDO","2YDV","3QAK","3REY","3RFM",
                                                       "3UZA","3UZC","4EIY","4UHR","5G53","3VG9","5CXV","3UON","4MQS",
@@ -946,7 +1091,11 @@ class AlignedReferenceTemplate(Alignment):
                                                       "3NYA","3PDS","4ZUD","4RWD",
                                                       "4XT1","4K5Y","4Z9G","4L6R","5EE7","4OR2","4OO9","5CGC","5CGD",
                                                       "4JKV","4N4W","4O9R","4QIM","4QIN"])
-       
+
+    def load_proteins_by_structure(self):
+        ''' Loads proteins into alignment based on available structures in the database.
+        '''
+        self.structures_data = self.template_structures(self.reference_protein, self.query_states)
         self.load_proteins(
             [Protein.objects.get(id=target.protein_conformation.protein.parent.id) for target in self.structures_data])
   
@@ -974,9 +1123,13 @@ class AlignedReferenceTemplate(Alignment):
         temp_list = []
         self.ordered_proteins = [self.proteins[0]]
         similarity_table = OrderedDict()
+        # structures of each template protein, read in one query (in the order of structures_data)
+        structures = OrderedDict()
+        for m in self.structures_data.select_related('pdb_code', 'protein_conformation__protein__parent'):
+            structures.setdefault(m.protein_conformation.protein.parent_id, []).append(m)
         for protein in self.proteins:
             try:
-                matches = self.structures_data.filter(protein_conformation__protein__parent=protein.protein)
+                matches = structures.get(protein.protein.id, [])
                 for m in matches:
                     if m.protein_conformation.protein.parent==self.reference_protein.protein and int(protein.similarity)==0:
                         continue
@@ -0,0 +1,172 @@
+from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS
+
+from collections import OrderedDict
+from Bio.SubsMat import MatrixInfo
+
+import numpy as np
+
+
+# integer codes used in the alignment matrix. Amino acids are numbered in the order of AMINO_ACIDS, followed by the
+# gap symbol and the padding (end gap) symbol
+AMINO_ACID_CODES = OrderedDict([(aa, i) for i, aa in enumerate(AMINO_ACIDS)])
+GAP_CODE = len(AMINO_ACID_CODES)
+PADDING_CODE = GAP_CODE + 1
+INVALID_CODE = 255
+
+# translation table from (ASCII) residue symbols to codes
+CODE_LOOKUP = np.full(256, INVALID_CODE, dtype=np.uint8)
+for aa, code in AMINO_ACID_CODES.items():
+    CODE_LOOKUP[ord(aa)] = code
+CODE_LOOKUP[ord('-')] = GAP_CODE
+CODE_LOOKUP[ord('_')] = PADDING_CODE
+
+# membership matrix of amino acid groups (features x amino acids)
+FEATURE_MEMBERSHIP = np.array([[aa in members for aa in AMINO_ACID_CODES] for members in AMINO_ACID_GROUPS.values()],
+    dtype=np.int64)
+
+
+
+def substitution_lookup(matrix):
+    """Convert a Bio.SubsMat substitution matrix (a dict of residue pairs, listed in one orientation only) into a
+        symmetric lookup array indexed by residue code. Gap codes are collapsed to GAP_CODE, which scores 0"""
+    lookup = np.zeros((GAP_CODE + 1, GAP_CODE + 1), dtype=np.int32)
+    for (aa1, aa2), score in matrix.items():
+        if aa1 in AMINO_ACID_CODES and aa2 in AMINO_ACID_CODES:
+            lookup[AMINO_ACID_CODES[aa1], AMINO_ACID_CODES[aa2]] = score
+            lookup[AMINO_ACID_CODES[aa2], AMINO_ACID_CODES[aa1]] = score
+    return lookup
+
+BLOSUM62_LOOKUP = substitution_lookup(MatrixInfo.blosum62)
+
+
+class AlignmentMatrix:
+    """An array-backed representation of an alignment. Each row is a protein (conformation) and each column an
+        aligned position. Residues are stored as uint8 codes (see AMINO_ACID_CODES, GAP_CODE and PADDING_CODE)"""
+    def __init__(self, codes, columns, segments, entry_names):
+        self.codes = codes
+        self.columns = columns # list of (segment slug, position label) tuples, one per column
+        self.segments = segments # segment slugs in alignment order, including segments without columns
+        self.entry_names = entry_names
+
+    def __str__(self):
+        return '<AlignmentMatrix: {} proteins x {} columns>'.format(*self.codes.shape)
+
+    @classmethod
+    def from_proteins(cls, proteins):
+        """Encode the alignment rows of a list of ProteinConformation objects (as built by Alignment.build_alignment)"""
+        columns = []
+        segments = []
+        if proteins:
+            for segment, positions in proteins[0].alignment.items():
+                segments.append(segment)
+                for position in positions:
+                    columns.append((segment, position[0]))
+
+        symbols = np.empty((len(proteins), len(columns)), dtype=np.uint8)
+        for i, pc in enumerate(proteins):
+            row = ''.join([p[2] for s in pc.alignment.values() for p in s]).encode('ascii')
+            if len(row) != len(columns):
+                raise ValueError('Alignment row of {} has {} positions, expected {}'.format(pc.protein.entry_name,
+                    len(row), len(columns)))
+            symbols[i] = np.frombuffer(row, dtype=np.uint8)
+
+        codes = CODE_LOOKUP[symbols]
+        invalid = codes == INVALID_CODE
+        if invalid.any():
+            raise KeyError('Unknown residue symbol(s) in alignment: {}'.format(
+                ', '.join(sorted(set(chr(c) for c in symbols[invalid])))))
+
+        entry_names = np.array([pc.protein.entry_name for pc in proteins], dtype=object)
+        return cls(codes, columns, segments, entry_names)
+
+    @property
+    def residue_mask(self):
+        """Boolean matrix that is True where a column contains a residue (not a gap)"""
+        return self.codes < GAP_CODE
+
+    def amino_acid_counts(self):
+        """Number of occurences of each amino acid in each column (amino acids x columns)"""
+        num_codes = len(AMINO_ACID_CODES)
+        num_columns = self.codes.shape[1]
+        flat_index = self.codes.astype(np.int64) * num_columns + np.arange(num_columns)
+        counts = np.bincount(flat_index.ravel(), minlength=(num_codes + 2) * num_columns)
+        return counts.reshape(num_codes + 2, num_columns)[:num_codes]
+
+    def feature_counts(self, amino_acid_counts=None):
+        """Number of residues of each amino acid group (AMINO_ACID_GROUPS) in each column (features x columns)"""
+        if amino_acid_counts is None:
+            amino_acid_counts = self.amino_acid_counts()
+        return FEATURE_MEMBERSHIP.dot(amino_acid_counts)
+
+    def first_residue_rows(self):
+        """Index of the first row that contains a residue in each column (-1 for columns with only gaps)"""
+        mask = self.residue_mask
+        if not mask.shape[0]:
+            return np.full(mask.shape[1], -1, dtype=np.int64)
+        first = mask.argmax(axis=0)
+        first[~mask.any(axis=0)] = -1
+        return first
+
+    def column_order(self):
+        """Indices of the non-empty columns, in the order they are first encountered when the alignment is read row by
+            row (protein by protein)"""
+        first = self.first_residue_rows()
+        present = np.flatnonzero(first >= 0)
+        return present[np.argsort(first[present], kind='stable')]
+
+    def most_frequent(self, column, amino_acid_counts):
+        """Most frequent amino acid code(s) in a column, and their count. Ties are ordered by the row in which each
+            amino acid reached the maximum count"""
+        counts = amino_acid_counts[:, column]
+        max_count = counts.max()
+        tied = np.flatnonzero(counts == max_count)
+        if len(tied) > 1:
+            column_codes = self.codes[:, column]
+            tied = sorted(tied, key=lambda code: np.flatnonzero(column_codes == code)[max_count - 1])
+        return [int(code) for code in tied], int(max_count)
+
+    def entry_names_by_amino_acid(self, column):
+        """Entry names of the proteins with each amino acid in a column. Amino acids and entry names are ordered by
+            first occurence"""
+        column_codes = self.codes[:, column]
+        rows = np.flatnonzero(column_codes < GAP_CODE)
+        row_codes = column_codes[rows]
+        codes, first_index = np.unique(row_codes, return_index=True)
+        entry_names = OrderedDict()
+        for code in codes[np.argsort(first_index)]:
+            names = self.entry_names[rows[row_codes == code]]
+            entry_names[int(code)] = list(OrderedDict.fromkeys(names))
+        return entry_names
+
+    @staticmethod
+    def frequencies(counts, num_proteins):
+        """Round frequencies (in percent) of an array of counts, in the same way as the built-in round()"""
+        return np.rint(counts / num_proteins * 100).astype(np.int64)
+
+    def compare_rows(self, row, other_rows, lookup=BLOSUM62_LOOKUP):
+        """Compare one row of the matrix with a set of other rows. Returns arrays with the number of compared positions
+            (positions that are not gapped in both rows), identical positions, similar positions (positive substitution
+            score) and the summed substitution score for each of the other rows"""
+        codes = np.minimum(self.codes[row], GAP_CODE)
+        other_codes = np.minimum(self.codes[other_rows], GAP_CODE)
+        residues = codes < GAP_CODE
+        other_residues = other_codes < GAP_CODE
+
+        scores = lookup[codes, other_codes] # gapped positions score 0
+        both_residues = residues & other_residues
+        lengths = (residues | other_residues).sum(axis=1)
+        identities = ((codes == other_codes) & both_residues).sum(axis=1)
+        similarities = (scores > 0).sum(axis=1)
+        return lengths, identities, similarities, scores.sum(axis=1)
+
+    def pairwise_similarity(self, lookup=BLOSUM62_LOOKUP):
+        """Calculate the number of compared, identical and similar positions and the substitution score for every pair
+            of rows. Each unordered pair is compared once, and the results are returned as symmetric matrices"""
+        num_rows = self.codes.shape[0]
+        results = [np.zeros((num_rows, num_rows), dtype=np.int64) for i in range(4)]
+        for i in range(num_rows):
+            others = np.arange(i, num_rows)
+            for result, values in zip(results, self.compare_rows(i, others, lookup)):
+                result[i, i:] = values
+                result[i:, i] = values
+        return results
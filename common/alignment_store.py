@@ -0,0 +1,147 @@
+from django.conf import settings
+from django.db.models import Count, Max
+
+from common.tools import release_stamp
+from residue.models import Residue, ResidueGenericNumber
+
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import zlib
+
+
+class AlignmentStore:
+    """An on-disk store of precomputed alignments (see build_alignment_store). Alignments are keyed by the alignment
+        class, the set of protein conformations, the ordered list of segments and the numbering schemes, and are stored
+        in one directory per data release and state of the residue table, so that a new release or a rebuild of the
+        residues invalidates all stored alignments. Commands that update residues in place clear the store"""
+
+    logger = logging.getLogger('protwis')
+
+    # the release directory of each process, which is checked at most once per ALIGNMENT_STORE_TIMEOUT seconds
+    _shared = {'release_dir': None, 'checked': 0}
+
+    def __init__(self, location=None, release=None):
+        if location is None:
+            location = getattr(settings, 'ALIGNMENT_STORE_DIR', os.sep.join([settings.BUILD_CACHE_DIR,
+                'alignment_store']))
+        self.location = location
+        self.release = release
+
+    @staticmethod
+    def signature():
+        """A summary of the residue table, used to detect that stored alignments are out of date (e.g. after the
+            residues have been rebuilt without new release notes)"""
+        residues = Residue.objects.aggregate(Count('id'), Max('id'))
+        return (residues['id__count'], residues['id__max'])
+
+    def release_dir(self):
+        if self.release is not None:
+            return os.sep.join([self.location, self.release])
+
+        timeout = getattr(settings, 'ALIGNMENT_STORE_TIMEOUT', 60)
+        shared = self._shared
+        now = time.time()
+        if shared['release_dir'] is None or now - shared['checked'] > timeout:
+            release = '_'.join([release_stamp()] + [str(s) for s in self.signature()])
+            shared['release_dir'] = release
+            shared['checked'] = now
+        return os.sep.join([self.location, shared['release_dir']])
+
+    def clear(self):
+        """Deletes all stored alignments"""
+        if os.path.isdir(self.location):
+            shutil.rmtree(self.location)
+            self.logger.info('Deleted alignment store {}'.format(self.location))
+
+    def key(self, alignment):
+        """Returns the store key of an alignment that has proteins and segments loaded, or False if the alignment can
+            not be served from the store (e.g. individually selected residue positions)"""
+        if not alignment.proteins or not alignment.segments:
+            return False
+        if alignment.use_residue_groups or alignment.custom_segment_label in alignment.segments:
+            return False
+
+        # alternative numbering schemes are only included when they are displayed
+        if not alignment.ignore_alternative_residue_numbering_schemes and len(alignment.numbering_schemes) > 1:
+            numbering_schemes = tuple(ns[0] for ns in alignment.numbering_schemes)
+        else:
+            numbering_schemes = ()
+
+        # alignment classes format generic numbers differently (see merge_generic_numbers)
+        key = (
+            '{}.{}'.format(type(alignment).__module__, type(alignment).__name__),
+            tuple(sorted(set(pc.id for pc in alignment.proteins))),
+            tuple(alignment.segments.keys()),
+            numbering_schemes,
+        )
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.sep.join([self.release_dir(), key[:2], key + '.pickle.zlib'])
+
+    def load(self, alignment):
+        """Populates an alignment from the store. Returns True if the alignment was found, otherwise False"""
+        key = self.key(alignment)
+        if not key:
+            return False
+
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return False
+        except Exception as msg:
+            self.logger.warning('Failed reading alignment {} from store: {}'.format(key, msg))
+            return False
+
+        # all conformations must be present (a stale entry could in theory share a key)
+        rows = data['rows']
+        if any(pc.id not in rows for pc in alignment.proteins):
+            return False
+
+        # stored rows use padding symbols for end gaps, which are converted if padding is not shown
+        for pc in alignment.proteins:
+            pc.alignment = rows[pc.id]
+            if not alignment.show_padding:
+                for s in pc.alignment.values():
+                    for p in s:
+                        if p[2] == '_':
+                            p[2] = '-'
+            pc.alignment_list = list(pc.alignment.values())
+
+        alignment.segments = data['segments']
+        alignment.generic_numbers = data['generic_numbers']
+        alignment.positions = data['positions']
+        alignment.number_of_residues_total = data['number_of_residues_total']
+
+        generic_number_objs = ResidueGenericNumber.objects.select_related('scheme').in_bulk(
+            list(data['generic_number_objs'].values()))
+        alignment.generic_number_objs = OrderedDict([(pos, generic_number_objs[gn_id])
+            for pos, gn_id in data['generic_number_objs'].items()])
+        return True
+
+    def save(self, alignment, key):
+        """Writes a built alignment to the store. The key must be calculated before the alignment is built, as building
+            it removes split segments from the segment list"""
+        data = {
+            'rows': {pc.id: pc.alignment for pc in alignment.proteins},
+            'segments': alignment.segments,
+            'generic_numbers': alignment.generic_numbers,
+            'generic_number_objs': OrderedDict([(pos, gn.id) for pos, gn in alignment.generic_number_objs.items()]),
+            'positions': alignment.positions,
+            'number_of_residues_total': alignment.number_of_residues_total,
+        }
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first, so that readers never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
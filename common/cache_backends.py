@@ -0,0 +1,179 @@
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+
+class ShardedSQLiteCache(BaseCache):
+    """A local cache backend that stores entries in a set of SQLite databases (shards) in the LOCATION directory. It
+        needs no external service and is safe to use from several WSGI worker processes, as SQLite handles locking
+
+        Each shard keeps a running total of the size of its entries, and when the total exceeds its share of
+        MAX_BYTES, expired entries and then the least recently used entries are evicted. Values larger than
+        COMPRESS_MIN_BYTES are compressed. Options (in OPTIONS, all optional):
+            SHARDS: number of database files (default 8)
+            MAX_BYTES: size budget of the whole cache (default 1 GB)
+            COMPRESS_MIN_BYTES: smallest value (after pickling) to compress (default 16 kB)
+            ACCESS_RESOLUTION: the access time used for LRU eviction is updated at most once per this many seconds
+                (default 60), so that reads rarely write to the database"""
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, compressed INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, expires REAL, accessed REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+        'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)',
+        'CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), total_size INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO meta (id, total_size) VALUES (0, 0)',
+        # the total size is kept up to date by triggers, so that it never has to be summed
+        'CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN '
+            'UPDATE meta SET total_size = total_size + NEW.size WHERE id = 0; END',
+        'CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN '
+            'UPDATE meta SET total_size = total_size - OLD.size WHERE id = 0; END',
+        'CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF size ON cache BEGIN '
+            'UPDATE meta SET total_size = total_size - OLD.size + NEW.size WHERE id = 0; END',
+    ]
+
+    def __init__(self, location, params):
+        super(ShardedSQLiteCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._location = os.path.abspath(location)
+        self._shards = int(options.get('SHARDS', 8))
+        self._max_bytes = int(options.get('MAX_BYTES', 1024**3))
+        self._compress_min_bytes = int(options.get('COMPRESS_MIN_BYTES', 16*1024))
+        self._access_resolution = float(options.get('ACCESS_RESOLUTION', 60))
+        self._connections = {}
+        self._pid = None
+
+    def shard_path(self, shard):
+        return os.sep.join([self._location, 'shard-{}.sqlite'.format(shard)])
+
+    def _shard(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self._shards
+
+    def _connection(self, shard):
+        """Returns a connection to a shard. Connections are opened once per process, and are not shared with forked
+            child processes"""
+        if self._pid != os.getpid():
+            self._connections = {}
+            self._pid = os.getpid()
+
+        if shard not in self._connections:
+            os.makedirs(self._location, exist_ok=True)
+            conn = sqlite3.connect(self.shard_path(shard), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.schema:
+                conn.execute(statement)
+            self._connections[shard] = conn
+        return self._connections[shard]
+
+    def _encode(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= self._compress_min_bytes:
+            return zlib.compress(data), 1
+        return data, 0
+
+    @staticmethod
+    def _decode(data, compressed):
+        if compressed:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._set(key, value, timeout, version, replace=False)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set(key, value, timeout, version, replace=True)
+
+    def _set(self, key, value, timeout, version, replace):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expires = self.get_backend_timeout(timeout)
+        data, compressed = self._encode(value)
+        now = time.time()
+
+        conn = self._connection(self._shard(key))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not replace:
+                row = conn.execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+                if row and (row[0] is None or row[0] > now):
+                    conn.execute('ROLLBACK')
+                    return False
+            # delete and insert rather than replace, so that the size triggers fire
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            conn.execute('INSERT INTO cache (key, value, compressed, size, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (key, sqlite3.Binary(data), compressed, len(data), expires, now))
+            self._cull(conn, now)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return True
+
+    def _cull(self, conn, now):
+        """Evicts expired entries, and then the least recently used entries, until the shard is within its budget"""
+        budget = self._max_bytes / self._shards
+        total_size = conn.execute('SELECT total_size FROM meta WHERE id = 0').fetchone()[0]
+        if total_size <= budget:
+            return
+        conn.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (now,))
+
+        # evict down to 90% of the budget, so that every set does not have to evict
+        target = budget * 0.9
+        while True:
+            total_size = conn.execute('SELECT total_size FROM meta WHERE id = 0').fetchone()[0]
+            if total_size <= target:
+                break
+            sizes = conn.execute('SELECT key, size FROM cache ORDER BY accessed LIMIT 100').fetchall()
+            if not sizes:
+                break
+            evict = []
+            for key, size in sizes:
+                evict.append((key,))
+                total_size -= size
+                if total_size <= target:
+                    break
+            conn.executemany('DELETE FROM cache WHERE key = ?', evict)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        conn = self._connection(self._shard(key))
+        row = conn.execute('SELECT value, compressed, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        now = time.time()
+        if row[2] is not None and row[2] <= now:
+            conn.execute('DELETE FROM cache WHERE key = ? AND expires <= ?', (key, now))
+            return default
+        if now - row[3] > self._access_resolution:
+            conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        try:
+            return self._decode(row[0], row[1])
+        except (pickle.PickleError, zlib.error, EOFError):
+            return default
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._connection(self._shard(key)).execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        row = self._connection(self._shard(key)).execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def clear(self):
+        for shard in range(self._shards):
+            if os.path.isfile(self.shard_path(shard)):
+                self._connection(shard).execute('DELETE FROM cache')
+
+    def close(self, **kwargs):
+        # connections are kept open for the life of the process
+        pass
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+
+from common.tools import release_stamp
+
+from functools import wraps
+from wsgiref.util import is_hop_by_hop
+import hashlib
+import time
+
+
+# the release stamp is looked up at most once per RELEASE_STAMP_TIMEOUT seconds in each process, so that serving a
+# cached page does not require a database query
+_release = {'stamp': None, 'checked': 0}
+
+def current_release():
+    """Returns the release stamp of the current data release, see common.tools.release_stamp"""
+    timeout = getattr(settings, 'RELEASE_STAMP_TIMEOUT', 60)
+    now = time.time()
+    if _release['stamp'] is None or now - _release['checked'] > timeout:
+        _release['stamp'] = release_stamp()
+        _release['checked'] = now
+    return _release['stamp']
+
+
+def release_cache_page(timeout=60*60*24*7):
+    """View decorator that caches GET responses of read-only data pages until the next data release (or for timeout
+        seconds). Cached pages are keyed by the release stamp and the full request path, and responses carry a strong
+        ETag, so that clients sending a matching If-None-Match header get an empty 304 response
+
+        Use it in the same way as django.views.decorators.cache.cache_page, e.g. @release_cache_page() on a view
+        function or release_cache_page()(View.as_view()) in a URL configuration. Only use it for views that do not
+        depend on the session (e.g. the user's selection)"""
+    def decorator(view):
+        @wraps(view)
+        def wrapped_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            release = current_release()
+            # the Accept header is part of the key, as API views choose the response format from it
+            key = 'release_page_' + hashlib.sha1('{} {} {}'.format(release, request.build_absolute_uri(),
+                request.META.get('HTTP_ACCEPT', '')).encode('utf-8')).hexdigest()
+            cached = cache.get(key)
+            if cached is not None and cached['release'] == release:
+                if etag_matches(request, cached['etag']):
+                    return not_modified(cached['etag'])
+                response = HttpResponse(cached['content'], status=cached['status'])
+                for header, value in cached['headers']:
+                    response[header] = value
+                return response
+
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200 or response.streaming or response.cookies:
+                return response
+            if hasattr(response, 'render') and callable(response.render):
+                response = response.render()
+            # pages that contain a CSRF token are specific to the user
+            if request.META.get('CSRF_COOKIE_USED'):
+                return response
+
+            etag = quote_etag(hashlib.sha1(release.encode('utf-8') + response.content).hexdigest())
+            response['ETag'] = etag
+            patch_cache_control(response, no_cache=True)
+            cache.set(key, {
+                'release': release,
+                'etag': etag,
+                'status': response.status_code,
+                'content': response.content,
+                # all headers (e.g. Content-Disposition of downloads), except connection specific and cookie headers
+                'headers': [(h, v) for h, v in response.items() if not is_hop_by_hop(h)
+                    and h.lower() not in ('set-cookie', 'cookie')],
+            }, timeout)
+
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            return response
+        return wrapped_view
+    return decorator
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # depending on the Django version, parse_etags returns quoted or unquoted tags
+    return etag.strip('"') in [e.strip('"') for e in parse_etags(if_none_match)]
+
+
+def not_modified(etag):
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+    return response
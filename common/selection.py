@@ -1,13 +1,32 @@
-﻿from django.conf import settings
+﻿from django.apps import apps
+from django.conf import settings
 
+from common.release_cache import current_release
 from protein.models import Species
 from protein.models import ProteinSource
 from residue.models import ResidueNumberingScheme
 
 
+# ids of the default protein source and numbering scheme, looked up once per release
+_default_ids = {'release': None}
+
+def default_ids():
+    release = current_release()
+    if _default_ids['release'] != release:
+        _default_ids['protein_source'] = ProteinSource.objects.get(name='SWISSPROT').id
+        _default_ids['numbering_scheme'] = ResidueNumberingScheme.objects.get(
+            slug=settings.DEFAULT_NUMBERING_SCHEME).id
+        _default_ids['release'] = release
+    return _default_ids
+
+
 class SimpleSelection:
     """A class representing the proteins and segments a user has selected. Can be serialized and stored in session"""
-    def __init__(self):
+    # attributes that hold lists of SelectionItems
+    item_lists = ['reference', 'targets', 'segments', 'species', 'pref_g_proteins', 'g_proteins', 'annotation',
+        'numbering_schemes']
+
+    def __init__(self, defaults=True):
         self.reference = []
         self.targets = []
         self.segments = []
@@ -20,14 +39,17 @@ class SimpleSelection:
         self.g_proteins = []
 
         # annotation
-        ps = ProteinSource.objects.get(name='SWISSPROT') # Default protein source is SWISSPROT
-        o = SelectionItem('protein_source', ps)
-        self.annotation = [o]
+        self.annotation = []
 
         # numbering schemes
-        gn = ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME)
-        o = SelectionItem('numbering_schemes', gn)
-        self.numbering_schemes = [o]
+        self.numbering_schemes = []
+
+        if defaults:
+            ids = default_ids()
+            self.annotation = SelectionItem.lazy_list([['protein_source', 'protein.proteinsource',
+                ids['protein_source'], {}]]) # Default protein source is SWISSPROT
+            self.numbering_schemes = SelectionItem.lazy_list([['numbering_schemes', 'residue.residuenumberingscheme',
+                ids['numbering_scheme'], {}]])
 
         # Default values for phylogenetic tree creation
         self.tree_settings = ['0','0','0','0']
@@ -39,6 +61,26 @@ class SimpleSelection:
     def __str__(self):
         return str(self.__dict__)
 
+    def to_dict(self):
+        """Compact representation of the selection, with selected objects stored as model labels and ids, that can
+            be serialized as JSON (see common.session_serializer)"""
+        data = {a: [item.to_list() for item in getattr(self, a)] for a in self.item_lists}
+        data['tree_settings'] = self.tree_settings
+        data['site_residue_groups'] = self.site_residue_groups
+        data['active_site_residue_group'] = self.active_site_residue_group
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a selection from to_dict output. Selected objects are not loaded until they are used"""
+        simple_selection = cls(defaults=False)
+        for a in cls.item_lists:
+            setattr(simple_selection, a, SelectionItem.lazy_list(data[a]))
+        simple_selection.tree_settings = data['tree_settings']
+        simple_selection.site_residue_groups = data['site_residue_groups']
+        simple_selection.active_site_residue_group = data['active_site_residue_group']
+        return simple_selection
+
 
 class Selection(SimpleSelection):
     """A class that extends SimpleSelection, and adds methods to process the selection (these methods can not be
@@ -59,7 +101,7 @@ class Selection(SimpleSelection):
 
     def exporter(self):
         """Exports the attributes of Selection to a SimpleSelection object, and returns it"""
-        ss = SimpleSelection()
+        ss = SimpleSelection(defaults=False)
         ss.reference = self.reference
         ss.targets = self.targets
         ss.segments = self.segments
@@ -112,7 +154,7 @@ class Selection(SimpleSelection):
         group_id = False
         delete_group = False
         for selection_object in selection:
-            if (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id) and 
+            if (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id) and 
                 'site_residue_group' in selection_object.properties and
                 selection_object.properties['site_residue_group']):
                 group_id = selection_object.properties['site_residue_group']
@@ -120,7 +162,7 @@ class Selection(SimpleSelection):
 
         # loop through selected objects and remove the one that matches the subtype and ID
         for selection_object in selection:
-            if not (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id)):
+            if not (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id)):
                 updated_selection.append(selection_object)
                 
                 # check group ID
@@ -169,15 +211,64 @@ class Selection(SimpleSelection):
 
 
 class SelectionItem:
-    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute"""
-    def __init__(self, selection_type, selection_object, properties={}):
+    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute
+
+    The object is identified by its model label and id, and items read from the session load their objects when
+    item is first used, with one query for all items of the same list (see lazy_list)"""
+    def __init__(self, selection_type, selection_object, properties=None):
         self.type = selection_type
         self.type_title = selection_type.replace('_', ' ').capitalize()
-        self.item = selection_object
-        self.properties = properties
+        self._item = selection_object
+        self.model = selection_object._meta.label_lower
+        self.item_id = selection_object.pk
+        self.properties = properties if properties is not None else {}
+        self._group = None
+
+    @classmethod
+    def lazy_list(cls, items):
+        """Creates a list of items from to_list output, without loading the selected objects"""
+        group = []
+        for selection_type, model, item_id, properties in items:
+            o = cls.__new__(cls)
+            o.type = selection_type
+            o.type_title = selection_type.replace('_', ' ').capitalize()
+            o._item = None
+            o.model = model
+            o.item_id = item_id
+            o.properties = properties
+            o._group = group
+            group.append(o)
+        return group
+
+    @property
+    def item(self):
+        if self._item is None:
+            self.load(self._group or [self])
+        return self._item
+
+    @staticmethod
+    def load(items):
+        """Loads the objects of a list of items, with one query per model"""
+        ids = {}
+        for o in items:
+            if o._item is None:
+                ids.setdefault(o.model, []).append(o.item_id)
+        for model, model_ids in ids.items():
+            objects = apps.get_model(model).objects.in_bulk(model_ids)
+            for o in items:
+                if o._item is None and o.model == model:
+                    o._item = objects.get(o.item_id)
+
+    def to_list(self):
+        return [self.type, self.model, self.item_id, self.properties]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_group'] = None
+        return state
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_list())
 
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+        return self.to_list() == other.to_list()
@@ -0,0 +1,42 @@
+from django.core.cache import cache
+
+from common.release_cache import current_release
+
+
+# values computed in this process, for the current release only
+_values = {'release': None, 'values': {}}
+
+
+class ReleaseContext:
+    """A class attribute of a selection view (e.g. the family tree of AbsTargetSelection) that is computed when it is
+        first read while rendering a page, instead of when the class is defined, which would query the database at
+        import time and keep the results for the life of the process
+
+        The value is built by calling build with the view, and is stored as a list, so that it can be shared by all
+        views and, through the cache, by all worker processes until the next data release. depends lists the view
+        attributes that the value depends on (e.g. default_slug). Subclasses can still override the attribute with
+        a plain value"""
+
+    def __init__(self, name, build, depends=(), timeout=60*60*24*7):
+        self.name = name
+        self.build = build
+        self.depends = depends
+        self.timeout = timeout
+
+    def __get__(self, view, owner):
+        if view is None:
+            return self
+
+        release = current_release()
+        if _values['release'] != release:
+            _values['release'] = release
+            _values['values'] = {}
+
+        key = '_'.join(['selection_context', release, self.name] + [str(getattr(view, d)) for d in self.depends])
+        if key not in _values['values']:
+            value = cache.get(key)
+            if value is None:
+                value = list(self.build(view))
+                cache.set(key, value, self.timeout)
+            _values['values'][key] = value
+        return _values['values'][key]
@@ -0,0 +1,42 @@
+from common.selection import SimpleSelection
+
+import base64
+import json
+import pickle
+
+
+class SelectionSerializer:
+    """Session serializer that stores sessions as JSON. Selections (SimpleSelection) are stored in their compact form
+        (model labels and ids, see SimpleSelection.to_dict), so that reading and writing the selection does not pickle
+        database objects. Values that can not be stored as JSON without changing them (e.g. uploaded files) are
+        pickled, as with django.contrib.sessions.serializers.PickleSerializer"""
+
+    def dumps(self, obj):
+        data = {}
+        for key, value in obj.items():
+            if isinstance(value, SimpleSelection) and self.json_safe(value.to_dict()):
+                data[key] = {'__selection__': value.to_dict()}
+            elif self.json_safe(value):
+                data[key] = value
+            else:
+                data[key] = {'__pickle__': base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).decode(
+                    'ascii')}
+        return json.dumps(data, separators=(',', ':')).encode('latin-1')
+
+    def loads(self, data):
+        obj = json.loads(data.decode('latin-1'))
+        for key, value in obj.items():
+            if isinstance(value, dict) and len(value) == 1:
+                if '__selection__' in value:
+                    obj[key] = SimpleSelection.from_dict(value['__selection__'])
+                elif '__pickle__' in value:
+                    obj[key] = pickle.loads(base64.b64decode(value['__pickle__']))
+        return obj
+
+    @staticmethod
+    def json_safe(value):
+        """True if a value is read back unchanged from JSON (e.g. tuples and dicts with integer keys are not)"""
+        try:
+            return json.loads(json.dumps(value)) == value
+        except (TypeError, ValueError):
+            return False
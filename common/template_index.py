@@ -0,0 +1,91 @@
+from django.conf import settings
+
+from common.alignment import AlignedReferenceTemplate
+from common.tools import release_stamp
+from protein.models import Protein
+from structure.models import Structure
+
+from collections import OrderedDict
+import logging
+import os
+import pickle
+import tempfile
+
+
+class TemplateIndex:
+    """An on-disk index of the template structures of each receptor, ranked as in the homology modeling template
+        search (see build_template_index), so that a model build can look up its templates instead of aligning the
+        receptor to every template structure. There is one file per receptor, with the ranked templates (structure id,
+        similarity, identity and resolution) and the ids of all candidate template structures for each set of query
+        states and segments, and one directory per data release, so that a new release invalidates the index. An entry
+        is not used if the candidate structures have changed since it was built (e.g. structures added within the same
+        release)"""
+
+    logger = logging.getLogger('protwis')
+
+    def __init__(self, location=None, release=None):
+        if location is None:
+            location = getattr(settings, 'TEMPLATE_INDEX_DIR', os.sep.join([settings.BUILD_CACHE_DIR,
+                'template_index']))
+        self.location = location
+        self.release = release
+
+    def release_dir(self):
+        release = self.release
+        if release is None:
+            release = release_stamp()
+        return os.sep.join([self.location, release])
+
+    @staticmethod
+    def key(query_states, segments):
+        return (tuple(sorted(set(query_states))), tuple(segments))
+
+    def path(self, entry_name):
+        return os.sep.join([self.release_dir(), entry_name + '.pickle'])
+
+    def load(self, entry_name):
+        """Returns the index entry of a receptor (a dict of ranked templates by key), or None"""
+        try:
+            with open(self.path(entry_name), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as msg:
+            self.logger.warning('Failed reading template index of {}: {}'.format(entry_name, msg))
+            return None
+
+    def ranked_templates(self, entry_name, query_states, segments):
+        """The ranked templates of a receptor, as a list of (structure id, similarity, identity, resolution) tuples,
+            or None if they are not in the index, or the candidate template structures have changed"""
+        entry = self.load(entry_name)
+        if entry is None or self.key(query_states, segments) not in entry:
+            return None
+        templates = entry[self.key(query_states, segments)]
+
+        # structures added or removed since the index was built make the entry out of date
+        structures = AlignedReferenceTemplate.template_structures(Protein.objects.get(entry_name=entry_name),
+            query_states).values_list('id', flat=True)
+        if sorted(structures) != templates['structures']:
+            self.logger.info('Template index entry of {} is out of date'.format(entry_name))
+            return None
+        return templates['ranked']
+
+    def similarity_table(self, entry_name, query_states, segments):
+        """The similarity table of a receptor (an ordered dict of template structures and their similarity, as
+            AlignedReferenceTemplate.similarity_table), or None if it is not in the index"""
+        ranked = self.ranked_templates(entry_name, query_states, segments)
+        if ranked is None:
+            return None
+        structures = Structure.objects.select_related('pdb_code', 'protein_conformation__protein__parent',
+            'state').in_bulk([r[0] for r in ranked])
+        return OrderedDict([(structures[r[0]], r[1]) for r in ranked])
+
+    def save(self, entry_name, entry):
+        path = self.path(entry_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first, so that readers never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
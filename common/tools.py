@@ -18,6 +18,16 @@ import xml.etree.ElementTree as etree
 
 
 
+def release_stamp():
+    """Returns a string identifying the current data release (the date of the latest release notes), used to version
+        precomputed data"""
+    from common.models import ReleaseNotes # imported here, as common.models imports this module
+
+    latest = ReleaseNotes.objects.values_list('date', flat=True).first()
+    if latest:
+        return latest.isoformat()
+    return 'unreleased'
+
 def save_to_cache(path, file_id, data):
     create_cache_dirs(path)
     cache_dir_path = os.sep.join([settings.BUILD_CACHE_DIR] + path)
@@ -6,6 +6,7 @@ from django.db.models import Case, When
 
 from common.selection import SimpleSelection, Selection, SelectionItem
 from common import definitions
+from common.selection_context import ReleaseContext
 from structure.models import Structure
 from protein.models import Protein, ProteinFamily, ProteinSegment, Species, ProteinSource, ProteinSet, ProteinGProtein, ProteinGProteinPair
 from residue.models import ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent, ResiduePositionSet
@@ -55,28 +56,27 @@ class AbsTargetSelection(TemplateView):
         ('segments', False),
     ])
 
-    # proteins and families
-    #try - except block prevents manage.py from crashing - circular dependencies between protein - common 
-    try:
-        ppf = ProteinFamily.objects.get(slug=default_slug)
-        pfs = ProteinFamily.objects.filter(parent=ppf.id)
-        ps = Protein.objects.filter(family=ppf)
-        psets = ProteinSet.objects.all().prefetch_related('proteins')
-        tree_indent_level = []
-        action = 'expand'
-        # remove the parent family (for all other families than the root of the tree, the parent should be shown)
-        del ppf
-    except Exception as e:
-        pass
+    # the lists below are looked up when a page is first rendered, and are shared until the next data release (see
+    # common.selection_context)
+
+    # proteins and families (the children of the family default_slug, which itself is not shown)
+    pfs = ReleaseContext('families', lambda view: ProteinFamily.objects.filter(parent__slug=view.default_slug),
+        depends=('default_slug',))
+    ps = ReleaseContext('proteins', lambda view: Protein.objects.filter(family__slug=view.default_slug),
+        depends=('default_slug',))
+    psets = ReleaseContext('protein_sets', lambda view: ProteinSet.objects.all().prefetch_related('proteins'))
+    tree_indent_level = []
+    action = 'expand'
 
     # species
-    sps = Species.objects.all()
+    sps = ReleaseContext('species', lambda view: Species.objects.all())
 
     # g proteins
-    gprots = ProteinGProtein.objects.all()
+    gprots = ReleaseContext('g_proteins', lambda view: ProteinGProtein.objects.all())
 
     # numbering schemes
-    gns = ResidueNumberingScheme.objects.exclude(slug=settings.DEFAULT_NUMBERING_SCHEME).exclude(slug='cgn')
+    gns = ReleaseContext('numbering_schemes', lambda view: ResidueNumberingScheme.objects.exclude(
+        slug=settings.DEFAULT_NUMBERING_SCHEME).exclude(slug='cgn'))
 
     def get_context_data(self, **kwargs):
         """get context from parent class (really only relevant for children of this class, as TemplateView does
@@ -177,13 +177,13 @@ class AbsSegmentSelection(TemplateView):
         ('segments', True),
     ])
 
-    try:
-        rsets = ResiduePositionSet.objects.exclude(name="Gprotein Barcode").prefetch_related('residue_position')
-    except Exception as e:
-        pass
+    rsets = ReleaseContext('residue_position_sets', lambda view: ResiduePositionSet.objects.exclude(
+        name="Gprotein Barcode").prefetch_related('residue_position'))
 
-    ss = ProteinSegment.objects.filter(name__regex = r'.{5}.*', partial=False).prefetch_related('generic_numbers') 
-    ss_cats = ss.values_list('category').order_by('category').distinct('category')
+    ss = ReleaseContext('segments', lambda view: ProteinSegment.objects.filter(name__regex = r'.{5}.*',
+        partial=False).prefetch_related('generic_numbers'))
+    ss_cats = ReleaseContext('segment_categories', lambda view: ProteinSegment.objects.filter(
+        name__regex = r'.{5}.*', partial=False).values_list('category').order_by('category').distinct('category'))
     action = 'expand'
 
     amino_acid_groups = definitions.AMINO_ACID_GROUPS
@@ -7,6 +7,8 @@ from django.views.decorators.cache import cache_page
 
 from drugs.models import Drugs
 from protein.models import Protein, ProteinFamily
+from protein.family_tree import FamilyTree
+from common.release_cache import release_cache_page
 
 import re
 import json
@@ -177,7 +179,7 @@ def drugstatistics(request):
 
     return render(request, 'drugstatistics.html', {'drugtypes_approved':drugtypes_approved,'drugtypes_trials':drugtypes_trials, 'drugtypes_estab':drugtypes_estab, 'drugtypes_not_estab':drugtypes_not_estab,'drugindications_approved':drugindications_approved, 'drugindications_trials':drugindications_trials, 'drugtargets_approved':drugtargets_approved, 'drugtargets_trials':drugtargets_trials, 'drugfamilies_approved':drugfamilies_approved, 'drugfamilies_trials':drugfamilies_trials, 'drugClasses_approved':drugClasses_approved, 'drugClasses_trials':drugClasses_trials, 'drugs_over_time':drugs_over_time})
 
-@cache_page(60*60*24*1) # 1 day
+@release_cache_page()
 def drugbrowser(request):
     # Get drugdata from here somehow
 
@@ -188,7 +190,8 @@ def drugbrowser(request):
     if context==None:
         context = list()
 
-        drugs = Drugs.objects.all().prefetch_related('target__family__parent__parent__parent')
+        drugs = Drugs.objects.all().prefetch_related('target')
+        tree = FamilyTree.get()
 
         for drug in drugs:
             drugname = drug.name
@@ -207,8 +210,8 @@ def drugbrowser(request):
                 # targets.append(str(protein))
                 # jsondata = {'name':drugname, 'target': str(protein), 'approval': approval, 'indication': indication, 'status':status, 'drugtype':drugtype, 'novelty': novelty}
                 
-                clas = str(protein.family.parent.parent.parent.name)
-                family = str(protein.family.parent.name)
+                clas = tree.ancestor_name(protein.family_id, 1)
+                family = tree.ancestor_name(protein.family_id, 3)
 
                 jsondata = {'name':drugname, 'target': str(protein), 'approval': approval, 'class':clas, 'family':family, 'indication': indication, 'status':status, 'drugtype':drugtype, 'novelty': novelty}
                 context.append(jsondata)
@@ -223,10 +226,10 @@ def drugbrowser(request):
 def drugmapping(request):
     context = dict()
 
-    families = ProteinFamily.objects.all()
+    tree = FamilyTree.get()
     lookup = {}
-    for f in families:
-        lookup[f.slug] = f.name.replace("receptors","").replace(" receptor","").replace(" hormone","").replace("/neuropeptide","/").replace(" (G protein-coupled)","").replace(" factor","").replace(" (LPA)","").replace(" (S1P)","").replace("GPR18, GPR55 and GPR119","GPR18/55/119").replace("-releasing","").replace(" peptide","").replace(" and oxytocin","/Oxytocin").replace("Adhesion class orphans","Adhesion orphans").replace("muscarinic","musc.").replace("-concentrating","-conc.")
+    for slug, name in zip(tree.slugs, tree.names):
+        lookup[slug] = name.replace("receptors","").replace(" receptor","").replace(" hormone","").replace("/neuropeptide","/").replace(" (G protein-coupled)","").replace(" factor","").replace(" (LPA)","").replace(" (S1P)","").replace("GPR18, GPR55 and GPR119","GPR18/55/119").replace("-releasing","").replace(" peptide","").replace(" and oxytocin","/Oxytocin").replace("Adhesion class orphans","Adhesion orphans").replace("muscarinic","musc.").replace("-concentrating","-conc.")
 
     class_proteins = Protein.objects.filter(family__slug__startswith="00",source__name='SWISSPROT', species_id=1).prefetch_related('family').order_by('family__slug')
     
@@ -741,14 +741,84 @@ def check_other_aromatic(aa,ligand,info):
     new_results[ligand]['interactions'] = templist
     return check
 
+class CellList(object):
+    """Spatial index of a set of coordinates. Points are assigned to cubic cells with an edge length of at least the
+        query radius, so that the neighbours of a point are found in the 27 surrounding cells"""
+
+    def __init__(self, coords, cell_size):
+        self.coords = coords
+        self.cell_size = float(cell_size)
+        cells = np.floor(coords / self.cell_size).astype(np.int64)
+        self.origin = cells.min(axis=0) - 1
+        self.shape = cells.max(axis=0) - self.origin + 2
+        keys = self.cell_keys(cells)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+        self.last_query_size = 0
+
+    def cell_keys(self, cells):
+        cells = cells - self.origin
+        return (cells[:, 0] * self.shape[1] + cells[:, 1]) * self.shape[2] + cells[:, 2]
+
+    def query(self, points, query_radius):
+        """All pairs of query points and indexed points that are closer than query_radius. Returns arrays of query
+            point indices, indexed point indices and distances, ordered by query point and indexed point"""
+        if query_radius > self.cell_size:
+            raise ValueError('Query radius is larger than the cell size')
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        offsets = np.array([[x, y, z] for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)], dtype=np.int64)
+        neighbours = (cells[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3)
+        point_index = np.repeat(np.arange(len(points)), len(offsets))
+
+        # cells outside the grid contain no points
+        inside = np.all((neighbours - self.origin >= 0) & (neighbours - self.origin < self.shape), axis=1)
+        neighbours = neighbours[inside]
+        point_index = point_index[inside]
+        keys = self.cell_keys(neighbours)
+        starts = np.searchsorted(self.keys, keys, side='left')
+        counts = np.searchsorted(self.keys, keys, side='right') - starts
+
+        # expand the ranges of sorted points in each cell into candidate pairs
+        total = int(counts.sum())
+        first = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        candidates = self.order[first + np.arange(total)]
+        point_index = np.repeat(point_index, counts)
+        self.last_query_size = total
+
+        difference = points[point_index] - self.coords[candidates]
+        distances = np.sqrt(np.sum(difference * difference, axis=1))
+        close = distances < query_radius
+        point_index = point_index[close]
+        candidates = candidates[close]
+        distances = distances[close]
+        order = np.lexsort((candidates, point_index))
+        return point_index[order], candidates[order], distances[order]
+
+
 # LOOP OVER RECEPTOR AND FIND INTERACTIONS
 def find_interactions():
     global count_calcs, count_skips
-    count_atom = 0
     count_skips = 0
     count_calcs = 0
     p = PDBParser(QUIET=True)
     s = p.get_structure(pdbname, projectdir + 'pdbs/' + pdbname + '.pdb')
+
+    # find the atoms within the interaction radius of each ligand with one query of a spatial index, and group them by
+    # residue (pairs of ligand atom index, residue atom and distance, ordered by ligand atom and residue atom)
+    atoms = list(s.get_atoms())
+    cells = CellList(np.array([atom.get_coord() for atom in atoms], dtype=float), radius)
+    residue_contacts = {}
+    for hetflag, atomlist in hetlist.iteritems():
+        residue_contacts[hetflag] = {}
+        if not atomlist:
+            continue
+        ligand_coords = np.array([atom[2].get_array() for atom in atomlist], dtype=float)
+        ligand_index, atom_index, distances = cells.query(ligand_coords, radius)
+        count_calcs += cells.last_query_size
+        for l, a, d in zip(ligand_index.tolist(), atom_index.tolist(), distances.tolist()):
+            residue_id = atoms[a].get_parent().get_full_id()
+            residue_contacts[hetflag].setdefault(residue_id, []).append([l, atoms[a], d])
+
     for model in s:
         for chain in model:
             chainid = chain.get_id()
@@ -769,10 +839,8 @@ def find_interactions():
                 if hetflagtest in hetlist:
                     continue  # residue is a hetnam
                 # print "Looking at ",aa_resname,aa_seqid,chainid
-                countresidue = count_atom
                 # print aaname
-                # could probably make a check here to see if this residue was
-                # anywhere near the ligand, otherwise skip the check per atom
+                residue_id = residue.get_full_id()
                 for hetflag, atomlist in hetlist.iteritems():
                     if not 'CA' in residue:  # prevent errors
                         continue
@@ -783,58 +851,49 @@ def find_interactions():
                         count_skips += 1
                         continue
 
-                    count_atom = countresidue
+                    # residues without atoms within the interaction radius have no interactions
+                    if residue_id not in residue_contacts[hetflag]:
+                        continue
+
                     sum = 0
-                    hydrophobic_count = 0
+                    hydrophobic_atoms = set()
                     accesible_check = 0
 
                     # if goodhet!='' and hetflag!=goodhet and
                     # "H_"+goodhet!=hetflag: continue ### Only look at the
                     # ligand that has an image from poseview made for it.
-                    tempdistance = radius
-
-                    for atom in atomlist:
-                        #print(hetflag,atom)
-                        hetresname = atom[0]
-                        het_atom = atom[1]
-                        het_vector = atom[2]
-                        hydrophobic_check = 1
 
-                        aaatomlist = []
-                        for atom in residue:
-                            count_atom += 1
-                            aa_vector = atom.get_vector()
-                            aa_atom = atom.name
-                            aa_atom_type = atom.element
-                            aaatomlist.append([count_atom, aa_vector, aa_atom])
-
-                            d = (het_vector - aa_vector)
-                            count_calcs += 1
-                            if d.norm() < radius:
-                                if not hetflag in results:
-                                    results[hetflag] = {}
-                                    summary_results[hetflag] = {'score': [], 'hbond': [], 'hbondplus': [],
-                                                                'hbond_confirmed': [], 'aromatic': [],'aromaticff': [],
-                                                                'ionaromatic': [], 'aromaticion': [], 'aromaticef': [],
-                                                                'aromaticfe': [], 'hydrophobic': [], 'waals': [], 'accessible':[]}
-                                    new_results[hetflag] = {'interactions':[]}
-                                if not aaname in results[hetflag]:
-                                    results[hetflag][aaname] = []
-                                if not (het_atom[0] == 'H' or aa_atom[0] == 'H' or aa_atom_type=='H'):
-                                    #print(aa_atom_type)
-                                    results[hetflag][aaname].append([het_atom, aa_atom, round(
-                                        d.norm(), 2), het_vector, aa_vector, aa_seqid, chainid])
-                                    tempdistance = round(d.norm(), 2)
-                                    sum += 1
-                            # if both are carbon then we are making a hydrophic
-                            # interaction
-                            if het_atom[0] == 'C' and aa_atom[0] == 'C' and d.norm() < hydrophob_radius and hydrophobic_check:
-                                hydrophobic_count += 1
-                                hydrophobic_check = 0
-
-                            if d.norm() < 5 and (aa_atom!='C' and aa_atom!='O' and aa_atom!='N'):
-                                #print(aa_atom)
-                                accesible_check = 1
+                    for l, atom, distance in residue_contacts[hetflag][residue_id]:
+                        hetresname = atomlist[l][0]
+                        het_atom = atomlist[l][1]
+                        het_vector = atomlist[l][2]
+                        aa_vector = atom.get_vector()
+                        aa_atom = atom.name
+                        aa_atom_type = atom.element
+
+                        if not hetflag in results:
+                            results[hetflag] = {}
+                            summary_results[hetflag] = {'score': [], 'hbond': [], 'hbondplus': [],
+                                                        'hbond_confirmed': [], 'aromatic': [],'aromaticff': [],
+                                                        'ionaromatic': [], 'aromaticion': [], 'aromaticef': [],
+                                                        'aromaticfe': [], 'hydrophobic': [], 'waals': [], 'accessible':[]}
+                            new_results[hetflag] = {'interactions':[]}
+                        if not aaname in results[hetflag]:
+                            results[hetflag][aaname] = []
+                        if not (het_atom[0] == 'H' or aa_atom[0] == 'H' or aa_atom_type=='H'):
+                            #print(aa_atom_type)
+                            results[hetflag][aaname].append([het_atom, aa_atom, round(
+                                distance, 2), het_vector, aa_vector, aa_seqid, chainid])
+                            sum += 1
+                        # if both are carbon then we are making a hydrophic
+                        # interaction (counted once per ligand atom)
+                        if het_atom[0] == 'C' and aa_atom[0] == 'C' and distance < hydrophob_radius:
+                            hydrophobic_atoms.add(l)
+
+                        if distance < 5 and (aa_atom!='C' and aa_atom!='O' and aa_atom!='N'):
+                            #print(aa_atom)
+                            accesible_check = 1
+                    hydrophobic_count = len(hydrophobic_atoms)
 
                     if accesible_check: #if accessible!
                         summary_results[hetflag]['accessible'].append(
@@ -1,5 +1,7 @@
 from django.db import models
 
+from structure.pdb_arrays import PdbArrays
+
 
 class ResidueFragmentInteraction(models.Model):
 
@@ -19,6 +21,11 @@ class ResidueFragmentInteraction(models.Model):
     def get_pdbdata(self):
         return "{!s}\n{!s}".format(self.rotamer.pdbdata, self.fragment.pdbdata)
 
+    def get_structure(self, structure_id='structure'):
+        """A Bio.PDB Structure of get_pdbdata, read as PDBParser reads it. Reading stops at the first END record, so the
+            fragment atoms are left out when the rotamer file ends with one"""
+        return PdbArrays.for_text(self.get_pdbdata()).get_structure(structure_id)
+
 
     def generate_filename(self):
 
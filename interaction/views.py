@@ -432,12 +432,11 @@ def extract_fragment_rotamer(f, residue, structure, ligand):
                 rotamer_pdb += line
         f_in.close()
 
-        rotamer_data, created = PdbData.objects.get_or_create(pdb=rotamer_pdb)
+        rotamer_data, created = PdbData.objects.get_or_create_pdb(rotamer_pdb)
         rotamer, created = Rotamer.objects.get_or_create(
             residue=residue, structure=structure, pdbdata=rotamer_data)
 
-        fragment_data, created = PdbData.objects.get_or_create(
-            pdb=fragment_pdb)
+        fragment_data, created = PdbData.objects.get_or_create_pdb(fragment_pdb)
         fragment, created = Fragment.objects.get_or_create(
             ligand=ligand, structure=structure, pdbdata=fragment_data, residue=residue)
     else:
@@ -467,8 +466,8 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
         if structure.pdb_data is None:
             f = module_dir + "/pdbs/" + pdbname + ".pdb"
             if os.path.isfile(f):
-                pdbdata, created = PdbData.objects.get_or_create(
-                    pdb=open(f, 'r').read())  # does this close the file?
+                pdbdata, created = PdbData.objects.get_or_create_pdb(
+                    open(f, 'r').read())  # does this close the file?
             else:
                 print('quitting due to no pdb in filesystem')
                 quit()
@@ -498,8 +497,8 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
                 f = module_dir + "/results/" + pdbname + "/interaction" + \
                     "/" + pdbname + "_" + temp[1] + ".pdb"
                 if os.path.isfile(f):
-                    pdbdata, created = PdbData.objects.get_or_create(
-                        pdb=open(f, 'r').read())  # does this close the file?
+                    pdbdata, created = PdbData.objects.get_or_create_pdb(
+                        open(f, 'r').read())  # does this close the file?
                     if debug:
                         print("Found file" + f)
                 else:
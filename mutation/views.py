@@ -11,11 +11,14 @@ from mutation.models import *
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.tools import release_stamp
+from common.release_cache import release_cache_page
 from common import definitions
 
 from residue.models import Residue,ResidueNumberingScheme, ResidueGenericNumberEquivalent
 from residue.views import ResidueTablesDisplay
 from protein.models import Protein,ProteinSegment,ProteinFamily,ProteinConformation
+from protein.family_tree import FamilyTree
 from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from interaction.views import calculate
 from interaction.forms import PDBform
@@ -224,8 +227,10 @@ def render_mutations(request, protein = None, family = None, download = None, re
         segments = ProteinSegment.objects.all().exclude(slug__in = excluded_segment).prefetch_related()
         segment_hash = hash(tuple(sorted(segments.values_list('id',flat=True))))
 
-        consensus = cache.get(str(protein_hash)+"&"+str(segment_hash)+"&consensus")
-        generic_number_objs = cache.get(str(protein_hash)+"&"+str(segment_hash)+"&generic_number_objs")
+        # cached alignments are invalidated by a new data release
+        cache_prefix = release_stamp()+"&"+str(protein_hash)+"&"+str(segment_hash)
+        consensus = cache.get(cache_prefix+"&consensus")
+        generic_number_objs = cache.get(cache_prefix+"&generic_number_objs")
         if generic_number_objs == None or consensus == None:
             a = Alignment()
 
@@ -240,8 +245,8 @@ def render_mutations(request, protein = None, family = None, download = None, re
             a.calculate_statistics()
             consensus = a.full_consensus
             generic_number_objs = a.generic_number_objs
-            cache.set(str(protein_hash)+"&"+str(segment_hash)+"&consensus",consensus)
-            cache.set(str(protein_hash)+"&"+str(segment_hash)+"&generic_number_objs",generic_number_objs)
+            cache.set(cache_prefix+"&consensus",consensus)
+            cache.set(cache_prefix+"&generic_number_objs",generic_number_objs)
 
         residue_list = []
         generic_numbers = []
@@ -552,17 +557,17 @@ def showcalculationPDB(request):
         return render(request, 'mutation/designpdb.html', context)
 
 
-@cache_page(60 * 60 * 24 *7)
+@release_cache_page()
 def coverage(request):
 
     context = {}
 
     #gpcr_class = '004' #class a
 
-    families = ProteinFamily.objects.all()
+    tree = FamilyTree.get()
     lookup = {}
-    for f in families:
-        lookup[f.slug] = f.name.replace("receptors","")
+    for slug, name in zip(tree.slugs, tree.names):
+        lookup[slug] = name.replace("receptors","")
 
     class_proteins = Protein.objects.filter(family__slug__startswith="00", source__name='SWISSPROT').prefetch_related('family').order_by('family__slug')
     print("time 1")
@@ -1111,9 +1116,11 @@ def showcalculation(request):
 
 
     #Consider caching result! Would be by protein since it compares protein to whole class.
-    json_generic = str(context['proteins'][0])+'_generic.json'
-    json_alternative = str(context['proteins'][0])+'_alternative.json'
-    json_similarity_list = str(context['proteins'][0])+'_similarity_list.json'
+    # cached alignments are invalidated by a new data release
+    cache_prefix = release_stamp()+'_'+str(context['proteins'][0])
+    json_generic = cache_prefix+'_generic.json'
+    json_alternative = cache_prefix+'_alternative.json'
+    json_similarity_list = cache_prefix+'_similarity_list.json'
 
 
     generic_aa_count = cache.get(json_generic)
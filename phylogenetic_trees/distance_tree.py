@@ -0,0 +1,112 @@
+from common.alignment_matrix import GAP_CODE
+
+import numpy as np
+
+
+class UndefinedDistance(Exception):
+    pass
+
+
+def kimura_distances(matrix):
+    """Protein distances between all rows of an AlignmentMatrix, with the Kimura formula (as PHYLIP protdist with the
+        Kimura model), D = -ln(1 - p - 0.2 p^2), where p is the fraction of differing residues among the positions
+        where both proteins have a residue. Raises UndefinedDistance if the formula is undefined for any pair (as
+        protdist, which does not report a distance for them)"""
+    codes = matrix.codes
+    residues = codes < GAP_CODE
+    num_rows = codes.shape[0]
+    p = np.zeros((num_rows, num_rows))
+    for i in range(num_rows):
+        both = residues[i] & residues
+        compared = both.sum(axis=1)
+        identical = ((codes[i] == codes) & both).sum(axis=1)
+        p[i] = 1 - identical / np.maximum(compared, 1)
+        p[i, compared == 0] = 1
+
+    # the formula is defined for p < 0.8541
+    remaining = 1 - p - 0.2 * p**2
+    undefined = remaining <= 0
+    np.fill_diagonal(undefined, False)
+    if undefined.any():
+        raise UndefinedDistance('{} protein pairs are too distant for the Kimura formula'.format(
+            int(undefined.sum() // 2)))
+    distances = -np.log(np.maximum(remaining, np.finfo(np.float64).tiny))
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def newick_length(length):
+    return '{:.5f}'.format(length)
+
+
+def neighbor_joining(distances, names):
+    """Neighbor-joining tree of a distance matrix, as an unrooted Newick tree with a trifurcation at the base"""
+    d = np.array(distances, dtype=np.float64)
+    nodes = list(names)
+    while len(nodes) > 3:
+        n = len(nodes)
+        r = d.sum(axis=1)
+        q = (n - 2) * d - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        if i > j:
+            i, j = j, i
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (n - 2))
+        length_j = d[i, j] - length_i
+
+        # distances from the new node to the others, which replaces i (and j is removed)
+        new_distances = 0.5 * (d[i] + d[j] - d[i, j])
+        d[i] = new_distances
+        d[:, i] = new_distances
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        nodes[i] = '({}:{},{}:{})'.format(nodes[i], newick_length(length_i), nodes[j], newick_length(length_j))
+        del nodes[j]
+
+    if len(nodes) == 3:
+        lengths = [(d[0, 1] + d[0, 2] - d[1, 2]) / 2, (d[0, 1] + d[1, 2] - d[0, 2]) / 2,
+            (d[0, 2] + d[1, 2] - d[0, 1]) / 2]
+    else:
+        lengths = [d[0, 1] / 2] * 2 if len(nodes) == 2 else [0]
+    return '(' + ','.join(['{}:{}'.format(node, newick_length(l)) for node, l in zip(nodes, lengths)]) + ');'
+
+
+def upgma(distances, names):
+    """UPGMA tree of a distance matrix, as a rooted Newick tree"""
+    d = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(d, np.inf)
+    nodes = list(names)
+    sizes = [1] * len(nodes)
+    heights = [0.0] * len(nodes)
+    while len(nodes) > 1:
+        i, j = np.unravel_index(np.argmin(d), d.shape)
+        if i > j:
+            i, j = j, i
+        height = d[i, j] / 2
+
+        # size weighted average distances from the new cluster, which replaces i (and j is removed)
+        new_distances = (d[i] * sizes[i] + d[j] * sizes[j]) / (sizes[i] + sizes[j])
+        d[i] = new_distances
+        d[:, i] = new_distances
+        d[i, i] = np.inf
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        nodes[i] = '({}:{},{}:{})'.format(nodes[i], newick_length(height - heights[i]), nodes[j],
+            newick_length(height - heights[j]))
+        sizes[i] += sizes[j]
+        heights[i] = height
+        del nodes[j], sizes[j], heights[j]
+    return nodes[0] + ';'
+
+
+def build_tree(matrix, names, use_upgma=False):
+    """Build a tree from an AlignmentMatrix (rows named by names), in the same form as phylip.build_tree (the Newick
+        tree and an output file)"""
+    distances = kimura_distances(matrix)
+    if use_upgma:
+        tree = upgma(distances, names)
+        method = 'UPGMA method'
+    else:
+        tree = neighbor_joining(distances, names)
+        method = 'Neighbor-Joining method'
+    outfile = '\n{}, distances calculated with the Kimura formula\n\n{}\n'.format(method, tree)
+    return tree + '\n', outfile
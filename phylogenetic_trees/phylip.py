@@ -0,0 +1,247 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger('protwis')
+
+# lines that start a data set in a PHYLIP sequence file (number of sequences and number of positions)
+DATA_SET_HEADER = re.compile(r'^\s*\d+\s+\d+\s*$')
+
+
+class PhylipError(Exception):
+    pass
+
+
+def run_program(program, options, cwd, timeout):
+    """Run a PHYLIP program in cwd, answering its menu with a list of options. The program is started in a new
+        session, so that it can be killed with all of its child processes if it does not finish in time"""
+    p = subprocess.Popen(['phylip', program], cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        out, err = p.communicate(('\n'.join(options) + '\n').encode('ascii'), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.communicate()
+        raise PhylipError('phylip {} did not finish within {} seconds'.format(program, timeout))
+    if p.returncode != 0:
+        raise PhylipError('phylip {} failed: {}'.format(program, out.decode('ascii', 'replace')[-1000:]))
+
+
+def split_data_sets(text, num_parts):
+    """Split a file with multiple data sets (e.g. bootstrap replicates from seqboot) into at most num_parts files with
+        consecutive data sets. Returns a list of (file content, number of data sets) tuples"""
+    data_sets = []
+    for line in text.splitlines(True):
+        if DATA_SET_HEADER.match(line) or not data_sets:
+            data_sets.append([])
+        data_sets[-1].append(line)
+
+    num_parts = max(1, min(num_parts, len(data_sets)))
+    parts = []
+    start = 0
+    for i in range(num_parts):
+        end = start + (len(data_sets) - start) // (num_parts - i)
+        parts.append((''.join([''.join(d) for d in data_sets[start:end]]), end - start))
+        start = end
+    return parts
+
+
+def tree_key(infile, bootstrap, upgma):
+    """Cache key (and job id) of a tree, from the alignment in PHYLIP format and the tree options"""
+    return hashlib.sha1('{}\n{}\n{}'.format(infile, bootstrap, upgma).encode('utf-8')).hexdigest()
+
+
+def build_tree(infile, bootstrap, upgma, progress=None):
+    """Build a tree from an alignment in PHYLIP format, with PHYLIP protdist and neighbor (and seqboot and consense
+        for bootstrapped trees). Bootstrap replicates are split into PHYLIP_WORKERS parts, which are processed at the
+        same time. Returns the tree (Newick) and the PHYLIP output file
+
+        progress is called with the number of completed and total steps"""
+    timeout = getattr(settings, 'PHYLIP_TIMEOUT', 600)
+    workers = getattr(settings, 'PHYLIP_WORKERS', os.cpu_count() or 1)
+    dirname = tempfile.mkdtemp(prefix='phylip_')
+    try:
+        with open(os.path.join(dirname, 'infile'), 'w') as f:
+            f.write(infile)
+
+        if not bootstrap:
+            steps = [0, 2]
+            run_program('protdist', ['y'], dirname, timeout)
+            step_done(progress, steps)
+            os.replace(os.path.join(dirname, 'outfile'), os.path.join(dirname, 'infile'))
+            run_program('neighbor', (['N'] if upgma else []) + ['y'], dirname, timeout)
+            step_done(progress, steps)
+            with open(os.path.join(dirname, 'outtree')) as f:
+                outtree = f.read()
+            with open(os.path.join(dirname, 'outfile')) as f:
+                outfile = f.read()
+            return outtree, outfile
+
+        # bootstrap replicates
+        steps = [0, 3]
+        run_program('seqboot', ['r', str(bootstrap), 'y', '77', 'y'], dirname, timeout)
+        step_done(progress, steps)
+        with open(os.path.join(dirname, 'outfile')) as f:
+            parts = split_data_sets(f.read(), workers)
+        steps[1] += len(parts) - 1
+
+        # distances and trees for each part of the replicates
+        def run_part(i, part):
+            part_dir = os.path.join(dirname, 'part{}'.format(i))
+            os.mkdir(part_dir)
+            with open(os.path.join(part_dir, 'infile'), 'w') as f:
+                f.write(part[0])
+            run_program('protdist', ['m', 'd', str(part[1]), 'y'], part_dir, timeout)
+            os.replace(os.path.join(part_dir, 'outfile'), os.path.join(part_dir, 'infile'))
+            run_program('neighbor', (['N'] if upgma else []) + ['m', str(part[1]), '111', 'y'], part_dir, timeout)
+            with open(os.path.join(part_dir, 'outtree')) as f:
+                return f.read()
+
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            futures = [executor.submit(run_part, i, part) for i, part in enumerate(parts)]
+            trees = []
+            for future in futures:
+                trees.append(future.result())
+                step_done(progress, steps)
+
+        # consensus tree
+        for name in ('intree', 'outfile', 'outtree'):
+            if os.path.exists(os.path.join(dirname, name)):
+                os.remove(os.path.join(dirname, name))
+        with open(os.path.join(dirname, 'intree'), 'w') as f:
+            f.write(''.join(trees))
+        run_program('consense', ['y'], dirname, timeout)
+        step_done(progress, steps)
+        with open(os.path.join(dirname, 'outtree')) as f:
+            outtree = f.read()
+        with open(os.path.join(dirname, 'outfile')) as f:
+            outfile = f.read()
+        return outtree, outfile
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
+def step_done(progress, steps):
+    steps[0] += 1
+    if progress:
+        progress(steps[0], steps[1])
+
+
+class TreeJobs:
+    """A queue of tree building jobs, run in background threads of the web process, so that large (bootstrapped)
+        trees do not block the request. Jobs are identified by the tree key (see tree_key), so the same tree is only
+        built once, and job status and finished trees are kept in the cache, where any worker process can read them
+
+        The status of a job is a dict with a state ('queued', 'running', 'done', 'failed' or 'lost') and the number of
+        completed and total steps. The process that runs a job sends a heartbeat for it every heartbeat_interval
+        seconds while it is queued or running, and a job without a recent heartbeat is lost (e.g. its worker process
+        was restarted). Lost jobs are submitted again by submit
+
+        Jobs run in threads of the web worker process that submitted them, and PHYLIP_JOBS (the number of jobs run at
+        the same time) applies to each worker process, not to the host. PHYLIP programs run in their own processes,
+        but they are killed when the worker is recycled, so a job may have to be submitted again"""
+
+    executor = None
+    cache_timeout = 60*60*24*7
+
+    # jobs of this process that are queued or running, and the interval (in seconds) of their heartbeats
+    active = set()
+    heartbeat_interval = 15
+
+    @classmethod
+    def get_executor(cls):
+        if cls.executor is None:
+            # number of jobs run at the same time by this worker process (see above)
+            cls.executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PHYLIP_JOBS', 2))
+            threading.Thread(target=cls.send_heartbeats, daemon=True).start()
+        return cls.executor
+
+    @staticmethod
+    def tree_cache_key(job_id):
+        return 'phylip_tree_' + job_id
+
+    @staticmethod
+    def status_cache_key(job_id):
+        return 'phylip_job_' + job_id
+
+    @staticmethod
+    def heartbeat_cache_key(job_id):
+        return 'phylip_heartbeat_' + job_id
+
+    @classmethod
+    def submit(cls, infile, bootstrap, upgma):
+        """Start building a tree, unless it has been built, or is being built, already. Returns the job id"""
+        job_id = tree_key(infile, bootstrap, upgma)
+        status = cls.status(job_id)
+        if status['state'] in ('queued', 'running', 'done'):
+            return job_id
+
+        executor = cls.get_executor()
+        cls.active.add(job_id)
+        cls.heartbeat(job_id)
+        cls.set_status(job_id, 'queued')
+        executor.submit(cls.run, job_id, infile, bootstrap, upgma)
+        return job_id
+
+    @classmethod
+    def run(cls, job_id, infile, bootstrap, upgma):
+        cls.set_status(job_id, 'running')
+        try:
+            tree = build_tree(infile, bootstrap, upgma,
+                progress=lambda done, total: cls.set_status(job_id, 'running', done, total))
+        except Exception as msg:
+            logger.error('Failed building tree {}: {}'.format(job_id, msg))
+            cls.set_status(job_id, 'failed')
+            return
+        finally:
+            cls.active.discard(job_id)
+        cache.set(cls.tree_cache_key(job_id), tree, cls.cache_timeout)
+        cls.set_status(job_id, 'done')
+
+    @classmethod
+    def send_heartbeats(cls):
+        while True:
+            for job_id in list(cls.active):
+                cls.heartbeat(job_id)
+            time.sleep(cls.heartbeat_interval)
+
+    @classmethod
+    def heartbeat(cls, job_id):
+        cache.set(cls.heartbeat_cache_key(job_id), time.time(), cls.cache_timeout)
+
+    @classmethod
+    def set_status(cls, job_id, state, done=0, total=0):
+        cache.set(cls.status_cache_key(job_id), {'state': state, 'done': done, 'total': total}, cls.cache_timeout)
+
+    @classmethod
+    def status(cls, job_id):
+        if cache.get(cls.tree_cache_key(job_id)) is not None:
+            return {'state': 'done', 'done': 0, 'total': 0}
+        status = cache.get(cls.status_cache_key(job_id))
+        if status is None or status['state'] == 'done': # the tree has been removed from the cache
+            return {'state': 'unknown', 'done': 0, 'total': 0}
+
+        # a queued or running job is lost when the process that runs it has stopped sending heartbeats. Queued jobs
+        # wait for as long as their process is alive, and running steps are limited by PHYLIP_TIMEOUT (see run_program)
+        if status['state'] in ('queued', 'running'):
+            heartbeat = cache.get(cls.heartbeat_cache_key(job_id)) or 0
+            if time.time() - heartbeat > 4 * cls.heartbeat_interval:
+                status['state'] = 'lost'
+        return status
+
+    @classmethod
+    def result(cls, job_id):
+        """The tree and PHYLIP output file of a finished job, or None"""
+        return cache.get(cls.tree_cache_key(job_id))
@@ -8,6 +8,7 @@ urlpatterns = [
     url(r'^segmentselection', views.SegmentSelection.as_view(), name='segmentselection'),
     url(r'^treesettings', views.TreeSettings.as_view(), name='treesettings'),
     url(r'^render', views.render_tree, name='render'),
+    url(r'^tree_status', views.tree_status, name='tree_status'),
     url(r'^showrings', views.modify_tree, name='render'),
     url(r'^get_buttons', views.get_buttons, name='render'),
 
@@ -1,4 +1,5 @@
 ﻿from django.shortcuts import render
+from django.http import JsonResponse
 from django.conf import settings
 from django.core.files import File
 from protein.models import ProteinFamily, ProteinAlias, ProteinSet, Protein, ProteinSegment
@@ -8,20 +9,17 @@ from common.views import AbsMiscSelection
 from common.selection import SelectionItem
 from mutation.models import *
 import math
-import os, shutil, subprocess, signal
-import uuid
+import os, shutil, tempfile
+import logging
 from phylogenetic_trees.PrepareTree import *
+from phylogenetic_trees.phylip import PhylipError, TreeJobs, build_tree, tree_key
+from phylogenetic_trees import distance_tree
 from collections import OrderedDict
 
+logger = logging.getLogger('protwis')
+
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
-def kill_phylo(): #FIXME, needs better way of handling this!
-    p = subprocess.Popen(['ps', '-A'], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    for line in out.splitlines():
-        if 'protdist' in str(line):
-            pid = int(line.split(None, 1)[0])
-            os.kill(pid, signal.SIGKILL)
 
 class TargetSelection(AbsTargetSelection):
     step = 1
@@ -96,9 +94,13 @@ class Treeclass:
         self.phylip = None
         self.outtree = None
         self.dir = ''
+        self.job_id = None
+        self.tree = None
 
 
-    def Prepare_file(self, request,build=False):
+    def prepare_input(self, request, build=False):
+        """Build the alignment of the selected proteins and write it in PHYLIP format (self.infile). Returns an error
+            tuple if there are too few proteins"""
         self.Tree = PrepareTree(build)
         a=Alignment()
 
@@ -154,14 +156,12 @@ class Treeclass:
         self.famdict = {}
         for n in families:
             self.famdict[self.Tree.trans_0_2_A(n.slug)]=n.name
-        dirname = unique_filename = uuid.uuid4()
-        os.mkdir('/tmp/%s' %dirname)
-        infile = open('/tmp/%s/infile' %dirname,'w')
-        infile.write('    '+str(self.total)+'    '+str(total_length)+'\n')
+        infile = ['    '+str(self.total)+'    '+str(total_length)+'\n']
         if len(a.proteins) < 3:
             return 'More_prots',None, None, None, None,None,None,None
         ####Get additional protein information
-        accesions = {}
+        self.accesions = {}
+        names = []
         for n in a.proteins:
             fam = self.Tree.trans_0_2_A(n.protein.family.slug)
             if n.protein.sequence_type.slug == 'consensus':
@@ -184,83 +184,51 @@ class Treeclass:
             if len(name)>25:
                 name=name[:25]+'...'
             self.family[entry_name] = {'name':name,'family':fam,'description':desc,'species':spec,'class':'','accession':acc,'ligand':'','type':'','link': entry_name}
-            accesions[acc]=entry_name
+            self.accesions[acc]=entry_name
+            names.append(acc)
             ####Write PHYLIP input
             sequence = ''
             for chain in n.alignment:
                 for residue in n.alignment[chain]:
                     sequence += residue[2].replace('_','-')
-            infile.write(acc+' '*9+sequence+'\n')
-        infile.close()
-        
-        ####Run bootstrap
-        if self.bootstrap:
-        ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('\n'.join(['r',str(self.bootstrap),'y','77','y'])+'\n')
-            inp.close()
-        ###
+            infile.append(acc+' '*9+sequence+'\n')
+        self.infile = ''.join(infile)
+
+        # with PHYLOGENY_BACKEND set to 'native', trees without bootstrap are built in-process from the alignment
+        # matrix (see distance_tree). Its Kimura distances differ from the JTT distances of protdist, so PHYLIP is the
+        # default. Alignments with distances that the Kimura formula does not define are built with PHYLIP
+        self.tree = None
+        if not self.bootstrap and getattr(settings, 'PHYLOGENY_BACKEND', 'phylip') == 'native':
             try:
-                subprocess.check_output(['phylip seqboot<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-                os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
-                return "too big","too big","too big","too big","too big","too big","too big","too big"
+                self.tree = distance_tree.build_tree(a.alignment_matrix or a.build_alignment_matrix(), names,
+                    self.UPGMA)
+            except distance_tree.UndefinedDistance as msg:
+                logger.info('Building tree with PHYLIP: {}'.format(msg))
 
-        ### Write phylip input options
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-            inp.write('\n'.join(['m','d',str(self.bootstrap),'y'])+'\n')
-        else:
-            inp.write('y\n')
-        inp.close()
-        ###
-        try:
-            subprocess.check_output(['phylip protdist<temp>>log'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big"
-        os.rename('/tmp/%s/infile' %dirname, '/tmp/%s/dupa' %dirname)
-        os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-        ### Write phylip input options
-            if self.UPGMA:
-                inp.write('\n'.join(['N','m',str(self.bootstrap),'111','y'])+'\n')
-            else:
-                inp.write('\n'.join(['m',str(self.bootstrap),'111','y'])+'\n')
-        else:
-            if self.UPGMA:
-                inp.write('N\ny\n')
-            else:
-                inp.write('y\n')
-        inp.close()
-        ###
-        try: 
-            subprocess.check_output(['phylip neighbor<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big"
-        if self.bootstrap:
-            os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            os.rename('/tmp/%s/outtree' %dirname, '/tmp/%s/intree' %dirname)
-           ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('y\n')
-            inp.close()
-        ###
+    def Prepare_file(self, request,build=False):
+        """Build the alignment and the tree of the selected proteins (or of a class, when building statistics)"""
+        error = self.prepare_input(request, build)
+        if error:
+            return error
+        tree = self.tree or TreeJobs.result(tree_key(self.infile, self.bootstrap, self.UPGMA))
+        if tree is None:
             try:
-                subprocess.check_output(['phylip consense<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
+                tree = build_tree(self.infile, self.bootstrap, self.UPGMA)
+            except PhylipError as msg:
+                logger.error('Failed building tree: {}'.format(msg))
                 return "too big","too big","too big","too big","too big","too big","too big","too big"
-        self.phylip = open('/tmp/%s/outtree' %dirname).read()
-        for acc in accesions.keys():
-            self.phylip=self.phylip.replace(acc,accesions[acc])
+        return self.finish(tree, build)
+
+    def finish(self, tree, build=False):
+        """Prepare the tree (Newick) and PHYLIP output file for display"""
+        self.phylip = tree[0]
+        for acc in self.accesions.keys():
+            self.phylip=self.phylip.replace(acc,self.accesions[acc])
 #        self.phylogeny_output = self.phylip
-        self.outtree = open('/tmp/%s/outfile' %dirname).read().lstrip()
-        phylogeny_input = self.get_phylogeny('/tmp/%s/' %dirname)
-        shutil.rmtree('/tmp/%s' %dirname)
+        self.outtree = tree[1].lstrip()
+        dirname = tempfile.mkdtemp()
+        phylogeny_input = self.get_phylogeny(dirname)
+        shutil.rmtree(dirname)
         
         if build != False:
             open('static/home/images/'+build+'_legend.svg','w').write(str(self.Tree.legend))
@@ -308,13 +276,28 @@ def modify_tree(request):
     return render(request, 'phylogenetic_trees/main.html', {'phylo': phylogeny_input, 'branch':branches, 'ttype': ttype, 'count':count, 'leg':legend, 'b':box, 'add':Additional_info, 'but':buttons, 'phylip':Tree_class.phylip, 'outtree':Tree_class.outtree})
 
 def render_tree(request):
-    Tree_class=Treeclass()
-    phylogeny_input, branches, ttype, total, legend, box, Additional_info, buttons=Tree_class.Prepare_file(request)
-    if phylogeny_input == 'too big':
-        return render(request, 'phylogenetic_trees/too_big.html')
+    """Builds the tree of the selected proteins. Trees are built in the background (see TreeJobs), and while a tree is
+        being built, a page that polls tree_status is shown, which reloads this view with the job id when it is done"""
+    job_id = request.GET.get('job')
+    if job_id:
+        Tree_class = request.session.get('Tree')
+        tree = TreeJobs.result(job_id)
+        if Tree_class is None or tree is None or Tree_class.job_id != job_id:
+            return render(request, 'phylogenetic_trees/too_big.html')
+    else:
+        Tree_class=Treeclass()
+        error = Tree_class.prepare_input(request)
+        if error:
+            return render(request, 'phylogenetic_trees/warning.html')
+        tree = Tree_class.tree
+        if tree is None:
+            job_id = Tree_class.job_id = TreeJobs.submit(Tree_class.infile, Tree_class.bootstrap, Tree_class.UPGMA)
+            tree = TreeJobs.result(job_id)
+        if tree is None:
+            request.session['Tree']=Tree_class
+            return render(request, 'phylogenetic_trees/building.html', {'job_id': job_id})
 
-    if phylogeny_input == 'More_prots':
-        return render(request, 'phylogenetic_trees/warning.html')
+    phylogeny_input, branches, ttype, total, legend, box, Additional_info, buttons=Tree_class.finish(tree)
     
     if ttype == '1':
         float(total)/4*100
@@ -324,4 +307,16 @@ def render_tree(request):
     request.session['Tree']=Tree_class
     return render(request, 'phylogenetic_trees/alignment.html', {'phylo': phylogeny_input, 'branch':branches, 'ttype': ttype, 'count':count, 'leg':legend, 'b':box, 'add':Additional_info, 'but':buttons, 'phylip':Tree_class.phylip, 'outtree':Tree_class.outtree })
 
-
+def tree_status(request):
+    """Returns the status of a tree building job as JSON. A lost job (e.g. its worker process was restarted) is
+        submitted again, if it is the tree of this session"""
+    job_id = request.GET['job']
+    status = TreeJobs.status(job_id)
+    if status['state'] == 'lost':
+        Tree_class = request.session.get('Tree')
+        if Tree_class is not None and getattr(Tree_class, 'job_id', None) == job_id:
+            TreeJobs.submit(Tree_class.infile, Tree_class.bootstrap, Tree_class.UPGMA)
+            status = TreeJobs.status(job_id)
+        else:
+            status['state'] = 'failed'
+    return JsonResponse(status)
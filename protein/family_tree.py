@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from common.release_cache import current_release
+from protein.models import Protein, ProteinFamily
+
+import time
+import numpy as np
+
+
+class FamilyTree:
+    """An in-memory index of the protein family tree, used to answer family navigation questions (children, ancestors,
+        all proteins under a family, the class of a protein) without walking ProteinFamily.parent one query at a time
+
+        Families are numbered in depth-first order (children sorted by slug), so that the descendants of a family are
+        the nodes from the family to subtree_end, and proteins are sorted in the same order, so that the proteins under
+        a family are one contiguous slice of protein_ids. The index is plain arrays, lists and dicts, and is shared
+        through the cache (see FamilyTree.get)"""
+
+    # the tree used by this process, see get
+    _shared = {'tree': None, 'key': None, 'checked': 0}
+
+    def __init__(self, families, proteins):
+        """families is a list of (id, parent id, slug, name) tuples, and proteins a list of (id, family id) tuples"""
+        children = {}
+        for family in sorted(families, key=lambda f: f[2]):
+            children.setdefault(family[1], []).append(family)
+
+        # depth first order, starting at the root(s)
+        order = []
+        stack = list(reversed(children.get(None, [])))
+        while stack:
+            family = stack.pop()
+            order.append(family)
+            stack.extend(reversed(children.get(family[0], [])))
+
+        num_nodes = len(order)
+        self.family_ids = np.array([f[0] for f in order], dtype=np.int64)
+        self.slugs = [f[2] for f in order]
+        self.names = [f[3] for f in order]
+        self.index_by_id = {f[0]: i for i, f in enumerate(order)}
+        self.index_by_slug = {f[2]: i for i, f in enumerate(order)}
+        self.parents = np.array([self.index_by_id.get(f[1], -1) for f in order], dtype=np.int64)
+        self.children = [[] for i in range(num_nodes)]
+        self.depths = np.zeros(num_nodes, dtype=np.int64)
+        for i in range(num_nodes):
+            if self.parents[i] >= 0:
+                self.children[self.parents[i]].append(i)
+                self.depths[i] = self.depths[self.parents[i]] + 1
+
+        # end (exclusive) of the subtree of each node in the depth first order
+        self.subtree_end = np.arange(1, num_nodes + 1, dtype=np.int64)
+        for i in range(num_nodes - 1, -1, -1):
+            if self.parents[i] >= 0:
+                self.subtree_end[self.parents[i]] = max(self.subtree_end[self.parents[i]], self.subtree_end[i])
+
+        # ancestors of each node at each depth (-1 below the depth of the node)
+        max_depth = int(self.depths.max()) if num_nodes else 0
+        self.ancestors = np.full((num_nodes, max_depth + 1), -1, dtype=np.int64)
+        for i in range(num_nodes):
+            if self.parents[i] >= 0:
+                self.ancestors[i] = self.ancestors[self.parents[i]]
+            self.ancestors[i, self.depths[i]] = i
+
+        # proteins sorted by the position of their family in the tree
+        proteins = sorted([(self.index_by_id[p[1]], p[0]) for p in proteins if p[1] in self.index_by_id])
+        protein_nodes = np.array([p[0] for p in proteins], dtype=np.int64)
+        self.protein_ids = np.array([p[1] for p in proteins], dtype=np.int64)
+        self.protein_start = np.searchsorted(protein_nodes, np.arange(num_nodes + 1))
+        self.node_by_protein = {p[1]: p[0] for p in proteins}
+
+    @classmethod
+    def build(cls):
+        return cls(list(ProteinFamily.objects.values_list('id', 'parent_id', 'slug', 'name')),
+            list(Protein.objects.values_list('id', 'family_id')))
+
+    @staticmethod
+    def signature():
+        """A summary of the family and protein tables, used to detect that a cached tree is out of date (e.g. while
+            the database is being built)"""
+        families = ProteinFamily.objects.aggregate(Count('id'), Max('id'))
+        proteins = Protein.objects.aggregate(Count('id'), Max('id'))
+        return (families['id__count'], families['id__max'], proteins['id__count'], proteins['id__max'])
+
+    @classmethod
+    def get(cls):
+        """Returns the family tree of the current data release. The tree is built once per release and shared by all
+            processes through the cache. Each process checks at most once per FAMILY_TREE_TIMEOUT seconds that its
+            tree is up to date"""
+        timeout = getattr(settings, 'FAMILY_TREE_TIMEOUT', 60)
+        shared = cls._shared
+        now = time.time()
+        if shared['tree'] is not None and now - shared['checked'] <= timeout:
+            return shared['tree']
+
+        key = 'family_tree_{}_{}'.format(current_release(), '_'.join([str(s) for s in cls.signature()]))
+        if key != shared['key']:
+            tree = cache.get(key)
+            if tree is None:
+                tree = cls.build()
+                cache.set(key, tree, 60*60*24*7)
+            shared['tree'] = tree
+            shared['key'] = key
+        shared['checked'] = now
+        return shared['tree']
+
+    def index(self, family):
+        """Node index of a family, given as a ProteinFamily, id or slug (None if the family is not in the tree)"""
+        if isinstance(family, str):
+            return self.index_by_slug.get(family)
+        if isinstance(family, ProteinFamily):
+            family = family.id
+        return self.index_by_id.get(family)
+
+    def __contains__(self, family):
+        return self.index(family) is not None
+
+    def children_ids(self, family):
+        return [int(self.family_ids[i]) for i in self.children[self.index(family)]]
+
+    def descendant_ids(self, family):
+        """Ids of a family and all families below it"""
+        i = self.index(family)
+        return self.family_ids[i:self.subtree_end[i]]
+
+    def protein_ids_under(self, family):
+        """Ids of all proteins in a family and the families below it"""
+        i = self.index(family)
+        return self.protein_ids[self.protein_start[i]:self.protein_start[self.subtree_end[i]]]
+
+    def ancestor(self, family, depth):
+        """Node index of the ancestor of a family at a depth (the root is at depth 0), None if there is none"""
+        i = self.index(family)
+        if i is None or depth >= self.ancestors.shape[1] or self.ancestors[i, depth] < 0:
+            return None
+        return int(self.ancestors[i, depth])
+
+    def ancestor_name(self, family, depth):
+        i = self.ancestor(family, depth)
+        return self.names[i] if i is not None else None
+
+    def protein_class(self, protein_id):
+        """Name of the class (the family at depth 1) of a protein, None if the protein is not in the tree"""
+        i = self.node_by_protein.get(protein_id)
+        if i is None or self.ancestors.shape[1] < 2 or self.ancestors[i, 1] < 0:
+            return None
+        return self.names[self.ancestors[i, 1]]
@@ -29,6 +29,11 @@ class Protein(models.Model):
         db_table = 'protein'
 
     def get_protein_class(self):
+        from protein.family_tree import FamilyTree # imported here, as family_tree imports this module
+
+        name = FamilyTree.get().ancestor_name(self.family_id, 1)
+        if name is not None:
+            return name
         tmp = self.family
         while tmp.parent.parent is not None:
             tmp = tmp.parent
@@ -51,6 +56,11 @@ class Protein(models.Model):
         return DrawGproteinPlot(residuelist,self.get_protein_class(),str(self))
 
     def get_protein_family(self):
+        from protein.family_tree import FamilyTree
+
+        name = FamilyTree.get().ancestor_name(self.family_id, 2)
+        if name is not None:
+            return name
         tmp = self.family
         while tmp.parent.parent.parent is not None:
             tmp = tmp.parent
@@ -93,7 +93,7 @@ MEDIA_ROOT = '/protwis/media/protwis'
 
 # Serializer
 
-SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
+SESSION_SERIALIZER = 'common.session_serializer.SelectionSerializer'
 
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH' : False,
@@ -184,7 +184,11 @@ if DEBUG:
 #CACHE
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache_backends.ShardedSQLiteCache',
         'LOCATION': '/tmp/django_cache',
+        'OPTIONS': {
+            'SHARDS': 8,
+            'MAX_BYTES': 2 * 1024**3, # 2 GB
+        },
     }
 }
\ No newline at end of file
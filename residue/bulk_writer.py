@@ -0,0 +1,183 @@
+from django.db import connection, transaction, OperationalError
+
+from residue.generic_number_registry import GenericNumberRegistry
+from residue.models import Residue
+
+from collections import OrderedDict
+from io import StringIO
+import logging
+import time
+
+
+# columns of the residue table that are written (besides the id)
+RESIDUE_FIELDS = ['protein_conformation_id', 'protein_segment_id', 'generic_number_id', 'display_generic_number_id',
+    'sequence_number', 'amino_acid']
+
+
+def copy_value(value):
+    """A value in PostgreSQL COPY text format"""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class ResidueWriter:
+    """Writes residues and their alternative generic numbers in large batches, with PostgreSQL COPY (bulk_create on
+        other databases)
+
+        Residues (unsaved Residue objects) are collected with add, and written by flush, in one transaction, which is
+        retried if it fails on a database error (e.g. a deadlock with another build process). Callers flush at the end
+        of a chunk of proteins, or call checkpoint after each protein, which flushes when batch_size residues have been
+        collected, so that the residues of a protein are always written together
+
+        With update=True, residues that exist already (same protein conformation and sequence number) are updated, and
+        their alternative generic numbers replaced, as with update_or_create. Otherwise all residues are inserted. The
+        ids of the written residues are set on the Residue objects"""
+
+    def __init__(self, update=False, batch_size=50000, retries=3, logger=None):
+        self.update = update
+        self.batch_size = batch_size
+        self.retries = retries
+        self.logger = logger or logging.getLogger('build')
+        self.residues = []
+        self.alternative_numbers = []
+
+        # totals, for report
+        self.rows = 0
+        self.seconds = 0
+
+        through = Residue.alternative_generic_numbers.through
+        self.through = through
+        self.through_table = through._meta.db_table
+        self.through_residue_column = through._meta.get_field('residue').column
+        self.through_number_column = through._meta.get_field('residuegenericnumber').column
+
+    def add(self, residue, alternative_generic_numbers=()):
+        """Add a residue, with the ids (or generic number registry keys) of its alternative generic numbers"""
+        self.residues.append(residue)
+        self.alternative_numbers.append(list(alternative_generic_numbers))
+
+    def checkpoint(self):
+        if len(self.residues) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.residues:
+            return
+
+        # new generic numbers must exist before residues can refer to them
+        registry = GenericNumberRegistry.get()
+        registry.flush()
+        alternative_numbers = [[registry.id(n) if isinstance(n, tuple) else n for n in numbers]
+            for numbers in self.alternative_numbers]
+        residues = self.residues
+        if self.update:
+            # a residue that was added more than once is written once, with the last values (as with update_or_create)
+            last = OrderedDict()
+            for residue, numbers in zip(residues, alternative_numbers):
+                key = (residue.protein_conformation_id, residue.sequence_number)
+                last.pop(key, None)
+                last[key] = (residue, numbers)
+            residues = [v[0] for v in last.values()]
+            alternative_numbers = [v[1] for v in last.values()]
+
+        start = time.time()
+        for attempt in range(1, self.retries + 2):
+            try:
+                with transaction.atomic():
+                    rows = self.write(residues, alternative_numbers)
+                break
+            except OperationalError as msg:
+                for residue in residues:
+                    residue.pk = None
+                if attempt > self.retries:
+                    raise
+                self.logger.warning('Writing {} residues failed (attempt {}), retrying: {}'.format(
+                    len(self.residues), attempt, msg))
+                time.sleep(attempt)
+
+        self.rows += rows
+        self.seconds += time.time() - start
+        self.residues = []
+        self.alternative_numbers = []
+
+    def write(self, residues, alternative_numbers):
+        """Write residues in the current transaction. Returns the number of rows written"""
+        if connection.vendor != 'postgresql':
+            return self.write_orm(residues, alternative_numbers)
+
+        with connection.cursor() as cursor:
+            # existing residues, which are updated instead of inserted
+            existing = {}
+            if self.update:
+                cursor.execute('SELECT id, protein_conformation_id, sequence_number FROM {} '
+                    'WHERE protein_conformation_id = ANY(%s)'.format(Residue._meta.db_table),
+                    [list(set([r.protein_conformation_id for r in residues]))])
+                for residue_id, pconf_id, sequence_number in cursor.fetchall():
+                    existing[(pconf_id, sequence_number)] = residue_id
+
+            new = []
+            updated = []
+            for residue in residues:
+                residue_id = existing.get((residue.protein_conformation_id, residue.sequence_number))
+                if residue_id:
+                    residue.pk = residue_id
+                    updated.append(residue)
+                else:
+                    new.append(residue)
+
+            # ids for the new residues, so that the alternative generic numbers can be written without reading the
+            # residues back
+            if new:
+                cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [Residue._meta.db_table, len(new)])
+                for residue, (residue_id,) in zip(new, cursor.fetchall()):
+                    residue.pk = residue_id
+                self.copy(cursor, Residue._meta.db_table, ['id'] + RESIDUE_FIELDS,
+                    [[r.pk] + [getattr(r, f) for f in RESIDUE_FIELDS] for r in new])
+
+            if updated:
+                cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS residue_update (id integer, '
+                    'protein_segment_id integer, generic_number_id integer, display_generic_number_id integer, '
+                    'amino_acid varchar(1)) ON COMMIT DELETE ROWS')
+                columns = ['id', 'protein_segment_id', 'generic_number_id', 'display_generic_number_id', 'amino_acid']
+                self.copy(cursor, 'residue_update', columns, [[getattr(r, c) for c in columns] for r in updated])
+                cursor.execute('UPDATE {} r SET protein_segment_id = u.protein_segment_id, generic_number_id = '
+                    'u.generic_number_id, display_generic_number_id = u.display_generic_number_id, amino_acid = '
+                    'u.amino_acid FROM residue_update u WHERE r.id = u.id'.format(Residue._meta.db_table))
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s)'.format(self.through_table,
+                    self.through_residue_column), [[r.pk for r in updated]])
+
+            through_rows = [[r.pk, n] for r, numbers in zip(residues, alternative_numbers) for n in numbers]
+            self.copy(cursor, self.through_table, [self.through_residue_column, self.through_number_column],
+                through_rows)
+
+        return len(residues) + len(through_rows)
+
+    def write_orm(self, residues, alternative_numbers):
+        rows = 0
+        for residue, numbers in zip(residues, alternative_numbers):
+            if self.update:
+                values = {f: getattr(residue, f) for f in RESIDUE_FIELDS[1:] if f != 'sequence_number'}
+                residue.pk = Residue.objects.update_or_create(protein_conformation_id=residue.protein_conformation_id,
+                    sequence_number=residue.sequence_number, defaults=values)[0].pk
+                self.through.objects.filter(residue_id=residue.pk).delete()
+            else:
+                residue.save()
+            self.through.objects.bulk_create([self.through(residue_id=residue.pk, residuegenericnumber_id=n)
+                for n in numbers])
+            rows += 1 + len(numbers)
+        return rows
+
+    def copy(self, cursor, table, columns, rows):
+        if not rows:
+            return
+        data = StringIO()
+        for row in rows:
+            data.write('\t'.join([copy_value(v) for v in row]) + '\n')
+        data.seek(0)
+        cursor.cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), data)
+
+    def report(self):
+        self.logger.info('Wrote {} residue and alternative generic number rows in {:.1f}s ({:.0f} rows/s)'.format(
+            self.rows, self.seconds, self.rows / self.seconds if self.seconds else 0))
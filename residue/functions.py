@@ -4,14 +4,15 @@ from django.db import IntegrityError
 
 from protein.models import ProteinAnomaly
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.bulk_writer import ResidueWriter
+from residue.generic_number_registry import GenericNumberRegistry
+from residue.sequence_alignment import align_to_reference
 
 import logging
 from collections import OrderedDict
 import yaml
 import shlex
 import os
-from Bio import AlignIO
-from Bio.Align.Applications import ClustalOmegaCommandline
 
 def parse_scheme_tables(path):
     # get generic residue numbering schemes
@@ -44,118 +45,55 @@ def load_reference_positions(path):
         return False
 
 def create_or_update_residue(protein_conformation, segment, schemes,residue,b_and_c):
-    logger = logging.getLogger('build')
-
-    rns_defaults = {'protein_segment': segment} # default numbering scheme for creating generic numbers
+    """Prepare a residue for bulk creation. Generic numbers are taken from the generic number registry, and new ones
+    are only registered there, so the registry must be flushed (GenericNumberRegistry.flush) before the residue is
+    saved. Returns the (unsaved) residue and the registry keys of its alternative generic numbers"""
+    registry = GenericNumberRegistry.get()
 
-    # default numbering scheme
-    ns = settings.DEFAULT_NUMBERING_SCHEME
-    ns_obj = ResidueNumberingScheme.objects.get(slug=ns)
-    
-    rvalues = {}
-    rvalues['protein_segment'] = segment
-    rvalues['amino_acid'] = residue['aa']
-    rvalues['generic_number'] = None
-    rvalues['display_generic_number'] = None
     sequence_number = residue['pos']
     numbers = residue['numbers']
+    scheme_slug = protein_conformation.protein.residue_numbering_scheme.slug
 
     if 'generic_number' in numbers:
         numbers = format_generic_numbers(protein_conformation.protein.residue_numbering_scheme, schemes,
                     sequence_number, numbers['generic_number'], numbers['bw'],b_and_c)
-        # print(numbers)
-    # print(residues,numbers)
-    # main generic number
+
+    bulk_r = Residue(protein_conformation=protein_conformation,sequence_number=sequence_number,
+        amino_acid=residue['aa'], protein_segment=segment)
+
+    # main generic number (default numbering scheme)
     if 'generic_number' in numbers:
-        gnl = numbers['generic_number']
-        if gnl in schemes[ns]['generic_numbers']:
-            rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl]
-        else:
-            try:
-                gn, created = ResidueGenericNumber.objects.get_or_create(
-                    scheme=ns_obj, label=gnl, defaults=rns_defaults)
-                # if created:
-                #     logger.info('Created generic number {}'.format(gn.label))
-            except IntegrityError:
-                gn = ResidueGenericNumber.objects.get(scheme=ns_obj, label=gnl)
-            rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-
-
-     # equivalent to main generic number
-    if 'equivalent' in numbers:
-        try:
-            gn_equivalent, created = ResidueGenericNumberEquivalent.objects.get_or_create(
-                default_generic_number=rvalues['generic_number'],
-                scheme=protein_conformation.protein.residue_numbering_scheme,
-                defaults={'label': numbers['equivalent']})
-            # if created:
-            #     logger.info('Created generic number equivalent {} ({}) for scheme {}'.format(
-            #         numbers['equivalent'], numbers['generic_number'],
-            #         protein_conformation.protein.residue_numbering_scheme))
-        except IntegrityError:
-            gn_equivalent = ResidueGenericNumberEquivalent.objects.get(
-                default_generic_number=rvalues['generic_number'],
-                scheme=protein_conformation.protein.residue_numbering_scheme)
-    
-    # display generic number
-    if 'display_generic_number' in numbers:
-        ns = protein_conformation.protein.residue_numbering_scheme.slug
-        gnl = numbers['display_generic_number']
-        if gnl in schemes[ns]['generic_numbers']:
-            rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl]
-        else:
-            try:
-                gn, created = ResidueGenericNumber.objects.get_or_create(
-                    scheme=protein_conformation.protein.residue_numbering_scheme,
-                    label=gnl, defaults=rns_defaults)
-                # if created:
-                #     logger.info('Created display generic number {}'.format(gn.label))
-            except IntegrityError:
-                gn = ResidueGenericNumber.objects.get(
-                    scheme=protein_conformation.protein.residue_numbering_scheme, label=gnl)
-            rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-            
+        gn_key = registry.number(settings.DEFAULT_NUMBERING_SCHEME, numbers['generic_number'], segment)
+        registry.assign(bulk_r, 'generic_number_id', gn_key)
 
-        # UPDATE or CREATE the residue
-    # bulk_r = Residue(protein_conformation=protein_conformation,sequence_number=sequence_number,defaults = rvalues)
-    bulk_r = Residue(protein_conformation=protein_conformation,sequence_number=sequence_number, amino_acid = rvalues['amino_acid'],
-        display_generic_number = rvalues['display_generic_number'],
-        generic_number = rvalues['generic_number'], protein_segment = segment)
-    # r, created = Residue.objects.update_or_create(protein_conformation=protein_conformation,
-    #     sequence_number=sequence_number, defaults = rvalues)
+        # equivalent to main generic number
+        if 'equivalent' in numbers:
+            registry.equivalent(gn_key, scheme_slug, numbers['equivalent'])
 
+    # display generic number
+    if 'display_generic_number' in numbers:
+        registry.assign(bulk_r, 'display_generic_number_id', registry.number(scheme_slug,
+            numbers['display_generic_number'], segment))
 
     # alternative generic numbers
-    # r.alternative_generic_numbers.clear() # remove any existing relations
     bulk_add_alt = []
     if (numbers and 'alternative_generic_numbers' in numbers):
         for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items():
-            if alt_num in schemes[alt_scheme]['generic_numbers']:
-                argn = schemes[alt_scheme]['generic_numbers'][alt_num]
-            else:
-                try:
-                    argn, created = ResidueGenericNumber.objects.get_or_create(
-                        scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num,
-                        defaults=rns_defaults)
-                except IntegrityError:
-                    argn = ResidueGenericNumber.objects.get(
-                        scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num)
-                schemes[alt_scheme]['generic_numbers'][alt_num] = argn
-            try:
-                bulk_add_alt.append(argn)
-                # r.alternative_generic_numbers.add(argn)
-            except IntegrityError:
-                print('argn already added?')
-                pass
-                # print('argn already added?')
+            bulk_add_alt.append(registry.number(alt_scheme, alt_num, segment))
 
     return [bulk_r,bulk_add_alt]
 
 
 def create_or_update_residues_in_segment(protein_conformation, segment, start, aligned_start, end, aligned_end,
-    schemes, ref_positions, protein_anomalies, disregard_db_residues):
-    logger = logging.getLogger('build')
-    rns_defaults = {'protein_segment': segment} # default numbering scheme for creating generic numbers
+    schemes, ref_positions, protein_anomalies, disregard_db_residues, writer=None):
+    """Create or update the residues of a segment. Residues are added to writer (a ResidueWriter in update mode),
+    which writes them when it is flushed, in bulk. Without a writer, the residues are written before returning"""
+    registry = GenericNumberRegistry.get()
+    if writer is None:
+        flush = True
+        writer = ResidueWriter(update=True)
+    else:
+        flush = False
 
     # fetch the residues that should be updated
     residues_to_update = Residue.objects.filter(Q(sequence_number__gte=start) & Q(sequence_number__lte=end),
@@ -179,21 +117,17 @@ def create_or_update_residues_in_segment(protein_conformation, segment, start, a
 
     # default numbering scheme
     ns = settings.DEFAULT_NUMBERING_SCHEME
-    ns_obj = ResidueNumberingScheme.objects.get(slug=ns)
-    
-    created_residues = 0
+    scheme_slug = protein_conformation.protein.residue_numbering_scheme.slug
+
     for res_num, residue in enumerate(residues_to_update, start=1):
         sequence_number = residue[0]
-        
-        # dictionary of values for updating/creating a residue
-        rvalues = {}
-        rvalues['protein_segment'] = segment
-        rvalues['amino_acid'] = residue[1]
+
+        r = Residue(protein_conformation=protein_conformation, sequence_number=sequence_number,
+            amino_acid=residue[1], protein_segment=segment)
 
         # generic numbers
         numbers = None
-        rvalues['generic_number'] = None
-        rvalues['display_generic_number'] = None
+        alternative_generic_numbers = []
 
         if (segment.slug in settings.REFERENCE_POSITIONS
             and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions
@@ -205,84 +139,27 @@ def create_or_update_residues_in_segment(protein_conformation, segment, start, a
             
             # main generic number
             if 'generic_number' in numbers:
-                gnl = numbers['generic_number']
-                if gnl in schemes[ns]['generic_numbers']:
-                    rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl]
-                else:
-                    try:
-                        gn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=ns_obj, label=gnl, defaults=rns_defaults)
-                        if created:
-                            logger.info('Created generic number {}'.format(gn.label))
-                    except IntegrityError:
-                        gn = ResidueGenericNumber.objects.get(scheme=ns_obj, label=gnl)
-                    rvalues['generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-
-            # equivalent to main generic number
-            if 'equivalent' in numbers:
-                try:
-                    gn_equivalent, created = ResidueGenericNumberEquivalent.objects.get_or_create(
-                        default_generic_number=rvalues['generic_number'],
-                        scheme=protein_conformation.protein.residue_numbering_scheme,
-                        defaults={'label': numbers['equivalent']})
-                    if created:
-                        logger.info('Created generic number equivalent {} ({}) for scheme {}'.format(
-                            numbers['equivalent'], numbers['generic_number'],
-                            protein_conformation.protein.residue_numbering_scheme))
-                except IntegrityError:
-                    try:
-                        print("Get",rvalues['generic_number'],protein_conformation.protein.residue_numbering_scheme,)
-                        gn_equivalent = ResidueGenericNumberEquivalent.objects.get(
-                            default_generic_number=rvalues['generic_number'],
-                            scheme=protein_conformation.protein.residue_numbering_scheme)
-                    except:
-                        print("failed gn_equivalent", rvalues['generic_number'], protein_conformation.protein.residue_numbering_scheme)
+                gn_key = registry.number(ns, numbers['generic_number'], segment)
+                registry.assign(r, 'generic_number_id', gn_key)
+
+                # equivalent to main generic number
+                if 'equivalent' in numbers:
+                    registry.equivalent(gn_key, scheme_slug, numbers['equivalent'])
             
             # display generic number
             if 'display_generic_number' in numbers:
-                ns = protein_conformation.protein.residue_numbering_scheme.slug
-                gnl = numbers['display_generic_number']
-                if gnl in schemes[ns]['generic_numbers']:
-                    rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl]
-                else:
-                    try:
-                        gn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=protein_conformation.protein.residue_numbering_scheme,
-                            label=gnl, defaults=rns_defaults)
-                        if created:
-                            logger.info('Created generic number {}'.format(gn.label))
-                    except IntegrityError:
-                        gn = ResidueGenericNumber.objects.get(
-                            scheme=protein_conformation.protein.residue_numbering_scheme, label=gnl)
-                    rvalues['display_generic_number'] = schemes[ns]['generic_numbers'][gnl] = gn
-            
-        # UPDATE or CREATE the residue
-        r, created = Residue.objects.update_or_create(protein_conformation=protein_conformation,
-            sequence_number=sequence_number, defaults = rvalues)
-        if created:
-            created_residues += 1
-
-        # alternative generic numbers
-        r.alternative_generic_numbers.clear() # remove any existing relations
-        if (segment.slug in settings.REFERENCE_POSITIONS
-            and settings.REFERENCE_POSITIONS[segment.slug] in ref_positions
-            and numbers and 'alternative_generic_numbers' in numbers):
-            for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items():
-                if alt_num in schemes[alt_scheme]['generic_numbers']:
-                    argn = schemes[alt_scheme]['generic_numbers'][alt_num]
-                else:
-                    try:
-                        argn, created = ResidueGenericNumber.objects.get_or_create(
-                            scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num,
-                            defaults=rns_defaults)
-                    except IntegrityError:
-                        argn = ResidueGenericNumber.objects.get(
-                            scheme=ResidueNumberingScheme.objects.get(slug=alt_scheme), label=alt_num)
-                    schemes[alt_scheme]['generic_numbers'][alt_num] = argn
-                r.alternative_generic_numbers.add(argn)
+                registry.assign(r, 'display_generic_number_id', registry.number(scheme_slug,
+                    numbers['display_generic_number'], segment))
+
+            # alternative generic numbers
+            if 'alternative_generic_numbers' in numbers:
+                for alt_scheme, alt_num in numbers['alternative_generic_numbers'].items():
+                    alternative_generic_numbers.append(registry.number(alt_scheme, alt_num, segment))
+
+        writer.add(r, alternative_generic_numbers)
 
-    if created_residues:
-        logger.info('Created {} residues for {} of {}'.format(created_residues, segment, protein_conformation))
+    if flush:
+        writer.flush()
 
 
 def format_generic_numbers_old(residue_numbering_scheme, schemes, sequence_number, ref_position, ref_residue,
@@ -489,41 +366,12 @@ def align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein):
         return False
     template_ref_positions = load_reference_positions(tpl_ref_pos_file_path)
 
-    # write sequences to files
-    seq_filename = "/tmp/" + protein['entry_name'] + ".fa"
-    with open(seq_filename, 'w') as seq_file:
-        seq_file.write("> ref\n")
-        seq_file.write(ref_protein.sequence + "\n")
-        seq_file.write("> seq\n")
-        seq_file.write(protein['sequence'] + "\n")
-
-    try:
-        ali_filename = "/tmp/out.fa"
-        acmd = ClustalOmegaCommandline(infile=seq_filename, outfile=ali_filename, force=True)
-        stdout, stderr = acmd()
-        a = AlignIO.read(ali_filename, "fasta")
-        logger.info("{} aligned to {}".format(protein['entry_name'], ref_protein.entry_name))
-    except:
-        logger.error('Alignment failed for {}'.format(protein['entry_name']))
+    # align in memory (no temporary files, so that several build processes can align at the same time)
+    name, ref_positions = align_to_reference((protein['entry_name'], protein['sequence'], ref_protein.sequence,
+        template_ref_positions))
+    if ref_positions is False:
         return False
-
-    # find reference positions
-    ref_positions = {}
-    ref_positions_in_ali = {}
-    for position_generic_number, rp in template_ref_positions.items():
-        gaps = 0
-        for i, r in enumerate(a[0].seq, 1):
-            if r == "-":
-                gaps += 1
-            if i-gaps == rp:
-                ref_positions_in_ali[position_generic_number] = i
-    for position_generic_number, rp in ref_positions_in_ali.items():
-        gaps = 0
-        for i, r in enumerate(a[1].seq, 1):
-            if r == "-":
-                gaps += 1
-            if i == rp:
-                ref_positions[position_generic_number] = i - gaps
+    logger.info("{} aligned to {}".format(protein['entry_name'], ref_protein.entry_name))
 
     return ref_positions
 
@@ -0,0 +1,154 @@
+from django.db import IntegrityError, transaction
+
+from residue.models import ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
+
+import logging
+
+
+logger = logging.getLogger('build')
+
+
+class GenericNumberRegistry:
+    """Ids of all residue numbering schemes, generic numbers and generic number equivalents, loaded once per process,
+        so that residues can be created without looking up their generic numbers one at a time
+
+        Generic numbers that are not in the database yet are collected while residues are prepared, and created
+        together by flush (e.g. before the residues of a protein are bulk created). Until then, foreign keys to them
+        are recorded with assign, and set by flush"""
+
+    # the registry used by this process, see get
+    _shared = None
+
+    def __init__(self):
+        self.schemes = {s.slug: s for s in ResidueNumberingScheme.objects.all()}
+        self.scheme_slugs = {s.id: s.slug for s in self.schemes.values()}
+
+        # (scheme slug, label) -> id
+        self.numbers = {}
+        for gn_id, scheme_id, label in ResidueGenericNumber.objects.values_list('id', 'scheme_id', 'label'):
+            self.numbers[(self.scheme_slugs[scheme_id], label)] = gn_id
+
+        # (default generic number id, scheme slug) -> id, and the labels in use for each scheme
+        self.equivalents = {}
+        self.equivalent_labels = set()
+        for eq_id, gn_id, scheme_id, label in ResidueGenericNumberEquivalent.objects.values_list('id',
+            'default_generic_number_id', 'scheme_id', 'label'):
+            self.equivalents[(gn_id, self.scheme_slugs[scheme_id])] = eq_id
+            self.equivalent_labels.add((self.scheme_slugs[scheme_id], label))
+
+        # generic numbers and equivalents to create, and foreign keys to set when they have been created
+        self.pending_numbers = {}
+        self.pending_equivalents = {}
+        self.pending_assignments = []
+
+    @classmethod
+    def get(cls):
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def scheme(self, slug):
+        return self.schemes[slug]
+
+    def number(self, scheme_slug, label, segment=None):
+        """Register a generic number (scheme slug, label), which is created by flush if it does not exist. Returns
+            its key"""
+        key = (scheme_slug, label)
+        if key not in self.numbers and key not in self.pending_numbers:
+            self.pending_numbers[key] = segment
+        return key
+
+    def id(self, key):
+        """Id of a registered generic number (None until it has been created by flush)"""
+        return self.numbers.get(key)
+
+    def assign(self, obj, attribute, key):
+        """Set obj.attribute to the id of a registered generic number, now if it exists, otherwise when it has been
+            created"""
+        if key in self.numbers:
+            setattr(obj, attribute, self.numbers[key])
+        else:
+            self.pending_assignments.append((obj, attribute, key))
+
+    def equivalent(self, key, scheme_slug, label):
+        """Register the equivalent (label in another scheme) of a registered generic number"""
+        self.pending_equivalents.setdefault((key, scheme_slug), label)
+
+    def flush(self):
+        """Create the pending generic numbers and equivalents, and set the pending foreign keys"""
+        if self.pending_numbers:
+            self.create_numbers()
+        for obj, attribute, key in self.pending_assignments:
+            setattr(obj, attribute, self.numbers[key])
+        self.pending_assignments = []
+
+        if self.pending_equivalents:
+            self.create_equivalents()
+
+    def create_numbers(self):
+        pending = self.pending_numbers
+        self.pending_numbers = {}
+
+        # another process may have created some of them since the registry was loaded
+        self.load_numbers(pending)
+        new = [ResidueGenericNumber(scheme=self.schemes[key[0]], label=key[1], protein_segment=segment)
+            for key, segment in pending.items() if key not in self.numbers]
+        if new:
+            try:
+                with transaction.atomic():
+                    ResidueGenericNumber.objects.bulk_create(new)
+            except IntegrityError:
+                # created by another process in the meantime, create the rest one at a time
+                for gn in new:
+                    try:
+                        with transaction.atomic():
+                            ResidueGenericNumber.objects.get_or_create(scheme=gn.scheme, label=gn.label,
+                                defaults={'protein_segment': gn.protein_segment})
+                    except IntegrityError:
+                        pass
+            self.load_numbers(pending)
+            logger.info('Created {} generic numbers'.format(len(new)))
+
+    def load_numbers(self, keys):
+        """Read the ids of generic numbers (given as keys) from the database, with one query per scheme"""
+        labels = {}
+        for scheme_slug, label in keys:
+            labels.setdefault(scheme_slug, []).append(label)
+        for scheme_slug, scheme_labels in labels.items():
+            for gn_id, label in ResidueGenericNumber.objects.filter(scheme=self.schemes[scheme_slug],
+                label__in=scheme_labels).values_list('id', 'label'):
+                self.numbers[(scheme_slug, label)] = gn_id
+
+    def create_equivalents(self):
+        pending = self.pending_equivalents
+        self.pending_equivalents = {}
+
+        new = []
+        for (key, scheme_slug), label in pending.items():
+            gn_id = self.numbers.get(key)
+            if (gn_id is None or (gn_id, scheme_slug) in self.equivalents
+                or (scheme_slug, label) in self.equivalent_labels):
+                continue
+            new.append(ResidueGenericNumberEquivalent(default_generic_number_id=gn_id,
+                scheme=self.schemes[scheme_slug], label=label))
+        if not new:
+            return
+
+        try:
+            with transaction.atomic():
+                ResidueGenericNumberEquivalent.objects.bulk_create(new)
+        except IntegrityError:
+            for eq in new:
+                try:
+                    with transaction.atomic():
+                        ResidueGenericNumberEquivalent.objects.get_or_create(
+                            default_generic_number_id=eq.default_generic_number_id, scheme=eq.scheme,
+                            defaults={'label': eq.label})
+                except IntegrityError:
+                    pass
+        for eq_id, gn_id, scheme_id, label in ResidueGenericNumberEquivalent.objects.filter(
+            default_generic_number_id__in=[eq.default_generic_number_id for eq in new]).values_list('id',
+            'default_generic_number_id', 'scheme_id', 'label'):
+            self.equivalents[(gn_id, self.scheme_slugs[scheme_id])] = eq_id
+            self.equivalent_labels.add((self.scheme_slugs[scheme_id], label))
+        logger.info('Created {} generic number equivalents'.format(len(new)))
@@ -0,0 +1,66 @@
+from Bio import pairwise2
+from Bio.SubsMat import MatrixInfo as matlist
+
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+
+
+logger = logging.getLogger('build')
+
+# scoring of pairwise alignments (same as the ortholog alignments in build_annotation)
+MATRIX = matlist.blosum62
+GAP_OPEN = -10
+GAP_EXTEND = -0.5
+
+
+def align_pair(ref_sequence, sequence):
+    """Global alignment of a sequence to a reference sequence, in memory. Gaps at the ends are not penalized, so that
+        orthologs with longer or shorter termini are aligned by their conserved parts. Returns the aligned reference
+        and sequence"""
+    alignment = pairwise2.align.globalds(ref_sequence, sequence, MATRIX, GAP_OPEN, GAP_EXTEND,
+        penalize_end_gaps=False, one_alignment_only=True)[0]
+    return alignment[0], alignment[1]
+
+
+def map_reference_positions(aligned_ref, aligned_seq, template_ref_positions):
+    """Map reference positions (generic number -> sequence number in the reference) to sequence numbers in the aligned
+        sequence. A reference residue is mapped through the last alignment column before the next reference residue,
+        and to the last residue of the sequence up to that column"""
+    ref = np.frombuffer(aligned_ref.encode('ascii'), dtype=np.uint8)
+    seq = np.frombuffer(aligned_seq.encode('ascii'), dtype=np.uint8)
+    gap = ord('-')
+    ref_counts = np.cumsum(ref != gap)
+    seq_counts = np.cumsum(seq != gap)
+
+    ref_positions = {}
+    for position_generic_number, rp in template_ref_positions.items():
+        if not isinstance(rp, int) or rp < 1:
+            continue
+        column = np.searchsorted(ref_counts, rp, side='right') - 1
+        if column >= 0 and ref_counts[column] == rp:
+            ref_positions[position_generic_number] = int(seq_counts[column])
+    return ref_positions
+
+
+def align_to_reference(job):
+    """Align one protein to its template and map the template reference positions. job is a tuple of (name, sequence,
+        template sequence, template reference positions). Returns the name and the reference positions of the protein
+        (False if the alignment failed)"""
+    name, sequence, ref_sequence, template_ref_positions = job
+    try:
+        aligned_ref, aligned_seq = align_pair(ref_sequence, sequence)
+    except Exception as msg:
+        logger.error('Alignment failed for {}: {}'.format(name, msg))
+        return name, False
+    return name, map_reference_positions(aligned_ref, aligned_seq, template_ref_positions)
+
+
+def align_to_references(jobs, proc=1):
+    """Align many proteins to their templates (see align_to_reference for the format of jobs), in proc worker
+        processes. Returns a dict of reference positions by name"""
+    if proc > 1 and len(jobs) > 1:
+        with Pool(min(proc, len(jobs))) as pool:
+            return dict(pool.imap_unordered(align_to_reference, jobs, chunksize=max(1, len(jobs) // (proc * 4))))
+    return dict([align_to_reference(job) for job in jobs])
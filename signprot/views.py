@@ -17,6 +17,7 @@ from signprot.models import SignprotStructure
 from common import definitions
 from collections import OrderedDict
 from common.views import AbsTargetSelection
+from common.release_cache import current_release, release_cache_page
 
 import json
 # Create your views here.
@@ -40,21 +41,12 @@ class BrowseSelection(AbsTargetSelection):
         ('targets', True),
         ('segments', False),
     ])
-    try:
-        ppf = ProteinFamily.objects.get(slug="100_000")
-        pfs = ProteinFamily.objects.filter(parent=ppf.id)
-        ps = Protein.objects.filter(family=ppf)
-        tree_indent_level = []
-        action = 'expand'
-        # remove the parent family (for all other families than the root of the tree, the parent should be shown)
-        del ppf
-    except Exception as e:
-        pass
-
-@cache_page(60*60*24*2) # 2 days caching
+    default_slug = '100_000'
+
+@release_cache_page()
 def GProtein(request):
 
-    name_of_cache = 'gprotein_statistics'
+    name_of_cache = 'gprotein_statistics_' + current_release()
 
     context = cache.get(name_of_cache)
 
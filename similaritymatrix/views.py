@@ -59,9 +59,6 @@ def render_matrix(request):
     # build the alignment data matrix
     a.build_alignment()
 
-    # calculate consensus sequence + amino acid and feature frequency
-    a.calculate_statistics()
-
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity_matrix()
 
@@ -82,9 +79,6 @@ def render_csv_matrix(request):
     # build the alignment data matrix
     a.build_alignment()
 
-    # calculate consensus sequence + amino acid and feature frequency
-    a.calculate_statistics()
-
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity_matrix()
 
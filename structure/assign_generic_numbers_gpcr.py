@@ -181,10 +181,9 @@ class GenericNumbering(object):
     
     def assign_generic_numbers(self):
         
-        alignments = {}
-        #blast search goes first, looping through all the chains
-        for chain in self.pdb_seq.keys():
-            alignments[chain] = self.blast.run(self.pdb_seq[chain])
+        #blast search goes first, all chains are searched in one batch
+        chains = list(self.pdb_seq.keys())
+        alignments = dict(zip(chains, self.blast.run_batch([self.pdb_seq[chain] for chain in chains])))
             
         #map the results onto pdb sequence for every sequence pair from blast
         for chain in self.pdb_seq.keys():
@@ -5,34 +5,236 @@ import Bio.PDB.Polypeptide as polypeptide
 from Bio.PDB.AbstractPropertyMap import AbstractPropertyMap
 from Bio.PDB.Polypeptide import CaPPBuilder, is_aa
 from Bio.PDB.Vector import rotaxis
+from Bio import pairwise2
 
 from django.conf import settings
 from common.selection import SimpleSelection
 from common.alignment import Alignment
-from protein.models import ProteinSegment
+from protein.models import Protein, ProteinSegment
 from residue.models import Residue
 from structure.models import Structure
 
 from subprocess import Popen, PIPE
 from io import StringIO
+from collections import OrderedDict
+import hashlib
 import os
 import sys
 import tempfile
 import logging
 import math
 import urllib
+import numpy as np
 
 logger = logging.getLogger("protwis")
 
 ATOM_FORMAT_STRING="%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%s%6.2f      %4s%2s%2s\n" 
 
+#==============================================================================
+# modification time and size of a file, or None if it does not exist. Used to notice that a blast database or sequence
+# index has been rebuilt
+def file_version (path):
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+#==============================================================================
+# LRU cache of parsed blast results, shared by all BlastSearch instances of a process. Keys are the database, its
+# version (see database_version), the number of results, whether the sequence index was used and a hash of the query
+# sequence
+class BlastResultCache(object):
+
+    def __init__ (self, maxsize=1024):
+
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+
+    @staticmethod
+    def database_version (blastdb):
+
+        #versions of the database files (single or multi volume database) and of its sequence index, so that results
+        #are not reused after the database or the index have been rebuilt
+        return tuple([file_version(blastdb + ext) for ext in ('.pin', '.pal')] +
+            [file_version(SequenceIndex.path(blastdb))])
+
+    def key (self, blastdb, version, top_results, prefilter, input_seq):
+
+        return (blastdb, version, top_results, prefilter, hashlib.sha1(str(input_seq).encode('latin1')).hexdigest())
+
+    def get (self, key):
+
+        if key not in self.results:
+            return None
+        self.results.move_to_end(key)
+        return list(self.results[key])
+
+    def set (self, key, output):
+
+        self.results[key] = list(output)
+        self.results.move_to_end(key)
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+#==============================================================================
+# k-mer codes of residue symbols for the sequence index. Letters are coded 1-26, anything else is 0, and k-mers that
+# contain other symbols (gaps, stop codons, digits) are left out
+MINIMIZER_CODES = np.zeros(256, dtype=np.uint64)
+MINIMIZER_CODES[ord('A'):ord('Z') + 1] = np.arange(1, 27, dtype=np.uint64)
+
+#==============================================================================
+# Minimizer index of the sequences in a blast database (see build_sequence_index). It identifies the protein of a
+# sequence that is (nearly) identical to a stored one without running blast. The index is stored next to the blast
+# database as three arrays: the sorted minimizers, offsets into the postings and the postings (protein indices)
+class SequenceIndex(object):
+
+    # loaded indices and the versions of their files (see file_version), by path
+    loaded = {}
+
+    def __init__ (self, protein_ids, minimizers, offsets, postings, k=5, w=5):
+
+        self.protein_ids = protein_ids
+        self.minimizers = minimizers
+        self.offsets = offsets
+        self.postings = postings
+        self.k = k
+        self.w = w
+
+    @staticmethod
+    def path (blastdb):
+
+        return blastdb + '_index.npz'
+
+    @classmethod
+    def sequence_minimizers (cls, sequence, k=5, w=5):
+
+        #each k-mer is encoded as an integer and hashed, and the smallest hash of each window of w consecutive k-mers
+        #is a minimizer
+        codes = MINIMIZER_CODES[np.frombuffer(str(sequence).upper().encode('latin1', 'replace'), dtype=np.uint8)]
+        if len(codes) < k + w - 1:
+            return np.array([], dtype=np.uint64)
+        num_kmers = len(codes) - k + 1
+        kmers = np.zeros(num_kmers, dtype=np.uint64)
+        for i in range(k):
+            kmers = kmers * np.uint64(32) + codes[i:i + num_kmers]
+        hashes = (kmers * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+
+        #k-mers with other symbols than letters never become minimizers
+        skipped = np.iinfo(np.uint64).max
+        other = np.concatenate([[0], np.cumsum(codes == 0)])
+        hashes[other[k:] != other[:-k]] = skipped
+        num_windows = num_kmers - w + 1
+        window_min = np.min([hashes[i:i + num_windows] for i in range(w)], axis=0)
+        return np.unique(window_min[window_min != skipped])
+
+    @classmethod
+    def build (cls, proteins, k=5, w=5):
+
+        protein_ids = []
+        protein_minimizers = []
+        for protein in proteins:
+            protein_ids.append(protein.id)
+            protein_minimizers.append(cls.sequence_minimizers(protein.sequence, k, w))
+
+        lengths = [len(m) for m in protein_minimizers]
+        all_minimizers = np.concatenate(protein_minimizers) if protein_minimizers else np.array([], dtype=np.uint64)
+        all_proteins = np.repeat(np.arange(len(protein_ids), dtype=np.int32), lengths)
+        order = np.argsort(all_minimizers, kind='stable')
+        minimizers, offsets = np.unique(all_minimizers[order], return_index=True)
+        offsets = np.append(offsets, len(order))
+        return cls(np.array(protein_ids, dtype=np.int64), minimizers, offsets, all_proteins[order], k, w)
+
+    def save (self, path):
+
+        with open(path, 'wb') as f:
+            np.savez(f, protein_ids=self.protein_ids, minimizers=self.minimizers, offsets=self.offsets,
+                postings=self.postings, params=np.array([self.k, self.w]))
+
+    @classmethod
+    def load (cls, path):
+
+        #returns the index stored at path, or None if there is no index. A loaded index is reloaded when the file has
+        #changed (e.g. rebuilt by build_sequence_index)
+        version = file_version(path)
+        if version is None:
+            logger.debug("No sequence index found at {}".format(path))
+            cls.loaded.pop(path, None)
+            return None
+        if path not in cls.loaded or cls.loaded[path][0] != version:
+            try:
+                data = np.load(path)
+            except (IOError, OSError, ValueError) as msg:
+                logger.debug("Failed to load sequence index {}: {}".format(path, msg))
+                return None
+            cls.loaded[path] = (version, cls(data['protein_ids'], data['minimizers'], data['offsets'],
+                data['postings'], *[int(x) for x in data['params']]))
+        return cls.loaded[path][1]
+
+    def identify (self, sequence, min_fraction=0.5, max_second_ratio=0.8):
+
+        #returns the id of the protein that shares most minimizers with the sequence, or None if the best hit is weak
+        #(less than min_fraction of the minimizers of the sequence) or ambiguous (the second best hit has more than
+        #max_second_ratio of the shared minimizers of the best hit)
+        query = self.sequence_minimizers(sequence, self.k, self.w)
+        if not len(query) or not len(self.minimizers):
+            return None
+        positions = np.searchsorted(self.minimizers, query)
+        found = positions < len(self.minimizers)
+        found[found] = self.minimizers[positions[found]] == query[found]
+        positions = positions[found]
+        if not len(positions):
+            return None
+        hits = np.concatenate([self.postings[self.offsets[i]:self.offsets[i + 1]] for i in positions])
+        counts = np.bincount(hits, minlength=len(self.protein_ids))
+        ranked = np.argsort(counts)[::-1]
+        best = counts[ranked[0]]
+        second = counts[ranked[1]] if len(ranked) > 1 else 0
+        if best < min_fraction * len(query) or second > max_second_ratio * best:
+            return None
+        return int(self.protein_ids[ranked[0]])
+
+#==============================================================================
+# A pairwise alignment of a sequence to a protein identified through the sequence index. It has the attributes of blast
+# alignments (Bio.Blast.Record.Alignment and HSP) that are used by the blast result parsers. The E-value is always 0, as
+# it is not calculated, so searches that use E-values must not use the sequence index (see BlastSearch.run)
+class IndexedAlignment(object):
+
+    def __init__ (self, protein_id, query, sbjct, query_start, sbjct_start, score):
+
+        self.hit_id = str(protein_id)
+        self.hit_def = ''
+        self.query = query
+        self.sbjct = sbjct
+        self.match = ''.join([q if q == s else ' ' for q, s in zip(query, sbjct)])
+        self.query_start = query_start
+        self.sbjct_start = sbjct_start
+        self.query_end = query_start + len(query.replace('-', '')) - 1
+        self.sbjct_end = sbjct_start + len(sbjct.replace('-', '')) - 1
+        self.identities = len(self.match.replace(' ', ''))
+        self.score = score
+        self.expect = 0.0
+        self.hsps = [self]
+
+    @classmethod
+    def align (cls, input_seq, protein_id, sequence):
+
+        query, sbjct, score, start, end = pairwise2.align.localms(str(input_seq), sequence, 2, -4, -4, -.1,
+            one_alignment_only=True)[0]
+        query_start = len(query[:start].replace('-', '')) + 1
+        sbjct_start = len(sbjct[:start].replace('-', '')) + 1
+        return cls(protein_id, query[start:end], sbjct[start:end], query_start, sbjct_start, score)
+
 #==============================================================================
 # I have put it into separate class for the sake of future uses
 class BlastSearch(object):
-    
+
+    cache = BlastResultCache(getattr(settings, 'BLAST_CACHE_SIZE', 1024))
     
     def __init__ (self, blast_path='blastp',
-        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1):
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1, num_threads=1,
+        prefilter=True):
   
         self.blast_path = blast_path
         self.blastdb = blastdb
@@ -40,34 +242,100 @@ class BlastSearch(object):
         #residues it is better to use more results to avoid getting sequence of
         #e.g.  different species
         self.top_results = top_results
+        self.num_threads = num_threads
+        #when only the best hit is requested, try to identify the protein with the sequence index before running blast
+        self.prefilter = prefilter and top_results == 1
       
     #takes Bio.Seq sequence as an input and returns a list of tuples with the
-    #alignments
-    def run (self, input_seq):
-    
-        output = []
+    #alignments. With prefilter=False, the sequence is always searched with blast, e.g. when the E-value of the hit is
+    #used
+    def run (self, input_seq, prefilter=True):
+
+        return self.run_batch([input_seq], prefilter)[0]
+
+    #takes a list of sequences and returns a list of results (see run) in the same order. Sequences that are not
+    #cached are searched with a single blast invocation, so the process start and database load are paid once
+    def run_batch (self, input_seqs, prefilter=True):
+
+        prefilter = self.prefilter and prefilter
+        version = self.cache.database_version(self.blastdb)
+        keys = [self.cache.key(self.blastdb, version, self.top_results, prefilter, input_seq)
+            for input_seq in input_seqs]
+        outputs = [self.cache.get(key) for key in keys]
+
+        # unique uncached sequences
+        queries = OrderedDict()
+        for i, input_seq in enumerate(input_seqs):
+            if outputs[i] is None and str(input_seq) and keys[i] not in queries:
+                queries[keys[i]] = str(input_seq)
+
+        results = {}
+        if queries and prefilter:
+            results = self.search_index(queries)
+            for key in results:
+                del queries[key]
+        if queries:
+            results.update(zip(queries.keys(), self.search(list(queries.values()))))
+        for key, output in results.items():
+            self.cache.set(key, output)
+
+        for i, key in enumerate(keys):
+            if outputs[i] is None:
+                outputs[i] = list(results.get(key, []))
+        return outputs
+
+    #identifies unambiguous hits with the sequence index, and aligns the sequences to them. Returns a dict of results
+    #(see run) by query key, sequences that are not in the dict have to be searched with blast
+    def search_index (self, queries):
+
+        index = SequenceIndex.load(SequenceIndex.path(self.blastdb))
+        if index is None:
+            return {}
+
+        hits = OrderedDict()
+        for key, input_seq in queries.items():
+            protein_id = index.identify(input_seq)
+            if protein_id is not None:
+                hits[key] = protein_id
+        sequences = dict(Protein.objects.filter(pk__in=hits.values()).values_list('id', 'sequence'))
+
+        results = {}
+        for key, protein_id in hits.items():
+            if protein_id in sequences:
+                aln = IndexedAlignment.align(queries[key], protein_id, sequences[protein_id])
+                logger.debug("Sequence index hit: {}".format(aln.hit_id))
+                results[key] = [(aln.hit_id, aln)]
+        return results
+
+    #runs blast with a multiple sequence fasta query, and returns the parsed results of each sequence
+    def search (self, input_seqs):
+
+        query = ''.join(['>query_{}\n{}\n'.format(i, input_seq) for i, input_seq in enumerate(input_seqs)])
+        cmd = [self.blast_path, '-db', self.blastdb, '-outfmt', '5', '-num_threads', str(self.num_threads)]
+        logger.debug("Running Blast with {} sequence(s)".format(len(input_seqs)))
+
         #Windows has problems with Popen and PIPE
         if sys.platform == 'win32':
             tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
+            tmp.write(bytes(query, 'latin1'))
             tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
-                stdout=PIPE, stderr=PIPE)
+            blast = Popen(cmd, universal_newlines=True, stdin=tmp, stdout=PIPE, stderr=PIPE)
             (blast_out, blast_err) = blast.communicate()
         else:
         #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
-                stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
+            blast = Popen(cmd, universal_newlines=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            (blast_out, blast_err) = blast.communicate(input=query)
         if len(blast_err) != 0:
             logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:         
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+
+        outputs = [[] for input_seq in input_seqs]
+        if blast_out.strip():
+            #blast reports one record per query sequence, in the order of the query
+            for query_index, result in enumerate(NCBIXML.parse(StringIO(blast_out))):
+                for aln in result.alignments[:self.top_results]:
+                    logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
+                    outputs[query_index].append((aln.hit_id, aln))
+        return outputs
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -299,6 +567,23 @@ class CASelector(object):
             return ([], [])
     
         return (tmp_ref, tmp_alt)
+
+
+    def get_consensus_coordinates (self, alt_id):
+        """Coordinates of the matched atoms (as in get_consensus_atom_sets) of the reference and an alternative
+        structure, as two n x 3 arrays. Atoms are matched on their generic numbers with one array comparison instead of
+        comparing each pair of atoms"""
+
+        if self.ref_atoms == [] or self.alt_atoms.get(alt_id, []) == []:
+            return (np.zeros((0, 3)), np.zeros((0, 3)))
+
+        ref_bfactors = np.array([at.get_bfactor() for at in self.ref_atoms])
+        alt_bfactors = np.array([at.get_bfactor() for at in self.alt_atoms[alt_id]])
+        ref_idx, alt_idx = np.nonzero(ref_bfactors[:, None] == alt_bfactors[None, :])
+        ref_coords = np.array([at.get_coord() for at in self.ref_atoms], dtype=np.float64)
+        alt_coords = np.array([at.get_coord() for at in self.alt_atoms[alt_id]], dtype=np.float64)
+
+        return (ref_coords[ref_idx], alt_coords[alt_idx])
     
 
     def get_consensus_gn_set (self):
@@ -361,7 +646,7 @@ class BackboneSelector():
         self.alt_atoms = []
         
         self.ref_atoms = self.select_ref_atoms(fragment, ref_pdbio_struct, use_similar)
-        self.alt_atoms = self.select_alt_atoms(PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(str(fragment.rotamer.pdbdata)))[0])
+        self.alt_atoms = self.select_alt_atoms(fragment.rotamer.pdbdata.get_structure('ref')[0])
         
         
     def select_ref_atoms (self, fragment, ref_pdbio_struct, use_similar=False):
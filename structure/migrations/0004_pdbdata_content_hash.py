@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import hashlib
+
+
+def add_content_hashes(apps, schema_editor):
+    PdbData = apps.get_model('structure', 'PdbData')
+    for pdbdata in PdbData.objects.filter(content_hash=None).only('id', 'pdb').iterator():
+        content_hash = hashlib.sha1(pdbdata.pdb.encode('utf-8')).hexdigest()
+        PdbData.objects.filter(pk=pdbdata.pk).update(content_hash=content_hash)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0003_rotamer_missing_atoms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdbdata',
+            name='content_hash',
+            field=models.CharField(db_index=True, max_length=40, null=True),
+        ),
+        migrations.RunPython(add_content_hashes, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,11 @@
 from django.db import models
 
 from io import StringIO
+from collections import OrderedDict
 from Bio.PDB import PDBIO
 
+import hashlib
+
 class Structure(models.Model):
     protein_conformation = models.ForeignKey('protein.ProteinConformation')
     structure_type = models.ForeignKey('StructureType')
@@ -143,12 +146,62 @@ class StructureStabilizingAgent(models.Model):
         db_table = "structure_stabilizing_agent"
 
 
+class PdbDataManager(models.Manager):
+
+    def get_or_create_pdb(self, pdb):
+        """get_or_create for a PDB file, using the indexed content hash instead of comparing the full text"""
+        content_hash = PdbData.hash_pdb(pdb)
+        for pdbdata in self.filter(content_hash=content_hash):
+            if pdbdata.pdb == pdb:
+                return pdbdata, False
+        return self.create(pdb=pdb, content_hash=content_hash), True
+
+    def get_or_create_many(self, pdbs):
+        """Returns a PdbData object for each PDB file in a list, in the same order. Existing files are fetched with one
+            query, and missing files are inserted with one bulk insert (identical files share one object)"""
+        hashes = [PdbData.hash_pdb(pdb) for pdb in pdbs]
+        existing = {}
+        for pdbdata in self.filter(content_hash__in=set(hashes)):
+            existing[(pdbdata.content_hash, pdbdata.pdb)] = pdbdata
+
+        missing = OrderedDict()
+        for content_hash, pdb in zip(hashes, pdbs):
+            if (content_hash, pdb) not in existing:
+                missing[(content_hash, pdb)] = PdbData(pdb=pdb, content_hash=content_hash)
+        if missing:
+            # primary keys are set by bulk_create on PostgreSQL
+            self.bulk_create(list(missing.values()))
+            existing.update(missing)
+
+        return [existing[(content_hash, pdb)] for content_hash, pdb in zip(hashes, pdbs)]
+
+
 class PdbData(models.Model):
     pdb = models.TextField()
+    content_hash = models.CharField(max_length=40, db_index=True, null=True) # sha1 of pdb, see hash_pdb
+
+    objects = PdbDataManager()
 
     def __str__(self):
         return self.pdb
 
+    def save(self, *args, **kwargs):
+        self.content_hash = self.hash_pdb(self.pdb)
+        super(PdbData, self).save(*args, **kwargs)
+
+    @staticmethod
+    def hash_pdb(pdb):
+        return hashlib.sha1(pdb.encode('utf-8')).hexdigest()
+
+    def get_arrays(self):
+        """The atoms of this file as memory-mapped arrays (see structure.pdb_arrays)"""
+        from structure.pdb_arrays import PdbArrays
+        return PdbArrays.for_pdbdata(self)
+
+    def get_structure(self, structure_id='structure'):
+        """A Bio.PDB Structure of this file, built from the stored arrays instead of parsing the text"""
+        return self.get_arrays().get_structure(structure_id)
+
     class Meta():
         db_table = "structure_pdb_data"
 
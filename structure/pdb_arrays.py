@@ -0,0 +1,233 @@
+from django.conf import settings
+
+from Bio.PDB.PDBExceptions import PDBConstructionException, PDBConstructionWarning
+from Bio.PDB.StructureBuilder import StructureBuilder
+
+import hashlib
+import logging
+import os
+import tempfile
+import warnings
+import numpy as np
+
+
+# one record per atom, with the fields that Bio.PDB.PDBParser reads from ATOM/HETATM records
+ATOM_DTYPE = np.dtype([
+    ('model', np.int32), # model index
+    ('model_serial', np.int32), # serial number of the MODEL record, -1 if there was none
+    ('hetero_flag', 'S1'),
+    ('serial', np.int32),
+    ('name', 'S4'),
+    ('fullname', 'S4'),
+    ('altloc', 'S1'),
+    ('resname', 'S3'),
+    ('chain', 'S1'),
+    ('resseq', np.int32),
+    ('icode', 'S1'),
+    ('coord', np.float32, (3,)),
+    ('occupancy', np.float64), # NaN if missing
+    ('bfactor', np.float64),
+    ('segid', 'S4'),
+    ('element', 'S2'),
+])
+
+
+def parse_pdb_text(pdb):
+    """Parse the coordinate records of a PDB file into an array of ATOM_DTYPE records. Fields are read in the same way
+        as Bio.PDB.PDBParser (in permissive mode), and parsing stops at the first END or CONECT record"""
+    records = []
+    model = -1
+    model_serial = -1
+    model_open = False
+    for line in pdb.split('\n'):
+        record_type = line[0:6]
+        if record_type == 'ATOM  ' or record_type == 'HETATM':
+            if not model_open:
+                model += 1
+                model_serial = -1
+                model_open = True
+            fullname = line[12:16]
+            split_list = fullname.split()
+            name = fullname if len(split_list) != 1 else split_list[0]
+            resname = line[17:20].strip()
+            try:
+                serial = int(line[6:11])
+            except ValueError:
+                serial = 0
+            if record_type == 'HETATM':
+                hetero_flag = 'W' if resname == 'HOH' or resname == 'WAT' else 'H'
+            else:
+                hetero_flag = ' '
+            try:
+                occupancy = float(line[54:60])
+            except ValueError:
+                occupancy = np.nan
+            try:
+                bfactor = float(line[60:66])
+            except ValueError:
+                bfactor = 0.0
+            records.append((model, model_serial, hetero_flag, serial, name, fullname, line[16], resname, line[21],
+                int(line[22:26].split()[0]), line[26], (float(line[30:38]), float(line[38:46]), float(line[46:54])),
+                occupancy, bfactor, line[72:76], line[76:78].strip().upper()))
+        elif record_type == 'MODEL ':
+            model += 1
+            try:
+                model_serial = int(line[10:14])
+            except ValueError:
+                model_serial = 0
+            model_open = True
+        elif record_type == 'ENDMDL':
+            model_open = False
+        elif (record_type == 'END   ' or record_type == 'CONECT') and records:
+            break
+    return np.array(records, dtype=ATOM_DTYPE)
+
+
+class PdbArrays:
+    """The atoms of a PDB file as a (usually memory-mapped) record array. Coordinates, atom names, residue ids, chain
+        ids and B-factors are available as columns, and get_structure builds a Bio.PDB structure without parsing text
+
+        Arrays are generated once for each distinct PDB file (see for_pdbdata) and are stored in PDB_ARRAY_DIR, keyed by
+        the content hash of the file (PdbData.content_hash), so a changed PdbData row never reads stale coordinates"""
+
+    logger = logging.getLogger('protwis')
+
+    def __init__(self, atoms):
+        self.atoms = atoms
+
+    def __len__(self):
+        return len(self.atoms)
+
+    @staticmethod
+    def location():
+        return getattr(settings, 'PDB_ARRAY_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'pdb_arrays']))
+
+    @classmethod
+    def path(cls, key):
+        return os.sep.join([cls.location(), key[:2], key + '.npy'])
+
+    @staticmethod
+    def key(pdb):
+        return hashlib.sha1(pdb.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_text(cls, pdb):
+        return cls(parse_pdb_text(pdb))
+
+    @classmethod
+    def for_pdbdata(cls, pdbdata):
+        """Returns the arrays of a PdbData object, generating and storing them if this file has not been seen before"""
+        return cls.cached(pdbdata.content_hash or cls.key(pdbdata.pdb), pdbdata.pdb)
+
+    @classmethod
+    def for_text(cls, pdb):
+        """Returns the arrays of a PDB file given as text (e.g. several PdbData files joined), stored as for_pdbdata"""
+        return cls.cached(cls.key(pdb), pdb)
+
+    @classmethod
+    def cached(cls, key, pdb):
+        path = cls.path(key)
+        try:
+            return cls(np.load(path, mmap_mode='r'))
+        except FileNotFoundError:
+            pass
+        except Exception as msg:
+            cls.logger.warning('Failed reading PDB arrays {}: {}'.format(path, msg))
+
+        arrays = cls.from_text(pdb)
+        try:
+            arrays.save(path)
+        except OSError as msg:
+            cls.logger.warning('Failed writing PDB arrays {}: {}'.format(path, msg))
+        return arrays
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first, so that readers never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, self.atoms)
+        os.replace(tmp_path, path)
+
+    @property
+    def coords(self):
+        return self.atoms['coord']
+
+    @property
+    def bfactors(self):
+        return self.atoms['bfactor']
+
+    @property
+    def atom_names(self):
+        return self.atoms['name'].astype('U4')
+
+    @property
+    def chain_ids(self):
+        return self.atoms['chain'].astype('U1')
+
+    @property
+    def residue_numbers(self):
+        return self.atoms['resseq']
+
+    def select(self, chain=None, atom_names=None):
+        """Returns the arrays of the atoms in a chain and/or with one of the given names"""
+        mask = np.ones(len(self.atoms), dtype=bool)
+        if chain is not None:
+            mask &= self.atoms['chain'] == chain.encode('ascii')
+        if atom_names is not None:
+            mask &= np.in1d(self.atoms['name'], [n.encode('ascii') for n in atom_names])
+        return PdbArrays(self.atoms[mask])
+
+    def get_structure(self, structure_id='structure'):
+        """Build a Bio.PDB Structure, calling the structure builder in the same way as Bio.PDB.PDBParser"""
+        atoms = self.atoms
+        columns = {}
+        for field in ('hetero_flag', 'name', 'fullname', 'altloc', 'resname', 'chain', 'icode', 'segid', 'element'):
+            columns[field] = atoms[field].astype('U').tolist()
+        for field in ('model', 'model_serial', 'serial', 'resseq', 'bfactor'):
+            columns[field] = atoms[field].tolist()
+        occupancies = [None if o != o else o for o in atoms['occupancy'].tolist()]
+        coords = np.array(atoms['coord'], dtype=np.float32) # a writeable copy, as atoms are often transformed
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', PDBConstructionWarning)
+            return self._build_structure(structure_id, columns, occupancies, coords)
+
+    def _build_structure(self, structure_id, columns, occupancies, coords):
+        builder = StructureBuilder()
+        builder.init_structure(structure_id)
+        current_model = None
+        current_chain_id = None
+        current_segid = None
+        current_residue = None
+        for i in range(len(coords)):
+            if columns['model'][i] != current_model:
+                current_model = columns['model'][i]
+                serial = columns['model_serial'][i]
+                builder.init_model(current_model, serial if serial >= 0 else None)
+                current_chain_id = None
+                current_residue = None
+            segid = columns['segid'][i]
+            if current_segid != segid:
+                current_segid = segid
+                builder.init_seg(segid)
+            residue = (columns['hetero_flag'][i], columns['resseq'][i], columns['icode'][i], columns['resname'][i])
+            chain_id = columns['chain'][i]
+            try:
+                if current_chain_id != chain_id:
+                    current_chain_id = chain_id
+                    builder.init_chain(chain_id)
+                    current_residue = residue
+                    builder.init_residue(residue[3], residue[0], residue[1], residue[2])
+                elif current_residue != residue:
+                    current_residue = residue
+                    builder.init_residue(residue[3], residue[0], residue[1], residue[2])
+            except PDBConstructionException as msg:
+                self.logger.debug('PDB construction warning: {}'.format(msg))
+            try:
+                builder.init_atom(columns['name'][i], coords[i], columns['bfactor'][i], occupancies[i],
+                    columns['altloc'][i], columns['fullname'][i], columns['serial'][i], columns['element'][i])
+            except PDBConstructionException as msg:
+                self.logger.debug('PDB construction warning: {}'.format(msg))
+        return builder.get_structure()
@@ -220,6 +220,7 @@ class SequenceParser(object):
         bio.pdb reads pdb in the following cascade: model->chain->residue->atom
         """
         wt_resi = list(Residue.objects.filter(protein_conformation__protein=self.wt.id))
+        peptides = []
         for chain in pdb_struct:
             self.residues[chain.id] = []
             self.mapping[chain.id] = {x.sequence_number: ParsedResidue(x.amino_acid, x.sequence_number, str(x.display_generic_number) if x.display_generic_number else None, x.protein_segment) for x in wt_resi}
@@ -231,8 +232,14 @@ class SequenceParser(object):
                 self.residues[chain.id].append(res)
             poly = self.get_chain_peptides(chain.id)
             for peptide in poly:
-                #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
-                self.map_to_wt_blast(chain.id, peptide, None, int(peptide[0].id[1]))
+                peptides.append((chain.id, peptide))
+
+        # search all peptides in one blast run, map_to_wt_blast then reads the results from the blast cache. Peptides
+        # are not searched in the sequence index, as their E-values are used to detect fusion proteins
+        self.blast.run_batch([self.get_peptide_sequence(peptide) for chain_id, peptide in peptides], prefilter=False)
+        for chain_id, peptide in peptides:
+            #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
+            self.map_to_wt_blast(chain_id, peptide, None, int(peptide[0].id[1]))
 
     def get_segments(self):
 
@@ -316,7 +323,7 @@ class SequenceParser(object):
         else:
             seq = self.get_chain_sequence(chain_id)
 
-        alignments = self.blast.run(seq)
+        alignments = self.blast.run(seq, prefilter=not residues)
 
         for alignment in alignments:
             if alignment[1].hsps[0].expect > .5 and residues:
@@ -13,6 +13,43 @@ from structure.models import Structure
 from interaction.models import ResidueFragmentInteraction
 
 logger = logging.getLogger("protwis")
+#==============================================================================  
+def batch_superpose (ref_sets, alt_sets):
+    """Least squares superposition (Kabsch) of several pairs of matched coordinate sets at once. ref_sets and alt_sets
+    are lists of n x 3 arrays (n can differ between pairs), which are padded to one k x n x 3 array, so that the
+    centroids, covariance matrices and their SVDs are computed for all pairs together.
+
+    Returns the rotations (k x 3 x 3), translations (k x 3) and RMS values (k), in the convention of Bio.PDB
+    (coord = dot(coord, rot) + tran), so they can be applied the same way as those of Superimposer."""
+
+    num_sets = len(ref_sets)
+    max_len = max([len(ref) for ref in ref_sets])
+    ref = np.zeros((num_sets, max_len, 3))
+    alt = np.zeros((num_sets, max_len, 3))
+    mask = np.zeros((num_sets, max_len))
+    for i, (ref_coords, alt_coords) in enumerate(zip(ref_sets, alt_sets)):
+        ref[i, :len(ref_coords)] = ref_coords
+        alt[i, :len(alt_coords)] = alt_coords
+        mask[i, :len(ref_coords)] = 1
+    counts = mask.sum(axis=1)
+
+    ref_centroids = ref.sum(axis=1) / counts[:, None]
+    alt_centroids = alt.sum(axis=1) / counts[:, None]
+    ref_centered = (ref - ref_centroids[:, None]) * mask[:, :, None]
+    alt_centered = (alt - alt_centroids[:, None]) * mask[:, :, None]
+
+    covariance = np.einsum('kni,knj->kij', alt_centered, ref_centered)
+    u, d, vt = np.linalg.svd(covariance)
+    # avoid reflections
+    u[:, :, 2] *= np.sign(np.linalg.det(np.matmul(u, vt)))[:, None]
+    rot = np.matmul(u, vt)
+    tran = ref_centroids - np.einsum('ki,kij->kj', alt_centroids, rot)
+
+    diff = (np.matmul(alt, rot) + tran[:, None] - ref) * mask[:, :, None]
+    rms = np.sqrt((diff ** 2).sum(axis=(1, 2)) / counts)
+
+    return rot, tran, rms
+
 #==============================================================================  
 class ProteinSuperpose(object):
   
@@ -21,6 +58,10 @@ class ProteinSuperpose(object):
     def __init__ (self, ref_file, alt_files, simple_selection):
     
         self.selection = SelectionParser(simple_selection)
+        #segment mappings of the structures that got generic numbers assigned here (see get_substructure_mapping_dict),
+        #kept so that they do not have to be assigned again when the superposed structures are downloaded
+        self.ref_substructure_mapping = None
+        self.alt_substructure_mapping = {}
     
         self.ref_struct = PDBParser(PERMISSIVE=True).get_structure('ref', ref_file)[0]
         assert self.ref_struct, self.logger.error("Can't parse the ref file %s".format(ref_file))
@@ -28,6 +69,7 @@ class ProteinSuperpose(object):
             if not check_gn(self.ref_struct):
                 gn_assigner = GenericNumbering(structure=self.ref_struct)
                 self.ref_struct = gn_assigner.assign_generic_numbers()
+                self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
       
         self.alt_structs = []
         for alt_id, alt_file in enumerate(alt_files):
@@ -38,6 +80,7 @@ class ProteinSuperpose(object):
                         gn_assigner = GenericNumbering(structure=tmp_struct)
                         self.alt_structs.append(gn_assigner.assign_generic_numbers())
                         self.alt_structs[-1].id = alt_id
+                        self.alt_substructure_mapping[alt_id] = gn_assigner.get_substructure_mapping_dict()
                     else:
                         self.alt_structs.append(tmp_struct)
             except Exception as e:
@@ -49,16 +92,27 @@ class ProteinSuperpose(object):
         if self.alt_structs == []:
             logger.error("No structures to align!")
             return []
-    
-        super_imposer = Superimposer()
+
+        #matched CA coordinates of all structures, superposed together
+        ref_sets, alt_sets, structs = [], [], []
         for alt_struct in self.alt_structs:
-            try:
-                ref, alt = self.selector.get_consensus_atom_sets(alt_struct.id)
-                super_imposer.set_atoms(ref, alt)
-                super_imposer.apply(alt_struct.get_atoms())
-                logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, super_imposer.rms))
-            except Exception as msg:
-                logger.error("Failed to superpose structures {} and {}\n{}".format(self.ref_struct.id, alt_struct.id, msg))
+            ref, alt = self.selector.get_consensus_coordinates(alt_struct.id)
+            if len(ref) == 0:
+                logger.error("Failed to superpose structures {} and {}\nNo matching atoms".format(self.ref_struct.id, alt_struct.id))
+                continue
+            ref_sets.append(ref)
+            alt_sets.append(alt)
+            structs.append(alt_struct)
+        if structs == []:
+            return self.alt_structs
+
+        rots, trans, rmss = batch_superpose(ref_sets, alt_sets)
+        for alt_struct, rot, tran, rms in zip(structs, rots, trans, rmss):
+            atoms = list(alt_struct.get_atoms())
+            coords = np.dot(np.array([atom.get_coord() for atom in atoms], dtype=np.float64), rot) + tran
+            for atom, coord in zip(atoms, coords.astype('f')):
+                atom.set_coord(coord)
+            logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, rms))
 
         return self.alt_structs
 
@@ -134,7 +188,7 @@ class FragmentSuperpose(object):
                 continue
             super_imposer = Superimposer()
             try:
-                fragment_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('alt', StringIO(fragment.get_pdbdata()))[0]
+                fragment_struct = fragment.get_structure('alt')[0]
                 super_imposer.set_atoms(atom_sel.get_ref_atoms(), atom_sel.get_alt_atoms())
                 super_imposer.apply(fragment_struct)
                 superposed_frags.append([fragment,fragment_struct])
@@ -4,6 +4,7 @@ from structure import views
 from django.conf import settings
 from django.views.generic import TemplateView
 from django.views.decorators.cache import cache_page
+from common.release_cache import release_cache_page
 
 urlpatterns = [
     url(r'^$', cache_page(60*60*24*7)(StructureBrowser.as_view()), name='structure_browser'),
@@ -11,7 +12,7 @@ urlpatterns = [
     url(r'^template_browser', TemplateBrowser.as_view(), name='structure_browser'),
     url(r'^template_selection', TemplateTargetSelection.as_view(), name='structure_browser'),
     url(r'^template_segment_selection', TemplateSegmentSelection.as_view(), name='structure_browser'),
-    url(r'^statistics$', cache_page(60*60*24*7)(StructureStatistics.as_view()), name='structure_statistics'),
+    url(r'^statistics$', release_cache_page()(StructureStatistics.as_view()), name='structure_statistics'),
     url(r'homology_models', ServeHomologyModels, name='homology_models'),
     url(r'^pdb_download_index$', PDBClean.as_view(), name='pdb_download'),
     url(r'pdb_segment_selection', PDBSegmentSelection.as_view(), name='pdb_download'),
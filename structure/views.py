@@ -787,12 +787,22 @@ class SuperpositionWorkflowResults(TemplateView):
             self.success = False
         elif len(out_structs) >= 1:
             io = PDBIO()
+            #the structures are kept with their generic numbers (and segment mappings, where they were assigned) so that
+            #the download does not have to assign them again
+            tmp = StringIO()
+            io.set_structure(superposition.ref_struct)
+            io.save(tmp)
+            self.request.session['ref_struct'] = tmp.getvalue()
+            self.request.session['ref_substructure_mapping'] = superposition.ref_substructure_mapping
             self.request.session['alt_structs'] = {}
+            self.request.session['alt_substructure_mapping'] = {}
             for alt_struct, alt_file_name in zip(out_structs, alt_file_names):
                 tmp = StringIO()
                 io.set_structure(alt_struct)
                 io.save(tmp)
-                self.request.session['alt_structs'][alt_file_name] = tmp
+                self.request.session['alt_structs'][alt_file_name] = tmp.getvalue()
+                if alt_struct.id in superposition.alt_substructure_mapping:
+                    self.request.session['alt_substructure_mapping'][alt_file_name] = superposition.alt_substructure_mapping[alt_struct.id]
 
             self.success = True
 
@@ -820,29 +830,34 @@ class SuperpositionWorkflowDownload(View):
         selection = Selection()
         if simple_selection:
             selection.importer(simple_selection)
-        self.alt_substructure_mapping = {}
+        #generic numbers and segment mappings from the results step are reused, they are only assigned here if they
+        #were not assigned there (i.e. the structures already had generic numbers)
+        self.ref_substructure_mapping = self.request.session.get('ref_substructure_mapping')
+        self.alt_substructure_mapping = dict(self.request.session.get('alt_substructure_mapping', {}))
         #reference
         if 'ref_file' in request.session.keys():
+            ref_name = self.request.session['ref_file'].name
+        elif selection.reference != []:
+            ref_name = '{}_{}_ref.pdb'.format(selection.reference[0].item.protein_conformation.protein.parent.entry_name, selection.reference[0].item.pdb_code.index)
+        if 'ref_struct' in request.session.keys():
+            ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(self.request.session['ref_struct']))[0]
+        elif 'ref_file' in request.session.keys():
             self.request.session['ref_file'].file.seek(0)
             ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(self.request.session['ref_file'].file.read().decode('UTF-8')))[0]
-            gn_assigner = GenericNumbering(structure=ref_struct)
-            gn_assigner.assign_generic_numbers()
-            self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
-            ref_name = self.request.session['ref_file'].name
         elif selection.reference != []:
             ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(selection.reference[0].item.get_cleaned_pdb()))[0]
+        if self.ref_substructure_mapping is None:
             gn_assigner = GenericNumbering(structure=ref_struct)
             gn_assigner.assign_generic_numbers()
             self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
-            ref_name = '{}_{}_ref.pdb'.format(selection.reference[0].item.protein_conformation.protein.parent.entry_name, selection.reference[0].item.pdb_code.index)
 
         alt_structs = {}
         for alt_id, st in self.request.session['alt_structs'].items():
-            st.seek(0)
-            alt_structs[alt_id] = PDBParser(PERMISSIVE=True, QUIET=True).get_structure(alt_id, st)[0]
-            gn_assigner = GenericNumbering(structure=alt_structs[alt_id])
-            gn_assigner.assign_generic_numbers()
-            self.alt_substructure_mapping[alt_id] = gn_assigner.get_substructure_mapping_dict()
+            alt_structs[alt_id] = PDBParser(PERMISSIVE=True, QUIET=True).get_structure(alt_id, StringIO(st))[0]
+            if alt_id not in self.alt_substructure_mapping:
+                gn_assigner = GenericNumbering(structure=alt_structs[alt_id])
+                gn_assigner.assign_generic_numbers()
+                self.alt_substructure_mapping[alt_id] = gn_assigner.get_substructure_mapping_dict()
 
         if self.kwargs['substructure'] == 'full':
 
@@ -852,10 +867,7 @@ class SuperpositionWorkflowDownload(View):
             zipf.writestr(ref_name, tmp.getvalue())
 
             for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp)
-                zipf.writestr(alt_name, tmp.getvalue())
+                zipf.writestr(alt_name, self.request.session['alt_structs'][alt_name])
 
         elif self.kwargs['substructure'] == 'substr':
 